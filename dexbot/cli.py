@@ -4,6 +4,7 @@ import os
 import os.path
 import signal
 import sys
+import time
 
 from dexbot.config import Config, DEFAULT_CONFIG_FILE
 from dexbot.cli_conf import SYSTEMD_SERVICE_NAME, get_whiptail, setup_systemd
@@ -15,6 +16,9 @@ from dexbot.ui import (
     configfile
 )
 from .worker import WorkerInfrastructure
+from .sharding import ShardSupervisor
+from .stats import load_stats, percentile
+from .metrics import METRICS_ADDRESS, start_http_server
 from .cli_conf import configure_dexbot, dexbot_service_running
 from . import errors
 from . import helper
@@ -70,21 +74,50 @@ def main(ctx, **kwargs):
 
 
 @main.command()
+@click.option(
+    '--processes',
+    '-n',
+    type=int,
+    default=1,
+    help='Number of processes to run the workers in, workers of an account share a process')
+@click.option(
+    '--metrics-port',
+    type=int,
+    default=None,
+    help='Serve Prometheus metrics on this port, with several processes each uses the next port')
+@click.option(
+    '--metrics-address',
+    default=METRICS_ADDRESS,
+    help='Serve Prometheus metrics on this address, 0.0.0.0 for all interfaces')
 @click.pass_context
 @configfile
 @chain
 @unlock
 @verbose
-def run(ctx):
+def run(ctx, processes, metrics_port, metrics_address):
     """ Continuously run the worker
     """
     if ctx.obj['pidfile']:
         with open(ctx.obj['pidfile'], 'w') as fd:
             fd.write(str(os.getpid()))
     try:
-        worker = WorkerInfrastructure(ctx.config)
-        # Set up signalling. do it here as of no relevance to GUI
-        kill_workers = worker_job(worker, lambda: worker.stop(pause=True))
+        if processes > 1:
+            worker = ShardSupervisor(
+                ctx.config,
+                get_account_keys(ctx.bitshares, ctx.config['workers']),
+                processes,
+                verbose=ctx.obj['verbose'],
+                systemd=ctx.obj['systemd'],
+                metrics_port=metrics_port,
+                metrics_address=metrics_address
+            )
+            kill_workers = worker.stop
+        else:
+            if metrics_port:
+                start_http_server(metrics_port, metrics_address)
+            worker = WorkerInfrastructure(ctx.config)
+            # Set up signalling. do it here as of no relevance to GUI
+            kill_workers = worker_job(worker, lambda: worker.stop(pause=True))
         # These first two UNIX & Windows
         signal.signal(signal.SIGTERM, kill_workers)
         signal.signal(signal.SIGINT, kill_workers)
@@ -151,9 +184,60 @@ def configure(ctx):
         os.system("systemctl --user start dexbot")
 
 
+@main.command()
+@click.pass_context
+def stats(ctx):
+    """ Show the event handler timings of the running workers
+    """
+    processes = load_stats()
+    if not processes:
+        click.echo("No statistics found, they are written by running workers once a minute")
+        return
+
+    def ms(seconds):
+        return '-' if seconds is None else '{:.0f}'.format(seconds * 1000)
+
+    for process in processes:
+        click.echo("Process {}, running since {}, updated {:.0f} s ago, handler budget {} s".format(
+            process['pid'],
+            time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(process['started'])),
+            time.time() - process['updated'],
+            process['budget']
+        ))
+        click.echo("{:<24} {:<16} {:>8} {:>8} {:>8} {:>8} {:>8} {:>9} {:>6}".format(
+            'worker', 'event', 'calls', 'avg ms', 'p50 ms', 'p95 ms', 'max ms', 'rpc/call', 'slow'))
+        for worker_name, events in sorted(process['workers'].items()):
+            for event, histogram in sorted(events.items()):
+                count = histogram['count']
+                click.echo("{:<24} {:<16} {:>8} {:>8} {:>8} {:>8} {:>8} {:>9.1f} {:>6}".format(
+                    worker_name, event, count,
+                    ms(histogram['total'] / count if count else None),
+                    ms(percentile(histogram, 0.5)),
+                    ms(percentile(histogram, 0.95)),
+                    ms(histogram['max']),
+                    histogram['rpc_calls'] / count if count else 0,
+                    histogram['slow']
+                ))
+        click.echo()
+
+
 def worker_job(worker, job):
     return lambda x, y: worker.do_next_tick(job)
 
 
+def get_account_keys(bitshares, workers):
+    """ Returns the active keys of the workers' accounts from the unlocked wallet
+
+        :return dict: Private key by account name
+    """
+    keys = {}
+    for account in {worker['account'] for worker in workers.values() if 'account' in worker}:
+        try:
+            keys[account] = bitshares.wallet.getActiveKeyForAccount(account)
+        except Exception:
+            log.warning('No active key of account {} found in the wallet'.format(account))
+    return keys
+
+
 if __name__ == '__main__':
     main()
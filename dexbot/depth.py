@@ -0,0 +1,119 @@
+""" Order book sides as arrays of prices and amounts, for pricing fills without building Order objects
+
+    NumPy is used when it is installed, otherwise the same is computed with lists.
+"""
+import bisect
+import itertools
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class MarketDepth:
+    """ One side of a market's order book, best order first
+
+        All values are in the market's terms: prices in BASE/QUOTE, amounts in BASE and QUOTE. The amounts are the
+        remainders of partially filled orders.
+
+        :param prices: Order prices
+        :param base: BASE amounts of the orders
+        :param quote: QUOTE amounts of the orders
+    """
+
+    def __init__(self, prices, base, quote):
+        self.prices = prices
+        self.base = base
+        self.quote = quote
+        if numpy is not None:
+            self.cum_base = numpy.cumsum(base)
+            self.cum_quote = numpy.cumsum(quote)
+        else:
+            self.cum_base = list(itertools.accumulate(base))
+            self.cum_quote = list(itertools.accumulate(quote))
+
+    def __len__(self):
+        return len(self.prices)
+
+    @property
+    def best_price(self):
+        """ Price of the best order, None if the side is empty
+        """
+        if not len(self):
+            return None
+        return float(self.prices[0])
+
+    def fill_price(self, amount, by_base=False):
+        """ Returns the average price of filling the amount against this side, best orders first
+
+            When the side holds less than the amount, the average price of the whole side is returned.
+
+            :param float amount: Amount to fill
+            :param bool by_base: The amount is in BASE, otherwise in QUOTE
+            :return: Price as float, None if the side is empty
+        """
+        if not len(self):
+            return None
+
+        cumulative = self.cum_base if by_base else self.cum_quote
+        # Number of orders filled completely
+        if numpy is not None:
+            filled = int(numpy.searchsorted(cumulative, amount, side='right'))
+        else:
+            filled = bisect.bisect_right(cumulative, amount)
+
+        base_amount = float(self.cum_base[filled - 1]) if filled else 0.0
+        quote_amount = float(self.cum_quote[filled - 1]) if filled else 0.0
+        if filled < len(self):
+            # Fill the rest from the next order
+            missing = amount - float(cumulative[filled - 1] if filled else 0)
+            price = float(self.prices[filled])
+            if by_base:
+                base_amount += missing
+                quote_amount += missing / price
+            else:
+                base_amount += missing * price
+                quote_amount += missing
+        return base_amount / quote_amount
+
+
+def market_depth(limit_orders, market, side, exclude_ids=()):
+    """ Build one side of the market's order book from raw limit orders
+
+        :param list limit_orders: Limit order objects as returned by rpc.get_limit_orders(), best first
+        :param market: The Market
+        :param str side: 'buy' for the orders selling BASE, 'sell' for the orders selling QUOTE
+        :param exclude_ids: Ids of orders to leave out, e.g. own orders
+        :return: MarketDepth
+    """
+    base_id = market['base']['id']
+    sold_id = base_id if side == 'buy' else market['quote']['id']
+    for_sale = []
+    receive_ratio = []
+    for order in limit_orders:
+        sell_price = order['sell_price']
+        if sell_price['base']['asset_id'] != sold_id or order['id'] in exclude_ids:
+            continue
+        for_sale.append(int(order['for_sale']))
+        receive_ratio.append(int(sell_price['quote']['amount']) / int(sell_price['base']['amount']))
+
+    base_scale = 10 ** market['base']['precision']
+    quote_scale = 10 ** market['quote']['precision']
+    if numpy is not None:
+        for_sale = numpy.array(for_sale, dtype=float)
+        received = for_sale * numpy.array(receive_ratio, dtype=float)
+        if side == 'buy':
+            base, quote = for_sale / base_scale, received / quote_scale
+        else:
+            base, quote = received / base_scale, for_sale / quote_scale
+        return MarketDepth(base / quote, base, quote)
+
+    received = [amount * ratio for amount, ratio in zip(for_sale, receive_ratio)]
+    if side == 'buy':
+        base = [amount / base_scale for amount in for_sale]
+        quote = [amount / quote_scale for amount in received]
+    else:
+        base = [amount / base_scale for amount in received]
+        quote = [amount / quote_scale for amount in for_sale]
+    return MarketDepth([b / q for b, q in zip(base, quote)], base, quote)
@@ -0,0 +1,381 @@
+import asyncio
+import collections
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from dexbot import metrics
+
+log = logging.getLogger(__name__)
+
+# Default number of threads running worker handlers in the threads dispatch mode
+DISPATCH_THREADS = 8
+
+# Default maximum number of events waiting in a worker's inbox
+EVENT_QUEUE_DEPTH = 100
+
+# Kinds of events of which only the latest one is kept in a worker's inbox. A tick on an older block and an account
+# update only tell the worker to recheck its state, market events carry the placed and filled orders
+COALESCED_EVENTS = ('block', 'account')
+
+# Kinds of events only dropped from a full inbox when it holds nothing else, the market events of filled orders
+KEPT_EVENTS = ('fill',)
+
+
+class InstanceLocks:
+    """ One lock per BitShares instance, held while a worker handler uses the instance
+
+        A BitShares instance is not thread safe: its RPC connection, its transaction buffer and its bundle flag are
+        shared by everything using it. Handlers of workers using the same instance take turns, while handlers of
+        workers with their own instances run in parallel.
+
+        Coroutines first wait for an asyncio lock of the instance, so they queue up on the event loop instead of
+        blocking it or the executor threads, see acquire_async().
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.locks = {}
+        self.async_locks = {}
+
+    def get(self, instance):
+        """ Returns the lock of the BitShares instance
+        """
+        with self.lock:
+            lock = self.locks.get(id(instance))
+            if lock is None:
+                lock = self.locks[id(instance)] = threading.Lock()
+            return lock
+
+    def get_async(self, instance):
+        """ Returns the asyncio lock of the BitShares instance, only to be used on the event loop
+        """
+        with self.lock:
+            lock = self.async_locks.get(id(instance))
+            if lock is None:
+                lock = self.async_locks[id(instance)] = asyncio.Lock()
+            return lock
+
+    async def acquire_async(self, instance):
+        """ Acquire the lock of the BitShares instance from a coroutine without blocking the event loop
+
+            Only the coroutine first in line for the instance waits for its thread lock, in the executor when a
+            thread outside the event loop holds it. Release it with release_async().
+        """
+        await self.get_async(instance).acquire()
+        lock = self.get(instance)
+        try:
+            if not lock.acquire(blocking=False):
+                await asyncio.get_event_loop().run_in_executor(None, lock.acquire)
+        except BaseException:
+            self.get_async(instance).release()
+            raise
+
+    def release_async(self, instance):
+        """ Release the lock of the BitShares instance acquired with acquire_async()
+        """
+        self.get(instance).release()
+        self.get_async(instance).release()
+
+
+class SequentialDispatcher:
+    """ Runs worker handlers right away on the calling thread, one after another
+    """
+
+    # Whether dispatched handlers are coroutine functions run on an event loop
+    is_async = False
+    # Whether handlers of different workers may run at the same time
+    is_parallel = False
+
+    def dispatch(self, worker_name, func, *args):
+        func(*args)
+
+    def wait_idle(self, worker_name=None, timeout=None):
+        return True
+
+    def shutdown(self):
+        pass
+
+
+class ThreadPoolDispatcher:
+    """ Runs worker handlers on a bounded thread pool
+
+        Handlers of one worker are serialized: they run in the order they were dispatched and never two at the same
+        time, while handlers of different workers run in parallel. After each handler the worker gives up its thread,
+        so a worker with a long backlog can't starve the others.
+
+        Handlers of workers sharing a BitShares instance must not run at the same time, WorkerInfrastructure holds
+        the instance's lock (see InstanceLocks) while calling them.
+
+        :param int max_threads: Maximum number of handlers running at the same time
+    """
+
+    is_async = False
+    is_parallel = True
+
+    def __init__(self, max_threads=DISPATCH_THREADS):
+        self.executor = ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix='dexbot-dispatch')
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        # Handlers waiting to run by worker name, a worker has an entry while it has handlers queued or running
+        self.pending = {}
+
+    def dispatch(self, worker_name, func, *args):
+        with self.lock:
+            tasks = self.pending.get(worker_name)
+            if tasks is not None:
+                # The worker is busy, its queue is drained by the running handler
+                tasks.append((func, args))
+                return
+            self.pending[worker_name] = collections.deque([(func, args)])
+        self.executor.submit(self._run_next, worker_name)
+
+    def _run_next(self, worker_name):
+        with self.lock:
+            func, args = self.pending[worker_name].popleft()
+
+        try:
+            func(*args)
+        except Exception:
+            log.exception('Unhandled exception in handler of worker {}'.format(worker_name))
+        finally:
+            with self.lock:
+                if self.pending[worker_name]:
+                    try:
+                        self.executor.submit(self._run_next, worker_name)
+                        return
+                    except RuntimeError:
+                        # Shut down, drop the backlog
+                        pass
+                del self.pending[worker_name]
+                self.idle.notify_all()
+
+    def wait_idle(self, worker_name=None, timeout=None):
+        """ Block until the handlers of the worker, or of all workers, are done
+
+            :param str worker_name: Name of the worker to wait for, None waits for all workers
+            :param float timeout: Maximum time to wait in seconds, None waits forever
+            :return bool: False if the timeout expired
+        """
+        if worker_name is None:
+            predicate = (lambda: not self.pending)
+        else:
+            predicate = (lambda: worker_name not in self.pending)
+
+        with self.idle:
+            return self.idle.wait_for(predicate, timeout)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=False)
+
+
+class AsyncioDispatcher:
+    """ Runs worker handlers as tasks of an asyncio event loop running in its own thread
+
+        Dispatched handlers are coroutine functions. Handlers of one worker are serialized like in the
+        ThreadPoolDispatcher, while a handler awaiting RPC calls or sleeping lets the handlers of the other workers
+        run. Blocking functions are run in the loop's default executor, see call().
+
+        Like with the ThreadPoolDispatcher, handlers of workers sharing a BitShares instance take turns: the worker
+        infrastructure holds the instance's lock (see InstanceLocks.acquire_async()) for the whole handler, including
+        the blocking parts running in the executor.
+
+        :param int max_threads: Size of the executor running blocking functions
+    """
+
+    is_async = True
+    is_parallel = True
+
+    def __init__(self, max_threads=DISPATCH_THREADS):
+        self.loop = asyncio.new_event_loop()
+        self.executor = ThreadPoolExecutor(max_workers=max_threads, thread_name_prefix='dexbot-blocking')
+        self.loop.set_default_executor(self.executor)
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        # Handlers waiting to run by worker name, a worker has an entry while it has handlers queued or running
+        self.pending = {}
+
+        self.thread = threading.Thread(target=self._run_loop, name='dexbot-asyncio', daemon=True)
+        self.thread.start()
+
+    def _run_loop(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def dispatch(self, worker_name, func, *args):
+        with self.lock:
+            tasks = self.pending.get(worker_name)
+            if tasks is not None:
+                tasks.append((func, args))
+                return
+            self.pending[worker_name] = collections.deque([(func, args)])
+        asyncio.run_coroutine_threadsafe(self._run_worker(worker_name), self.loop)
+
+    async def _run_worker(self, worker_name):
+        while True:
+            with self.lock:
+                tasks = self.pending[worker_name]
+                if not tasks:
+                    del self.pending[worker_name]
+                    self.idle.notify_all()
+                    return
+                func, args = tasks.popleft()
+
+            try:
+                await self.call(func, *args)
+            except Exception:
+                log.exception('Unhandled exception in handler of worker {}'.format(worker_name))
+
+    async def call(self, func, *args):
+        """ Call a handler from the event loop
+
+            Coroutine functions are awaited, other callables run in the executor so they can't block the loop. A
+            coroutine returned by them is awaited as well.
+        """
+        if asyncio.iscoroutinefunction(func):
+            return await func(*args)
+
+        result = await self.loop.run_in_executor(None, functools.partial(func, *args))
+        if asyncio.iscoroutine(result):
+            result = await result
+        return result
+
+    def wait_idle(self, worker_name=None, timeout=None):
+        """ Block until the handlers of the worker, or of all workers, are done
+
+            Must not be called from the event loop.
+        """
+        if worker_name is None:
+            predicate = (lambda: not self.pending)
+        else:
+            predicate = (lambda: worker_name not in self.pending)
+
+        with self.idle:
+            return self.idle.wait_for(predicate, timeout)
+
+    def shutdown(self):
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self.executor.shutdown(wait=False)
+
+
+class WorkerInbox:
+    """ Queue of the events waiting to be handled by one worker
+
+        Ticks and account updates only tell the worker to recheck its state, so for these kinds (see
+        COALESCED_EVENTS) an event replaces the one of the same kind still waiting, keeping its place in the queue.
+
+        When the queue is full the oldest event is dropped, preferring events which are not of the kept kinds (see
+        KEPT_EVENTS) such as the filled orders of market events. Only when the queue holds nothing but kept events
+        the oldest of them is dropped, so the queue never grows beyond its maximum depth.
+
+        Coalesced and dropped events are counted in the metrics of the worker as well, which unlike the counters of
+        the inbox keep counting when the worker is started again.
+
+        :param int max_depth: Maximum number of events waiting
+        :param tuple coalesced: Kinds of events of which only the latest one is kept
+        :param tuple kept: Kinds of events dropped last
+        :param str worker_name: Name of the worker, None doesn't count the events in the metrics
+    """
+
+    def __init__(self, max_depth=EVENT_QUEUE_DEPTH, coalesced=COALESCED_EVENTS, kept=KEPT_EVENTS, worker_name=None):
+        self.worker_name = worker_name
+        self.max_depth = max_depth
+        self.coalesced = coalesced
+        self.kept = kept
+        self.lock = threading.Lock()
+        # Entries are [kind, event] lists, the waiting entry of a coalesced kind is also kept in self.latest
+        self.events = collections.deque()
+        self.latest = {}
+        # Whether processing of the inbox has been scheduled, see put() and get()
+        self.scheduled = False
+        self.counters = {'received': 0, 'coalesced': 0, 'dropped': 0, 'processed': 0, 'max_depth': 0}
+
+    def put(self, kind, event):
+        """ Add an event to the inbox
+
+            :param str kind: Kind of the event, e.g. 'block', 'market', 'fill' or 'account'
+            :param event: The event
+            :return bool: True if the caller has to schedule processing of the inbox
+        """
+        with self.lock:
+            self.counters['received'] += 1
+            entry = self.latest.get(kind)
+            if entry is not None:
+                entry[1] = event
+                self.counters['coalesced'] += 1
+                if self.worker_name is not None:
+                    metrics.EVENTS_COALESCED.inc(worker=self.worker_name)
+            else:
+                if len(self.events) >= self.max_depth:
+                    self._drop_oldest()
+                entry = [kind, event]
+                self.events.append(entry)
+                if kind in self.coalesced:
+                    self.latest[kind] = entry
+                self.counters['max_depth'] = max(self.counters['max_depth'], len(self.events))
+
+            if self.scheduled:
+                return False
+            self.scheduled = True
+            return True
+
+    def get(self):
+        """ Take the oldest event from the inbox
+
+            :return: The event, None if the inbox is empty. The next put() then asks for processing to be scheduled.
+        """
+        with self.lock:
+            if not self.events:
+                self.scheduled = False
+                return None
+            entry = self.events.popleft()
+            self._forget(entry)
+            self.counters['processed'] += 1
+            return entry[1]
+
+    def _drop_oldest(self):
+        for index, entry in enumerate(self.events):
+            if entry[0] not in self.kept:
+                break
+        else:
+            index = 0
+            entry = self.events[0]
+            log.warning('Inbox full of {} events, dropping the oldest one'.format(entry[0]))
+
+        del self.events[index]
+        self._forget(entry)
+        self.counters['dropped'] += 1
+        if self.worker_name is not None:
+            metrics.EVENTS_DROPPED.inc(worker=self.worker_name)
+
+    def _forget(self, entry):
+        if self.latest.get(entry[0]) is entry:
+            del self.latest[entry[0]]
+
+    def stats(self):
+        """ Returns the event counters of the inbox and its current depth
+        """
+        with self.lock:
+            return dict(self.counters, depth=len(self.events))
+
+
+def create_dispatcher(config):
+    """ Create the dispatcher selected in the config
+
+        config.yml keys:
+            dispatch_mode: 'sequential' (default) runs handlers on the notification thread, 'threads' runs them on a
+                           thread pool, 'asyncio' runs them on an event loop
+            dispatch_threads: Size of the thread pool in the threads mode, or of the executor running blocking
+                              handlers in the asyncio mode
+
+        :param dict config: dexbot config
+    """
+    mode = config.get('dispatch_mode', 'sequential')
+    if mode == 'threads':
+        return ThreadPoolDispatcher(int(config.get('dispatch_threads', DISPATCH_THREADS)))
+    if mode == 'asyncio':
+        return AsyncioDispatcher(int(config.get('dispatch_threads', DISPATCH_THREADS)))
+    if mode != 'sequential':
+        log.warning('Unknown dispatch_mode "{}", using sequential dispatch'.format(mode))
+    return SequentialDispatcher()
@@ -0,0 +1,216 @@
+""" Minimal metrics registry with a Prometheus text format exporter
+
+    The metrics are always collected, they are cheap dict updates. The exporter is only started with
+    ``dexbot-cli run --metrics-port``.
+"""
+import logging
+import math
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+log = logging.getLogger(__name__)
+
+# Address the metrics are served on by default, only reachable from the same machine
+METRICS_ADDRESS = '127.0.0.1'
+
+# Default histogram buckets, seconds
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+class Metric:
+    """ Base of the metric types: a value per combination of label values
+
+        :param str name: Metric name
+        :param str documentation: Help text
+        :param tuple labelnames: Names of the labels
+    """
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.lock = threading.Lock()
+        self.values = {}
+        self.callback = None
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def set_callback(self, callback):
+        """ Get the values from a function when collected instead of storing them
+
+            :param callback: Function returning the values by tuple of label values
+        """
+        self.callback = callback
+
+    def _values(self):
+        if self.callback is not None:
+            try:
+                return dict(self.callback())
+            except Exception:
+                log.exception('Collecting {} failed'.format(self.name))
+                return {}
+        with self.lock:
+            return dict(self.values)
+
+    def _format_labels(self, key, extra=()):
+        pairs = list(zip(self.labelnames, key)) + list(extra)
+        if not pairs:
+            return ''
+        return '{' + ','.join('{}="{}"'.format(name, escape(value)) for name, value in pairs) + '}'
+
+    def samples(self):
+        for key, value in sorted(self._values().items()):
+            yield '{}{} {}'.format(self.name, self._format_labels(key), format_value(value))
+
+    def expose(self):
+        lines = [
+            '# HELP {} {}'.format(self.name, self.documentation),
+            '# TYPE {} {}'.format(self.name, self.type),
+        ]
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+    """ Histogram of observed values, e.g. durations in seconds
+
+        :param tuple buckets: Upper bounds of the buckets, +Inf is added
+    """
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self.lock:
+            counts = self.values.get(key)
+            if counts is None:
+                # Counts per bucket, the +Inf bucket, then the sum
+                counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            else:
+                counts[len(self.buckets)] += 1
+            counts[-1] += value
+
+    def samples(self):
+        for key, counts in sorted(self._values().items()):
+            cumulative = 0
+            bounds = [format_value(bound) for bound in self.buckets] + ['+Inf']
+            for bound, count in zip(bounds, counts):
+                cumulative += count
+                yield '{}_bucket{} {}'.format(self.name, self._format_labels(key, [('le', bound)]), cumulative)
+            yield '{}_sum{} {}'.format(self.name, self._format_labels(key), format_value(counts[-1]))
+            yield '{}_count{} {}'.format(self.name, self._format_labels(key), cumulative)
+
+    def _values(self):
+        with self.lock:
+            return {key: list(counts) for key, counts in self.values.items()}
+
+
+def escape(value):
+    return str(value).replace('\\', r'\\').replace('\n', r'\n').replace('"', r'\"')
+
+
+def format_value(value):
+    if isinstance(value, float):
+        if math.isnan(value):
+            return 'NaN'
+        if math.isinf(value):
+            return '+Inf' if value > 0 else '-Inf'
+        return repr(value)
+    return str(value)
+
+
+def expose():
+    """ Returns all metrics in the Prometheus text format
+    """
+    return '\n'.join(metric.expose() for metric in REGISTRY) + '\n'
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = expose().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+
+class MetricsServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def start_http_server(port, address=METRICS_ADDRESS):
+    """ Serve the metrics on http://address:port/metrics in a background thread
+
+        :param int port: Port to serve the metrics on
+        :param str address: Address to serve the metrics on, '0.0.0.0' serves them on all interfaces
+        :return MetricsServer: The server, shut it down with server.shutdown()
+    """
+    server = MetricsServer((address, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever, name='dexbot-metrics', daemon=True)
+    thread.start()
+    log.info('Serving metrics on {}:{}'.format(address, port))
+    return server
+
+
+# All metrics, in the order they are exposed
+REGISTRY = []
+
+BLOCK_LAG = Gauge(
+    'dexbot_block_lag_seconds', 'Time between the timestamp of the last block and its notification, NaN if unknown')
+EVENTS = Counter(
+    'dexbot_events_total', 'Events received for the workers', ('worker', 'kind'))
+EVENTS_COALESCED = Counter(
+    'dexbot_events_coalesced_total', 'Events replaced by a newer one before being handled', ('worker',))
+EVENTS_DROPPED = Counter(
+    'dexbot_events_dropped_total', 'Events dropped from a full worker inbox', ('worker',))
+EVENT_QUEUE_DEPTH = Gauge(
+    'dexbot_event_queue_depth', 'Events waiting in the worker inbox', ('worker',))
+HANDLER_DURATION = Histogram(
+    'dexbot_handler_duration_seconds', 'Duration of the worker event handler calls', ('worker', 'event'))
+HANDLER_ERRORS = Counter(
+    'dexbot_handler_errors_total', 'Exceptions raised by the worker event handlers', ('worker', 'event'))
+ORDERS_PLACED = Counter(
+    'dexbot_orders_placed_total', 'Orders placed by the workers', ('worker', 'side'))
+ORDERS_CANCELLED = Counter(
+    'dexbot_orders_cancelled_total', 'Orders cancelled by the workers', ('worker',))
+ACTION_RETRIES = Counter(
+    'dexbot_action_retries_total', 'Actions retried after a spurious node error', ('worker',))
+RPC_DURATION = Histogram(
+    'dexbot_rpc_duration_seconds', 'Duration of the node RPC calls', ('method',))
+RPC_ERRORS = Counter(
+    'dexbot_rpc_errors_total', 'Node RPC calls which raised an exception', ('method',))
+DATABASE_QUEUE_SIZE = Gauge(
+    'dexbot_database_queue_size', 'Tasks waiting for the database worker')
@@ -0,0 +1,357 @@
+import bisect
+import logging
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# Cached order books are refetched after this long even without a block or market notification, seconds
+ORDER_BOOK_TTL = 3
+
+# Minimum number of orders per side fetched, so small depth queries of different workers share one fetch
+ORDER_BOOK_MIN_DEPTH = 20
+
+# Number of orders per side a local order book is seeded with
+LOCAL_BOOK_DEPTH = 100
+
+# How often a local order book is compared with the node's and reseeded when they differ, seconds
+LOCAL_BOOK_RESYNC_INTERVAL = 60
+
+
+def book_key(base_symbol, quote_symbol):
+    """ Returns the key of a market's order book regardless of the market's orientation
+    """
+    return frozenset((base_symbol, quote_symbol))
+
+
+def satoshis(amount):
+    """ Returns the integer amount of an Amount as used by the blockchain objects
+    """
+    return int(round(amount['amount'] * 10 ** amount['asset']['precision']))
+
+
+def raw_limit_order(order):
+    """ Returns the limit order object of an Order received with a market notification
+
+        :param order: Order, or a limit order object
+        :return: dict: Limit order object like the ones returned by rpc.get_limit_orders(), None if the order lacks
+                       the data
+    """
+    if 'sell_price' in order and 'for_sale' in order and not isinstance(order['for_sale'], dict):
+        return order
+    try:
+        return {
+            'id': order['id'],
+            'sell_price': {
+                'base': {'amount': satoshis(order['base']), 'asset_id': order['base']['asset']['id']},
+                'quote': {'amount': satoshis(order['quote']), 'asset_id': order['quote']['asset']['id']},
+            },
+            'for_sale': satoshis(order['for_sale']),
+        }
+    except (KeyError, TypeError, AttributeError):
+        return None
+
+
+def sort_key(order):
+    """ Returns the key sorting the orders selling the same asset best first: by the amount asked per amount sold,
+        then by age
+    """
+    sell_price = order['sell_price']
+    return (
+        int(sell_price['quote']['amount']) / int(sell_price['base']['amount']),
+        int(order['id'].split('.')[2]),
+        order['id'],
+    )
+
+
+class LocalOrderBook:
+    """ Order book of a market kept up to date from the market notifications
+
+        The book is seeded with the best orders of both sides, then orders are inserted, updated and removed as the
+        notifications come in. Each side is a list of sort keys kept sorted with bisect.
+
+        A side which had more orders on the node than were seeded is only known down to its worst seeded order, new
+        orders beyond that can't be placed correctly. Queries deeper than the known part return None and the caller
+        seeds the book again.
+
+        :param str base_id: Asset id of the market's base
+        :param str quote_id: Asset id of the market's quote
+    """
+
+    def __init__(self, base_id, quote_id):
+        self.asset_ids = (base_id, quote_id)
+        # Sort keys by id of the asset the orders sell
+        self.sides = {base_id: [], quote_id: []}
+        # Worst seeded sort key by side, None for sides known completely
+        self.boundaries = {base_id: None, quote_id: None}
+        # Limit order objects and their sort keys by order id
+        self.orders = {}
+        self.keys = {}
+        self.synced = 0
+
+    def seed(self, orders, depth):
+        """ Replace the book's content with limit orders fetched from the node
+
+            :param list orders: Result of rpc.get_limit_orders()
+            :param int depth: The limit used to fetch the orders
+        """
+        self.sides = {asset_id: [] for asset_id in self.asset_ids}
+        self.boundaries = {asset_id: None for asset_id in self.asset_ids}
+        self.orders = {}
+        self.keys = {}
+        for order in orders:
+            self.update(order)
+        self.boundaries = {
+            asset_id: keys[-1] if len(keys) >= depth else None
+            for asset_id, keys in self.sides.items()
+        }
+        self.synced = time.time()
+
+    def update(self, order):
+        """ Insert a new order or update a changed one
+
+            :param dict order: Limit order object
+            :return bool: False if the order isn't in this book's market
+        """
+        asset_id = order['sell_price']['base']['asset_id']
+        if asset_id not in self.sides or order['sell_price']['quote']['asset_id'] not in self.sides:
+            return False
+
+        self.remove(order['id'])
+        key = sort_key(order)
+        boundary = self.boundaries[asset_id]
+        if boundary is not None and key > boundary:
+            # Beyond the known part of the side, there may be unknown orders in front of it
+            return True
+        bisect.insort(self.sides[asset_id], key)
+        self.orders[order['id']] = order
+        self.keys[order['id']] = (asset_id, key)
+        return True
+
+    def remove(self, order_id):
+        """ Remove a filled or cancelled order
+
+            :return bool: False if the order isn't in the book
+        """
+        entry = self.keys.pop(order_id, None)
+        if entry is None:
+            return False
+        asset_id, key = entry
+        keys = self.sides[asset_id]
+        index = bisect.bisect_left(keys, key)
+        if index < len(keys) and keys[index] == key:
+            del keys[index]
+        del self.orders[order_id]
+        return True
+
+    def get_limit_orders(self, base_id, quote_id, depth):
+        """ Returns the best orders like rpc.get_limit_orders(base_id, quote_id, depth), None if the book doesn't
+            know that many orders of a side
+        """
+        orders = []
+        for asset_id in (base_id, quote_id):
+            keys = self.sides[asset_id]
+            if self.boundaries[asset_id] is not None and len(keys) < depth:
+                return None
+            orders.extend(self.orders[key[2]] for key in keys[:depth])
+        return orders
+
+    def matches(self, orders):
+        """ Compare the book with limit orders freshly fetched from the node
+
+            :param list orders: Result of rpc.get_limit_orders()
+            :return bool: True if the book has the same best orders with the same amounts for sale
+        """
+        fetched = {asset_id: [] for asset_id in self.asset_ids}
+        for order in orders:
+            fetched.setdefault(order['sell_price']['base']['asset_id'], []).append(
+                (order['id'], int(order['for_sale'])))
+
+        for asset_id, fetched_side in fetched.items():
+            local_keys = self.sides.get(asset_id, [])[:len(fetched_side)]
+            local_side = [(key[2], int(self.orders[key[2]]['for_sale'])) for key in local_keys]
+            if local_side != fetched_side:
+                return False
+        return True
+
+
+class OrderBookCache:
+    """ Limit orders of the markets, fetched once and shared by all workers of the process
+
+        Markets the process is subscribed to are tracked (see track()): their books are LocalOrderBooks, kept up to
+        date by WorkerInfrastructure from the market notifications and compared with the node's book every
+        resync_interval seconds.
+
+        Books of the other markets are kept until they are invalidated, by WorkerInfrastructure on every block and on
+        notifications of their market, or until they are older than the ttl.
+
+        Concurrent requests for a book that is being fetched wait for that fetch instead of starting their own.
+
+        :param float ttl: Maximum age of a cached book in seconds
+        :param int min_depth: Minimum number of orders per side to fetch
+        :param int local_depth: Number of orders per side local books are seeded with
+        :param float resync_interval: Time between the checks of the local books in seconds
+    """
+
+    def __init__(self, ttl=ORDER_BOOK_TTL, min_depth=ORDER_BOOK_MIN_DEPTH, local_depth=LOCAL_BOOK_DEPTH,
+                 resync_interval=LOCAL_BOOK_RESYNC_INTERVAL):
+        self.ttl = ttl
+        self.min_depth = min_depth
+        self.local_depth = local_depth
+        self.resync_interval = resync_interval
+        self.lock = threading.Lock()
+        # Per book key: {'sides': raw orders by id of the asset they sell, 'depth': orders fetched per side,
+        # 'time': fetch time}
+        self.books = {}
+        # Keys of the tracked markets and their local books, created on first use
+        self.tracked = set()
+        self.local_books = {}
+        # Notifications received while the book of a tracked market is fetched, applied to the fetched book
+        self.pending = {}
+        # Fetches in progress by book key, set when they are done
+        self.fetching = {}
+        # Incremented by invalidate(), a fetch started before an invalidation isn't cached
+        self.generations = {}
+
+    def get_limit_orders(self, bitshares, market, depth):
+        """ Returns the raw limit orders of the market like rpc.get_limit_orders(): up to depth orders buying, then
+            up to depth orders selling QUOTE, best first
+
+            :param bitshares: BitShares instance to fetch the book with
+            :param market: The Market
+            :param int depth: Number of orders per side
+        """
+        key = book_key(market['base']['symbol'], market['quote']['symbol'])
+        base_id, quote_id = market['base']['id'], market['quote']['id']
+        while True:
+            with self.lock:
+                if key in self.tracked:
+                    local_book = self.local_books.get(key)
+                    if local_book and time.time() - local_book.synced < self.resync_interval:
+                        orders = local_book.get_limit_orders(base_id, quote_id, depth)
+                        if orders is not None:
+                            return orders
+                else:
+                    book = self.books.get(key)
+                    if book and book['depth'] >= depth and time.time() - book['time'] < self.ttl:
+                        return self._cut(book, market, depth)
+                fetching = self.fetching.get(key)
+                if fetching is None:
+                    fetching = self.fetching[key] = threading.Event()
+                    generation = self.generations.get(key, 0)
+                    self.pending[key] = []
+                    break
+            fetching.wait()
+
+        try:
+            fetch_depth = max(depth, self.min_depth)
+            if key in self.tracked:
+                fetch_depth = max(fetch_depth, self.local_depth)
+            orders = bitshares.rpc.get_limit_orders(base_id, quote_id, fetch_depth)
+
+            with self.lock:
+                if key in self.tracked:
+                    return self._sync_local_book(key, base_id, quote_id, orders, fetch_depth, depth)
+
+                sides = {}
+                for order in orders:
+                    sides.setdefault(order['sell_price']['base']['asset_id'], []).append(order)
+                book = {'sides': sides, 'depth': fetch_depth, 'time': time.time()}
+                if self.generations.get(key, 0) == generation:
+                    self.books[key] = book
+                return self._cut(book, market, depth)
+        finally:
+            with self.lock:
+                del self.fetching[key]
+                self.pending.pop(key, None)
+            fetching.set()
+
+    def _sync_local_book(self, key, base_id, quote_id, orders, fetch_depth, depth):
+        local_book = self.local_books.get(key)
+        if local_book is None:
+            local_book = self.local_books[key] = LocalOrderBook(base_id, quote_id)
+        elif local_book.synced and not self.pending[key]:
+            if local_book.matches(orders):
+                local_book.synced = time.time()
+                result = local_book.get_limit_orders(base_id, quote_id, depth)
+                if result is not None:
+                    return result
+            else:
+                log.debug('Local order book of {} differs from the node, seeding it again'.format('/'.join(key)))
+
+        local_book.seed(orders, fetch_depth)
+        for update in self.pending[key]:
+            update(local_book)
+        result = local_book.get_limit_orders(base_id, quote_id, depth)
+        if result is None:
+            # Deeper than fetched, return what the node has
+            result = orders
+        return result
+
+    @staticmethod
+    def _cut(book, market, depth):
+        return (book['sides'].get(market['base']['id'], [])[:depth] +
+                book['sides'].get(market['quote']['id'], [])[:depth])
+
+    def invalidate(self, key=None):
+        """ Drop a cached book of an untracked market, or all of them
+
+            :param frozenset key: Book key of the market, see book_key(), None drops all books
+        """
+        with self.lock:
+            keys = set(self.books) | set(self.fetching) if key is None else [key]
+            for book in keys:
+                self.books.pop(book, None)
+                self.generations[book] = self.generations.get(book, 0) + 1
+
+    def track(self, keys):
+        """ Set the markets whose books are kept up to date from market notifications
+
+            :param set keys: Book keys of the markets, see book_key()
+        """
+        with self.lock:
+            self.tracked = set(keys)
+            for key in list(self.local_books):
+                if key not in self.tracked:
+                    del self.local_books[key]
+
+    def is_tracked(self, key):
+        return key in self.tracked
+
+    def update_order(self, key, order):
+        """ Apply a notification of a new or changed order to the market's local book
+
+            :param frozenset key: Book key of the market
+            :param order: The notified Order
+        """
+        limit_order = raw_limit_order(order)
+        if limit_order is None:
+            return
+        self._apply(key, lambda local_book: local_book.update(limit_order))
+
+    def remove_order(self, order_id):
+        """ Apply a notification of a filled or cancelled order, it is removed from the book containing it
+
+            :param str order_id: Id of the order
+        """
+        with self.lock:
+            keys = [key for key, local_book in self.local_books.items() if order_id in local_book.orders]
+            keys.extend(key for key in self.pending if key not in keys)
+        for key in keys:
+            self._apply(key, lambda local_book: local_book.remove(order_id))
+
+    def _apply(self, key, update):
+        with self.lock:
+            if key not in self.tracked:
+                return
+            local_book = self.local_books.get(key)
+            if local_book is not None:
+                update(local_book)
+            pending = self.pending.get(key)
+            if pending is not None:
+                # The book is being fetched, the fetched book may not contain the change yet
+                pending.append(update)
+
+
+# The order books of this process
+order_books = OrderBookCache()
@@ -0,0 +1,156 @@
+import calendar
+import logging
+import threading
+import time
+import zlib
+
+from dexbot import metrics
+
+log = logging.getLogger(__name__)
+
+# Ticks of blocks notified more than this many seconds after they were produced are skipped, 0 never skips
+TICK_MAX_LAG = 60
+
+
+def block_number(block_id):
+    """ Returns the number of a block from its id, None if it is not a block id
+
+        :param str block_id: Id of the block as received by on_block(), its first 8 hex digits are the block number
+    """
+    try:
+        return int(block_id[:8], 16)
+    except (TypeError, ValueError):
+        return None
+
+
+def block_timestamp(header):
+    """ Returns the unix time a block was produced at, None if it is not known
+
+        :param dict header: Block header as returned by rpc.get_block_header()
+    """
+    try:
+        return calendar.timegm(time.strptime(header['timestamp'], '%Y-%m-%dT%H:%M:%S'))
+    except (KeyError, TypeError, ValueError):
+        return None
+
+
+def tick_offset(worker_name, period):
+    """ Returns a stable offset of the worker's ticks within the period, spreading the workers over it
+
+        :param str worker_name: Name of the worker
+        :param int period: Number of blocks, or of milliseconds
+    """
+    return zlib.crc32(worker_name.encode('utf-8')) % period
+
+
+class TickScheduler:
+    """ Decides which workers get an ontick event for a block
+
+        Strategies declare their cadence with attributes (see StrategyBase):
+            tick_blocks: Tick every N blocks
+            tick_interval: Tick at most once per this many seconds, of block time
+            tick_on_change: Only tick after a market or account event was posted to the worker
+
+        Every worker gets its own offset within its cadence, so workers with the same cadence don't all tick on the
+        same block. While the node falls behind and blocks arrive late, their ticks are skipped altogether: a burst
+        of catch-up blocks then doesn't make every worker recheck the same state over and over.
+
+        The notification of a block only carries its id, the time the block was produced at is looked up with
+        block_header.
+
+        :param float max_lag: Maximum lag of a block to still tick on it in seconds, 0 never skips
+        :param block_header: Callable returning the header of the block with the given number, like
+                             rpc.get_block_header(). None doesn't look up the block time and never skips
+    """
+
+    def __init__(self, max_lag=TICK_MAX_LAG, block_header=None):
+        self.max_lag = max_lag
+        self.block_header = block_header
+        self.lock = threading.Lock()
+        # Seconds between the production of the current block and its notification, None if unknown
+        self.lag = None
+        self.behind = False
+        self.block_num = 0
+        self.block_time = time.time()
+        # Per worker: block time of the next tick allowed by tick_interval, and whether it got an event since its
+        # last tick
+        self.next_tick = {}
+        self.changed = {}
+
+    def new_block(self, block_id):
+        """ Advance to a new block
+
+            :param str block_id: Id of the block, as received by on_block()
+            :return bool: False if the block is stale and nobody ticks on it
+        """
+        # The lag is measured up to the notification, not including the header lookup
+        now = time.time()
+        number = block_number(block_id)
+        timestamp = None
+        if number is not None and self.block_header is not None:
+            try:
+                timestamp = block_timestamp(self.block_header(number))
+            except Exception:
+                log.debug('Could not get the header of block {}'.format(number), exc_info=True)
+        with self.lock:
+            if number is None:
+                self.block_num += 1
+            else:
+                self.block_num = number
+
+            if timestamp is None:
+                self.lag = None
+                self.block_time = now
+                metrics.BLOCK_LAG.set(float('nan'))
+                return True
+
+            self.lag = now - timestamp
+            metrics.BLOCK_LAG.set(self.lag)
+            self.block_time = timestamp
+            behind = bool(self.max_lag) and self.lag > self.max_lag
+            if behind and not self.behind:
+                log.warning('Blocks arrive {:.0f} s late, skipping ticks until the node caught up'.format(self.lag))
+            elif self.behind and not behind:
+                log.info('Node caught up, ticking again')
+            self.behind = behind
+            return not behind
+
+    def on_change(self, worker_name):
+        """ Note that a market or account event was posted to the worker
+        """
+        with self.lock:
+            self.changed[worker_name] = True
+
+    def is_due(self, worker_name, worker):
+        """ Returns whether the worker ticks on the current block, recording the tick if it does
+
+            :param str worker_name: Name of the worker
+            :param worker: The worker's strategy instance
+        """
+        blocks = max(int(getattr(worker, 'tick_blocks', 1) or 1), 1)
+        interval = float(getattr(worker, 'tick_interval', 0) or 0)
+        on_change = getattr(worker, 'tick_on_change', False)
+
+        with self.lock:
+            if blocks > 1 and (self.block_num + tick_offset(worker_name, blocks)) % blocks:
+                return False
+            if on_change and not self.changed.get(worker_name):
+                return False
+            if interval:
+                next_tick = self.next_tick.get(worker_name)
+                if next_tick is None:
+                    # The first tick comes within one interval, at the worker's offset in it
+                    next_tick = self.block_time + tick_offset(worker_name, max(int(interval * 1000), 1)) / 1000
+                    self.next_tick[worker_name] = next_tick
+                if self.block_time < next_tick:
+                    return False
+                # Keep the offset, skipping the intervals missed while not ticking
+                self.next_tick[worker_name] = self.block_time + interval - (self.block_time - next_tick) % interval
+
+            self.changed[worker_name] = False
+            return True
+
+    def remove_worker(self, worker_name):
+        with self.lock:
+            self.next_tick.pop(worker_name, None)
+            self.changed.pop(worker_name, None)
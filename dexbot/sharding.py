@@ -0,0 +1,236 @@
+import copy
+import logging
+import multiprocessing
+import os
+import signal
+import sys
+import time
+
+import dexbot.errors as errors
+from dexbot.metrics import METRICS_ADDRESS, start_http_server
+from dexbot.storage import DatabaseWorker, get_backend, set_backend
+from dexbot.ui import configure_logging
+
+log = logging.getLogger(__name__)
+
+# Exit code of a shard without any workers able to run, such a shard is not restarted
+NO_WORKERS_EXIT_CODE = 70
+
+# How often the supervisor checks the shards, seconds
+SUPERVISOR_INTERVAL = 1
+
+# Delay before restarting a crashed shard, doubled for every crash soon after a start up to the maximum, seconds
+RESTART_DELAY = 5
+MAX_RESTART_DELAY = 5 * 60
+
+# A shard running at least this long before crashing is restarted with the initial delay again, seconds
+STABLE_RUN_TIME = 10 * 60
+
+# How long stopped shards get to pause their workers before they are killed, seconds
+STOP_TIMEOUT = 60
+
+
+def shard_workers(workers, processes):
+    """ Split the workers into shards, keeping all workers of an account in the same shard
+
+        Accounts are assigned to the shard with the fewest workers, biggest accounts first. Transactions of an
+        account are then always signed and broadcast from a single process.
+
+        :param dict workers: Worker configs by worker name
+        :param int processes: Maximum number of shards
+        :return list: Worker configs by worker name, one dict per shard
+    """
+    by_account = {}
+    for worker_name, worker in workers.items():
+        by_account.setdefault(worker.get('account'), {})[worker_name] = worker
+
+    shards = [{} for _ in range(min(processes, len(by_account)))]
+    for account_workers in sorted(by_account.values(), key=len, reverse=True):
+        min(shards, key=len).update(account_workers)
+    return shards
+
+
+def kill_process(process):
+    """ Kill a process which doesn't stop when asked to
+
+        multiprocessing.Process.kill() needs Python 3.7. Windows has no SIGKILL, terminate() kills the process there
+        right away.
+    """
+    if hasattr(signal, 'SIGKILL'):
+        try:
+            os.kill(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            # Stopped meanwhile
+            pass
+    else:
+        process.terminate()
+
+
+def run_shard(config, keys, verbose, systemd, metrics_port=None, metrics_address=METRICS_ADDRESS):
+    """ Entry point of a shard process: run the workers of the config with an own BitShares instance
+
+        :param dict config: dexbot config with the shard's workers only
+        :param list keys: Private keys of the shard's accounts
+        :param int verbose: Verbosity as given to the cli
+        :param bool systemd: Running as a systemd service
+        :param int metrics_port: Port to serve the shard's metrics on, None to not serve them
+        :param str metrics_address: Address to serve the shard's metrics on
+    """
+    # Imported here to keep the supervisor process light
+    from bitshares import BitShares
+    from bitshares.instance import set_shared_bitshares_instance
+    from dexbot.worker import WorkerInfrastructure
+
+    configure_logging(verbose, systemd)
+    if metrics_port:
+        start_http_server(metrics_port, metrics_address)
+    # The supervisor migrates the database and runs its maintenance, see ShardSupervisor.run()
+    set_backend(DatabaseWorker(maintain=False))
+
+    bitshares = BitShares(config['node'], keys=keys, num_retries=-1)
+    set_shared_bitshares_instance(bitshares)
+
+    try:
+        worker = WorkerInfrastructure(config, bitshares)
+
+        def kill_workers(signum, frame):
+            worker.do_next_tick(lambda: worker.stop(pause=True))
+
+        signal.signal(signal.SIGTERM, kill_workers)
+        signal.signal(signal.SIGINT, kill_workers)
+        worker.run()
+    except errors.NoWorkersAvailable:
+        sys.exit(NO_WORKERS_EXIT_CODE)
+
+
+class ShardSupervisor:
+    """ Runs the workers in several processes and restarts the processes which crash
+
+        Every shard process gets its own BitShares instance, notification subscriptions and database connections.
+        Workers are sharded by account, see shard_workers().
+
+        The shards share the database file. SQLite lets only one of them write at a time, the others wait for it
+        through the busy timeout (see SQLITE_PRAGMAS). The database is migrated and maintained by the supervisor
+        only, so the shards don't run the same schema changes and maintenance tasks against each other.
+
+        :param dict config: dexbot config
+        :param dict keys: Private keys by account name
+        :param int processes: Number of processes to run
+        :param int verbose: Verbosity as given to the cli
+        :param bool systemd: Running as a systemd service
+        :param int metrics_port: Shards serve their metrics on consecutive ports starting from this one
+        :param str metrics_address: Address the shards serve their metrics on
+    """
+
+    def __init__(self, config, keys, processes, verbose=0, systemd=False, metrics_port=None,
+                 metrics_address=METRICS_ADDRESS):
+        self.verbose = verbose
+        self.systemd = systemd
+        self.metrics_port = metrics_port
+        self.metrics_address = metrics_address
+        # Spawn fresh interpreters, the websocket and database threads of the parent must not be forked
+        self.context = multiprocessing.get_context('spawn')
+        self.stopping = False
+
+        self.shards = []
+        for workers in shard_workers(config['workers'], processes):
+            shard_config = copy.deepcopy(config)
+            shard_config['workers'] = workers
+            accounts = {worker.get('account') for worker in workers.values()}
+            self.shards.append({
+                'config': shard_config,
+                'keys': [keys[account] for account in accounts if account in keys],
+                'process': None,
+                'exitcode': None,
+                'started': 0,
+                'restart_at': 0,
+                'restart_delay': RESTART_DELAY,
+            })
+
+    def start_shard(self, index):
+        shard = self.shards[index]
+        metrics_port = self.metrics_port + index if self.metrics_port else None
+        process = self.context.Process(
+            target=run_shard,
+            args=(shard['config'], shard['keys'], self.verbose, self.systemd, metrics_port, self.metrics_address),
+            name='dexbot-shard-{}'.format(index)
+        )
+        process.start()
+        shard['process'] = process
+        shard['exitcode'] = None
+        shard['started'] = time.time()
+        log.info('Started shard {} (pid {}) with workers {}'.format(
+            index, process.pid, ', '.join(shard['config']['workers'])))
+
+    def run(self):
+        """ Start the shards and supervise them until they are stopped or none of them can run
+        """
+        if not self.shards:
+            raise errors.NoWorkersAvailable()
+
+        # Migrate the database before the shards open it, the maintenance then runs on the database thread of this
+        # process
+        get_backend()
+
+        for index in range(len(self.shards)):
+            self.start_shard(index)
+
+        while not self.stopping:
+            time.sleep(SUPERVISOR_INTERVAL)
+            self.check_shards()
+            if any(shard['process'] for shard in self.shards):
+                continue
+            if all(shard['exitcode'] == 0 for shard in self.shards):
+                log.info('All shards stopped')
+                return
+            log.critical("No shards left running")
+            raise errors.NoWorkersAvailable()
+
+    def check_shards(self):
+        """ Restart the shards which crashed
+
+            Shards which stopped, i.e. exited with code 0, and shards without workers able to run are not restarted.
+        """
+        now = time.time()
+        for index, shard in enumerate(self.shards):
+            process = shard['process']
+            if process is None or process.is_alive() or self.stopping:
+                continue
+
+            if process.exitcode in (0, NO_WORKERS_EXIT_CODE):
+                if process.exitcode:
+                    log.critical('Shard {} has no workers able to run, not restarting it'.format(index))
+                else:
+                    log.info('Shard {} stopped'.format(index))
+                shard['process'] = None
+                shard['exitcode'] = process.exitcode
+                continue
+
+            if not shard['restart_at']:
+                if now - shard['started'] >= STABLE_RUN_TIME:
+                    shard['restart_delay'] = RESTART_DELAY
+                log.error('Shard {} exited with code {}, restarting in {} seconds'.format(
+                    index, process.exitcode, shard['restart_delay']))
+                shard['restart_at'] = now + shard['restart_delay']
+                shard['restart_delay'] = min(shard['restart_delay'] * 2, MAX_RESTART_DELAY)
+            elif now >= shard['restart_at']:
+                shard['restart_at'] = 0
+                self.start_shard(index)
+
+    def stop(self, *args):
+        """ Stop the shards, letting them pause their workers first
+
+            Extra arguments are ignored, so this can be used as a signal handler.
+        """
+        self.stopping = True
+        processes = [shard['process'] for shard in self.shards if shard['process'] and shard['process'].is_alive()]
+        for process in processes:
+            process.terminate()
+
+        deadline = time.time() + STOP_TIMEOUT
+        for process in processes:
+            process.join(max(deadline - time.time(), 0))
+            if process.is_alive():
+                log.warning('Shard {} did not stop in time, killing it'.format(process.name))
+                kill_process(process)
+                process.join()
@@ -0,0 +1,314 @@
+import atexit
+import cProfile
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from dexbot import metrics
+from dexbot.helper import get_user_data_directory, mkdir
+
+log = logging.getLogger(__name__)
+
+# Upper bounds of the latency histogram buckets, seconds. The last bucket takes everything slower
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+# Default time budget of a single event handler call, slower calls are logged, seconds
+HANDLER_BUDGET = 5
+
+# How often the handler statistics are written to the stats file, seconds
+STATS_WRITE_INTERVAL = 60
+
+# Stats files not updated for this long are left by processes which died, seconds
+STATS_STALE_AGE = 5 * STATS_WRITE_INTERVAL
+
+# Handler statistics of the running dexbot processes are written to stats-<pid>.json in this directory
+STATS_DIR = os.path.join(get_user_data_directory(), 'stats')
+
+# Profiles of the handler calls exceeding the budget are dumped here when profiling is enabled
+PROFILES_DIR = os.path.join(get_user_data_directory(), 'profiles')
+
+# Number of RPC calls made by the current thread, see count_rpc_calls()
+_local = threading.local()
+
+
+class RPCCallCounter:
+    """ Proxy of the RPC connection of a BitShares instance, counting the calls made by each thread
+
+        The duration and errors of the calls are recorded in the RPC metrics as well.
+
+        :param rpc: The proxied RPC connection
+    """
+
+    def __init__(self, rpc):
+        object.__setattr__(self, 'rpc', rpc)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.rpc, name)
+        if name.startswith('_') or not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            _local.rpc_calls = getattr(_local, 'rpc_calls', 0) + 1
+            start = time.time()
+            try:
+                return attribute(*args, **kwargs)
+            except Exception:
+                metrics.RPC_ERRORS.inc(method=name)
+                raise
+            finally:
+                metrics.RPC_DURATION.observe(time.time() - start, method=name)
+        return call
+
+    def __setattr__(self, name, value):
+        setattr(self.rpc, name, value)
+
+
+def count_rpc_calls(bitshares):
+    """ Count the RPC calls made through the BitShares instance, see rpc_calls()
+    """
+    if not isinstance(bitshares.rpc, RPCCallCounter):
+        bitshares.rpc = RPCCallCounter(bitshares.rpc)
+
+
+def rpc_calls():
+    """ Returns the number of RPC calls the current thread has made through the counted BitShares instances
+    """
+    return getattr(_local, 'rpc_calls', 0)
+
+
+class CallMeasurement:
+    """ RPC calls made for a measured handler call on other threads, see HandlerStats.measure()
+
+        Coroutine handlers share the event loop thread and run their blocking calls on executor threads, so the
+        calls counted on their own thread don't tell which handler made them. Functions run through run() count
+        their calls for the handler instead.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.rpc_calls = 0
+
+    def run(self, func, *args, **kwargs):
+        """ Call the function, counting the RPC calls it makes on the current thread as calls of the handler
+        """
+        calls = rpc_calls()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            with self.lock:
+                self.rpc_calls += rpc_calls() - calls
+
+
+class LatencyHistogram:
+    """ Histogram of call durations with fixed buckets, see LATENCY_BUCKETS
+    """
+
+    def __init__(self):
+        self.buckets = [0] * len(LATENCY_BUCKETS)
+        self.count = 0
+        self.total = 0
+        self.max = 0
+        self.rpc_calls = 0
+        self.slow = 0
+
+    def observe(self, duration, rpc_calls=0, slow=False):
+        for index, bound in enumerate(LATENCY_BUCKETS):
+            if duration <= bound:
+                self.buckets[index] += 1
+                break
+        self.count += 1
+        self.total += duration
+        self.max = max(self.max, duration)
+        self.rpc_calls += rpc_calls
+        self.slow += slow
+
+    def to_dict(self):
+        return {
+            'buckets': self.buckets,
+            'count': self.count,
+            'total': self.total,
+            'max': self.max,
+            'rpc_calls': self.rpc_calls,
+            'slow': self.slow,
+        }
+
+
+def percentile(histogram, fraction):
+    """ Returns the upper bound of the bucket containing the given fraction of the calls
+
+        :param dict histogram: LatencyHistogram.to_dict() result
+        :param float fraction: e.g. 0.95 for the 95th percentile
+        :return float: Seconds, None if there were no calls
+    """
+    if not histogram['count']:
+        return None
+    needed = fraction * histogram['count']
+    seen = 0
+    for bound, count in zip(LATENCY_BUCKETS, histogram['buckets']):
+        seen += count
+        if seen >= needed:
+            return min(bound, histogram['max'])
+    return histogram['max']
+
+
+class HandlerStats:
+    """ Latency histograms and RPC call counts of the event handlers, by worker and event
+
+        Handler calls taking longer than the budget are logged. With profiling enabled every call is profiled and
+        the profile of a call exceeding the budget is dumped to PROFILES_DIR, to be opened with pstats or snakeviz.
+
+        :param float budget: Time budget of a handler call in seconds
+        :param bool profile: Profile the handler calls
+        :param str path: File the statistics are written to, see save()
+    """
+
+    def __init__(self, budget=HANDLER_BUDGET, profile=False, path=None):
+        self.budget = budget
+        self.profile = profile
+        self.path = path or os.path.join(STATS_DIR, 'stats-{}.json'.format(os.getpid()))
+        self.lock = threading.Lock()
+        self.histograms = {}
+        self.started = time.time()
+        self.saved = 0
+
+    @contextmanager
+    def measure(self, worker_name, event, logger=log, profile=True, count_thread=True):
+        """ Measure a handler call
+
+            Yields a CallMeasurement, the RPC calls of functions run through it are added to the handler's calls.
+
+            :param str worker_name: Name of the worker
+            :param str event: Name of the event handler
+            :param logger: Logger the budget warning goes to
+            :param bool profile: Allow profiling, False for calls sharing the thread with others like coroutines
+            :param bool count_thread: Count the RPC calls made on the current thread, False for calls sharing the
+                                      thread with others like coroutines
+        """
+        profiler = None
+        if self.profile and profile:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another profiler is active already (Python 3.12+ allows only one at a time)
+                profiler = None
+        measurement = CallMeasurement()
+        calls = rpc_calls()
+        start = time.time()
+        try:
+            yield measurement
+        finally:
+            duration = time.time() - start
+            calls = (rpc_calls() - calls if count_thread else 0) + measurement.rpc_calls
+            if profiler:
+                profiler.disable()
+
+            metrics.HANDLER_DURATION.observe(duration, worker=worker_name, event=event)
+            slow = duration > self.budget
+            with self.lock:
+                histogram = self.histograms.setdefault((worker_name, event), LatencyHistogram())
+                histogram.observe(duration, calls, slow)
+
+            if slow:
+                logger.warning('{}() took {:.2f} s, over the budget of {} s, with {} RPC calls'.format(
+                    event, duration, self.budget, calls))
+                if profiler:
+                    self.dump_profile(profiler, worker_name, event)
+
+    @staticmethod
+    def dump_profile(profiler, worker_name, event):
+        mkdir(PROFILES_DIR)
+        filename = os.path.join(PROFILES_DIR, '{}-{}-{}.prof'.format(worker_name, event, int(time.time() * 1000)))
+        profiler.dump_stats(filename)
+        log.info('Profile of the slow {}() of {} written to {}'.format(event, worker_name, filename))
+
+    def to_dict(self):
+        with self.lock:
+            workers = {}
+            for (worker_name, event), histogram in self.histograms.items():
+                workers.setdefault(worker_name, {})[event] = histogram.to_dict()
+        return {
+            'pid': os.getpid(),
+            'started': self.started,
+            'updated': time.time(),
+            'budget': self.budget,
+            'workers': workers,
+        }
+
+    def save(self):
+        """ Write the statistics to the stats file, removed again when the process exits
+        """
+        if not self.saved:
+            atexit.register(self.remove)
+        mkdir(os.path.dirname(self.path))
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as file:
+            json.dump(self.to_dict(), file)
+        os.replace(temp_path, self.path)
+        self.saved = time.time()
+
+    def save_if_due(self):
+        if time.time() - self.saved >= STATS_WRITE_INTERVAL:
+            try:
+                self.save()
+            except OSError:
+                log.exception('Writing the handler statistics failed')
+
+    def remove(self):
+        """ Remove the stats file, e.g. on shutdown
+        """
+        if not self.saved:
+            return
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+        self.saved = 0
+
+
+def pid_alive(pid):
+    """ Returns whether a process with the pid is running, True where this can't be checked
+    """
+    if os.name != 'posix':
+        # os.kill() would terminate the process on Windows
+        return True
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # Running, but owned by another user
+        pass
+    return True
+
+
+def load_stats():
+    """ Returns the statistics written by the running dexbot processes, oldest process first
+
+        Files left by processes which crashed or were killed, i.e. whose process is gone or which weren't updated
+        for STATS_STALE_AGE, are removed.
+    """
+    stats = []
+    now = time.time()
+    for path in glob.glob(os.path.join(STATS_DIR, 'stats-*.json')):
+        try:
+            with open(path) as file:
+                process = json.load(file)
+            alive = pid_alive(int(process['pid'])) and now - process['updated'] <= STATS_STALE_AGE
+        except (OSError, ValueError, KeyError, TypeError):
+            log.debug('Could not read {}'.format(path))
+            continue
+
+        if not alive:
+            log.debug('Removing {} of a process which is gone'.format(path))
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            continue
+        stats.append(process)
+    return sorted(stats, key=lambda process: process['started'])
@@ -1,26 +1,91 @@
 import os
 import json
+import collections
+import time
+import atexit
+import logging
 import threading
 import queue
-import uuid
+from concurrent.futures import Future
 from appdirs import user_data_dir
 
 from . import helper
+from . import metrics
 from dexbot import APP_NAME, AUTHOR
 
-from sqlalchemy import create_engine, Column, String, Integer, Float, Boolean
+from sqlalchemy import create_engine, event, inspect, select, text, Column, String, Integer, Float, Boolean, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm import scoped_session
+from sqlalchemy.pool import QueuePool
+
+log = logging.getLogger(__name__)
 
 Base = declarative_base()
 
 # For dexbot.sqlite file
 storageDatabase = "dexbot.sqlite"
 
+# Group commit settings: maximum number of write tasks applied in one transaction and the maximum time in seconds
+# a write may wait in an open transaction for more writes before it is committed
+GROUP_COMMIT_MAX_BATCH = 500
+GROUP_COMMIT_MAX_LATENCY = 0.05
+
+# SQLite tuning used in WAL mode. cache_size is negative to be read as KiB instead of pages
+SQLITE_PRAGMAS = {
+    'synchronous': 'NORMAL',
+    'cache_size': -16 * 1024,
+    'mmap_size': 64 * 1024 * 1024,
+    'busy_timeout': 30 * 1000,
+}
+
+# Number of pooled read-only connections shared by the threads reading concurrently with the database worker
+READ_POOL_SIZE = 4
+
+# Balance history downsampling tiers as (age, resolution) in seconds: entries older than the age are reduced to
+# one entry per resolution long bucket
+BALANCE_HISTORY_TIERS = [
+    (60 * 60 * 24, 60),
+    (60 * 60 * 24 * 7, 60 * 60),
+    (60 * 60 * 24 * 30, 60 * 60 * 24),
+]
+
+# Balance history entries older than this are deleted, seconds
+BALANCE_HISTORY_RETENTION = 60 * 60 * 24 * 365
+
+# How often the balance history is rolled up, seconds
+BALANCE_HISTORY_ROLLUP_INTERVAL = 60 * 60
+
+# How long the idle database worker waits before checking for due maintenance, seconds
+MAINTENANCE_CHECK_INTERVAL = 60
+
+# Deleted orders older than this are moved from the orders table to the orders archive, seconds
+ORDER_ARCHIVE_AGE = 60 * 60 * 24 * 7
+
+# How often deleted orders are archived, seconds
+ORDER_ARCHIVE_INTERVAL = 60 * 60
+
+# Maximum number of order ids bound to a single IN (...) clause, SQLite limits the number of bound parameters
+BULK_CHUNK_SIZE = 500
+
+# Indexes created by earlier versions and dropped by migrate(), by table name
+OBSOLETE_INDEXES = {
+    # Duplicated ix_orders_worker_order_id, the query planner never used it
+    'orders': ['ix_orders_active'],
+}
+
+# Typed order columns stored next to the optional raw order blob
+ORDER_COLUMNS = ('side', 'price', 'base_amount', 'base_asset', 'quote_amount', 'quote_asset')
+
+# Lightweight order record, read from the typed columns without parsing the raw order
+OrderRecord = collections.namedtuple('OrderRecord', ('order_id', 'worker') + ORDER_COLUMNS + ('deleted',))
+
 
 class Config(Base):
     __tablename__ = 'config'
+    __table_args__ = (
+        Index('ix_config_category_key', 'category', 'key', unique=True),
+    )
 
     id = Column(Integer, primary_key=True)
     category = Column(String)
@@ -35,24 +100,63 @@ class Config(Base):
 
 class Orders(Base):
     __tablename__ = 'orders'
+    __table_args__ = (
+        Index('ix_orders_order_id', 'order_id', unique=True),
+        Index('ix_orders_worker_order_id', 'worker', 'order_id'),
+        Index('ix_orders_worker_side_price', 'worker', 'side', 'price'),
+    )
 
     id = Column(Integer, primary_key=True)
     worker = Column(String)
     order_id = Column(String)
-    order = Column(String)
+    order = Column(String, nullable=True)
     userdata = Column(String)
     deleted = Column(Boolean)
-
-    def __init__(self, worker, order_id, order, userdata=''):
+    side = Column(String)
+    price = Column(Float)
+    base_amount = Column(Float)
+    base_asset = Column(String)
+    quote_amount = Column(Float)
+    quote_asset = Column(String)
+    deleted_at = Column(Integer)
+
+    def __init__(self, worker, order_id, order, userdata='', **columns):
         self.worker = worker
         self.order_id = order_id
         self.order = order
         self.userdata = userdata
         self.deleted = False
+        for name in ORDER_COLUMNS:
+            setattr(self, name, columns.get(name))
+
+
+class OrdersArchive(Base):
+    """ Deleted orders moved out of the orders table, see DatabaseWorker._archive_orders()
+    """
+    __tablename__ = 'orders_archive'
+    __table_args__ = (
+        Index('ix_orders_archive_worker_order_id', 'worker', 'order_id'),
+    )
+
+    id = Column(Integer, primary_key=True)
+    worker = Column(String)
+    order_id = Column(String)
+    order = Column(String, nullable=True)
+    userdata = Column(String)
+    side = Column(String)
+    price = Column(Float)
+    base_amount = Column(Float)
+    base_asset = Column(String)
+    quote_amount = Column(Float)
+    quote_asset = Column(String)
+    deleted_at = Column(Integer)
 
 
 class Balances(Base):
     __tablename__ = 'balances'
+    __table_args__ = (
+        Index('ix_balances_history', 'account', 'worker', 'base_symbol', 'quote_symbol', 'timestamp'),
+    )
 
     id = Column(Integer, primary_key=True)
     account = Column(String)
@@ -63,6 +167,8 @@ class Balances(Base):
     quote_symbol = Column(String)
     center_price = Column(Float)
     timestamp = Column(Integer)
+    # Size of the time bucket in seconds this entry represents, 0 for raw entries
+    resolution = Column(Integer, default=0, server_default='0')
 
     def __init__(self, account, worker, base_total, base_symbol, quote_total, quote_symbol, center_price, timestamp):
         self.account = account
@@ -75,65 +181,264 @@ class Balances(Base):
         self.timestamp = timestamp
 
 
+def chunks(items, size):
+    """ Split a list into lists of at most size items
+    """
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def use_savepoints(engine):
+    """ Let the engine's sessions roll back to savepoints
+
+        pysqlite only begins a transaction in front of data changing statements and a SAVEPOINT outside a transaction
+        starts one itself, which is then committed when the savepoint is released. Transactions are begun explicitly
+        instead, the SQLAlchemy recipe for SQLite savepoints.
+    """
+    def connect(dbapi_connection, connection_record):
+        dbapi_connection.isolation_level = None
+
+    def begin(connection):
+        connection.execute('BEGIN')
+
+    event.listen(engine, 'connect', connect)
+    event.listen(engine, 'begin', begin)
+
+
+def set_pragmas(dbapi_connection, pragmas):
+    """ Apply PRAGMA statements to a raw SQLite connection
+    """
+    cursor = dbapi_connection.cursor()
+    for name, value in pragmas.items():
+        cursor.execute('PRAGMA {} = {}'.format(name, value))
+    cursor.close()
+
+
+def order_columns(order):
+    """ Get the typed columns of an order as the order itself has them
+
+        Base is the asset the order sells and the price is base per quote. The side is not known without a market,
+        see StrategyBase.order_columns(). Orders which are not shaped like bitshares orders only get empty columns.
+
+        :param dict | order: dict or Order object
+        :return dict: Column values by column name
+    """
+    try:
+        base_amount = float(order['base']['amount'])
+        quote_amount = float(order['quote']['amount'])
+        columns = {
+            'side': None,
+            'base_amount': base_amount,
+            'base_asset': order['base']['asset']['id'],
+            'quote_amount': quote_amount,
+            'quote_asset': order['quote']['asset']['id'],
+        }
+    except (KeyError, TypeError, ValueError):
+        return dict.fromkeys(ORDER_COLUMNS)
+
+    try:
+        columns['price'] = float(order['price'])
+    except (KeyError, TypeError, ValueError):
+        columns['price'] = base_amount / quote_amount if quote_amount else None
+    return columns
+
+
+def migrate(engine):
+    """ Upgrade an existing database in place to the current schema
+
+        create_all() only creates missing tables, so columns and indexes added to the models later on are created
+        here. Duplicate rows which would violate a new unique index are removed first, keeping the newest one.
+        Indexes listed in OBSOLETE_INDEXES are dropped.
+    """
+    inspector = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name in existing_columns:
+                continue
+
+            log.info('Adding column {} to table {}'.format(column.name, table.name))
+            definition = '{} {}'.format(column.name, column.type.compile(engine.dialect))
+            if column.server_default is not None:
+                definition += " DEFAULT '{}'".format(column.server_default.arg)
+            with engine.begin() as connection:
+                connection.execute(text('ALTER TABLE {} ADD COLUMN {}'.format(table.name, definition)))
+
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index_name in OBSOLETE_INDEXES.get(table.name, ()):
+            if index_name in existing_indexes:
+                log.info('Dropping index {} of table {}'.format(index_name, table.name))
+                with engine.begin() as connection:
+                    connection.execute(text('DROP INDEX {}'.format(index_name)))
+
+        for index in table.indexes:
+            if index.name in existing_indexes:
+                continue
+
+            log.info('Creating index {} on table {}'.format(index.name, table.name))
+            with engine.begin() as connection:
+                if index.unique:
+                    columns = ', '.join(column.name for column in index.columns)
+                    connection.execute(text(
+                        'DELETE FROM {table} WHERE id NOT IN '
+                        '(SELECT MAX(id) FROM {table} GROUP BY {columns})'.format(table=table.name, columns=columns)
+                    ))
+                index.create(connection)
+
+
 class Storage(dict):
     """ Storage class
 
+        Key/value pairs are cached in memory per category: the first access loads the whole category from the
+        database and later reads are served from the cache. Writes update the cache and are persisted through the
+        database worker (write-through). When a write fails the category is dropped from the cache, so the cache
+        doesn't keep values the database doesn't have.
+
         :param string category: The category to distinguish
                                 different storage namespaces
     """
 
+    # Keep the full json of saved orders next to the typed order columns
+    store_raw_orders = True
+
+    # Serialized values by category and key, shared by all instances using the same category
+    _cache = {}
+    _cache_lock = threading.RLock()
+
     def __init__(self, category):
         self.category = category
 
+    def _cached_items(self):
+        """ Returns the cached key/value pairs of the category, loading them from the database on first use
+        """
+        with Storage._cache_lock:
+            items = Storage._cache.get(self.category)
+            if items is None:
+                items = dict(get_backend().get_items(self.category))
+                Storage._cache[self.category] = items
+            return items
+
+    def _drop_cache_on_failure(self, future):
+        """ Drop the cached category if the write fails, it is loaded from the database again on next use
+
+            :param concurrent.futures.Future | future: Future of the write, None if it is written already
+        """
+        if future is None:
+            return
+
+        category = self.category
+
+        def done(future):
+            if future.cancelled() or future.exception() is not None:
+                # Runs on the database thread, which must not wait for _cache_lock: its holder may be waiting for
+                # the database to load a category
+                Storage._cache.pop(category, None)
+        future.add_done_callback(done)
+
     def __setitem__(self, key, value):
-        db_worker.set_item(self.category, key, value)
+        with Storage._cache_lock:
+            self._cached_items()[key] = json.dumps(value)
+            self._drop_cache_on_failure(get_backend().set_item(self.category, key, value))
 
     def __getitem__(self, key):
-        return db_worker.get_item(self.category, key)
+        value = self._cached_items().get(key)
+        if value is None:
+            return None
+        return json.loads(value)
 
     def __delitem__(self, key):
-        db_worker.del_item(self.category, key)
+        with Storage._cache_lock:
+            self._cached_items().pop(key, None)
+            self._drop_cache_on_failure(get_backend().del_item(self.category, key))
 
     def __contains__(self, key):
-        return db_worker.contains(self.category, key)
+        return key in self._cached_items()
 
     def items(self):
-        return db_worker.get_items(self.category)
+        with Storage._cache_lock:
+            return list(self._cached_items().items())
 
     def clear(self):
-        db_worker.clear(self.category)
+        with Storage._cache_lock:
+            Storage._cache[self.category] = {}
+            get_backend().clear(self.category)
 
     def update_order(self, order_id, user_data):
-        return db_worker.update_order(order_id, user_data)
+        return get_backend().update_order(order_id, user_data)
+
+    def order_columns(self, order):
+        """ Get the typed columns stored for an order
+
+            Strategies override this to store the side and the price in their market's terms.
+
+            :param dict | order: dict or Order object
+            :return dict: Column values by column name
+        """
+        return order_columns(order)
+
+    def _order_row(self, order):
+        row = self.order_columns(order)
+        row['order'] = json.dumps(order) if self.store_raw_orders else None
+        return row
 
     def save_order(self, order):
         """ Save the order to the database
         """
         order_id = order['id']
-        db_worker.save_order(self.category, order_id, order)
+        get_backend().save_order(self.category, order_id, self._order_row(order))
 
     def remove_order(self, order):
         """ Removes an order from the database
         """
         order_id = order['id']
-        db_worker.remove_order(self.category, order_id)
+        get_backend().remove_order(self.category, order_id)
+
+    def save_orders(self, orders):
+        """ Save multiple orders to the database in one go
+        """
+        get_backend().save_orders(self.category, {order['id']: self._order_row(order) for order in orders})
+
+    def remove_orders(self, orders):
+        """ Removes multiple orders from the database in one go
+        """
+        get_backend().remove_orders(self.category, [order['id'] for order in orders])
 
     def clear_orders(self):
         """ Removes all worker's orders from the database
         """
-        db_worker.clear_orders(self.category)
+        get_backend().clear_orders(self.category)
 
-    def fetch_orders(self, worker=None, raw=False):
+    def fetch_orders(self, worker=None, raw=False, records=False, include_deleted=False):
         """ Get all the orders (or just specific worker's orders) from the database
+
+            :param str | worker: Name of the worker, defaults to this storage's category
+            :param bool | raw: Return the Orders rows
+            :param bool | records: Return OrderRecord tuples read from the typed columns, the raw orders are not parsed
+            :param bool | include_deleted: Return removed orders which are not archived yet as well
+            :return dict: Orders by order id, None if there are none
         """
         if not worker:
             worker = self.category
-        return db_worker.fetch_orders(worker, raw)
+        if records:
+            return get_backend().fetch_order_records(worker, include_deleted)
+        return get_backend().fetch_orders(worker, raw, include_deleted)
+
+    def fetch_orders_by_price(self, side, min_price=None, max_price=None, worker=None):
+        """ Get the worker's open orders of one side within a price range, lowest price first
+
+            :param str | side: 'buy' or 'sell'
+            :param float | min_price: Lowest price to include, no limit if None
+            :param float | max_price: Highest price to include, no limit if None
+            :param str | worker: Name of the worker, defaults to this storage's category
+            :return list: OrderRecord tuples
+        """
+        if not worker:
+            worker = self.category
+        return get_backend().fetch_orders_by_price(worker, side, min_price, max_price)
 
     @staticmethod
     def clear_worker_data(worker):
-        db_worker.clear_orders(worker)
-        db_worker.clear(worker)
+        get_backend().clear_orders(worker)
+        Storage(worker).clear()
 
     @staticmethod
     def store_balance_entry(account, worker, base_total, base_symbol, quote_total, quote_symbol,
@@ -141,76 +446,347 @@ class Storage(dict):
         balance = Balances(account, worker, base_total, base_symbol,
                            quote_total, quote_symbol, center_price, timestamp)
         # Save balance to db
-        db_worker.save_balance(balance)
+        get_backend().save_balance(balance)
 
     @staticmethod
     def fetch_order(order_id):
-        return db_worker.fetch_order(order_id)
+        return get_backend().fetch_order(order_id)
 
     @staticmethod
     def get_balance_history(account, worker, timestamp, base_asset, quote_asset):
-        return db_worker.get_balance(account, worker, timestamp, base_asset, quote_asset)
+        return get_backend().get_balance(account, worker, timestamp, base_asset, quote_asset)
 
     @staticmethod
     def get_recent_balance_entry(account, worker, base_asset, quote_asset):
-        return db_worker.get_recent_balance_entry(account, worker, base_asset, quote_asset)
+        return get_backend().get_recent_balance_entry(account, worker, base_asset, quote_asset)
+
+
+class StorageBackend:
+    """ Interface of the storage backends used by Storage
+
+        Key/value items are stored as json per category, orders are stored as the column values of the orders table
+        (see Storage._order_row()) and balance history entries as Balances objects. Order and balance queries return
+        Orders and Balances objects, whether they are attached to a database session or not.
+
+        Writes may be stored later on. They return a concurrent.futures.Future resolved once the write is stored, or
+        with the exception it failed with, or None if the write is stored already.
+    """
+
+    def flush(self):
+        """ Block until all writes are stored
+        """
+        pass
+
+    def set_item(self, category, key, value):
+        raise NotImplementedError
+
+    def get_item(self, category, key):
+        raise NotImplementedError
+
+    def del_item(self, category, key):
+        raise NotImplementedError
+
+    def contains(self, category, key):
+        raise NotImplementedError
+
+    def get_items(self, category):
+        """ :return list: (key, json value) pairs of the category
+        """
+        raise NotImplementedError
+
+    def clear(self, category):
+        raise NotImplementedError
+
+    def update_order(self, order_id, user_data):
+        raise NotImplementedError
+
+    def save_order(self, worker, order_id, order):
+        return self.save_orders(worker, {order_id: order})
+
+    def save_orders(self, worker, orders):
+        raise NotImplementedError
+
+    def remove_order(self, worker, order_id):
+        return self.remove_orders(worker, [order_id])
+
+    def remove_orders(self, worker, order_ids):
+        raise NotImplementedError
+
+    def clear_orders(self, worker):
+        raise NotImplementedError
+
+    def fetch_order(self, order_id):
+        raise NotImplementedError
+
+    def fetch_orders(self, category, raw=False, include_deleted=False):
+        raise NotImplementedError
+
+    def fetch_order_records(self, worker, include_deleted=False):
+        raise NotImplementedError
+
+    def fetch_orders_by_price(self, worker, side, min_price=None, max_price=None):
+        raise NotImplementedError
+
+    def save_balance(self, balance):
+        raise NotImplementedError
+
+    def get_balance(self, account, worker, timestamp, base_asset, quote_asset):
+        raise NotImplementedError
+
+    def get_recent_balance_entry(self, account, worker, base_asset, quote_asset):
+        raise NotImplementedError
 
 
-class DatabaseWorker(threading.Thread):
+class DatabaseWorker(StorageBackend, threading.Thread):
     """ Thread safe database worker
+
+        Writes are group-committed: the worker drains all queued write tasks, applies them in one transaction and
+        commits once, so a burst of writes costs a single disk sync instead of one per row. Every write is applied
+        within its own savepoint, so a failing write is rolled back alone and the others of the batch are committed.
+
+        In WAL mode the history reads (see :meth:`read`) don't go through the task queue at all: they run on the
+        calling thread using a pool of read-only connections, so they don't wait behind queued writes while all
+        writes are committed. Writes are still serialized through the worker thread.
+
+        :param bool group_commit: Commit writes in batches, False commits after every single write
+        :param int max_batch: Maximum number of writes applied in one transaction
+        :param float max_latency: Maximum time in seconds a write waits in an open transaction for more writes
+        :param bool wal: Use SQLite write-ahead log with tuned pragmas and allow concurrent reads
+        :param int read_pool_size: Number of pooled read-only connections in WAL mode
+        :param int order_archive_age: Age in seconds after which deleted orders are archived
+        :param str path: Path of the SQLite database file
+        :param bool maintain: Migrate the database on start and run the periodic maintenance. Processes sharing the
+                              database file with a process doing this pass False, see ShardSupervisor
     """
 
-    def __init__(self):
+    def __init__(self, group_commit=True, max_batch=GROUP_COMMIT_MAX_BATCH, max_latency=GROUP_COMMIT_MAX_LATENCY,
+                 wal=True, read_pool_size=READ_POOL_SIZE, order_archive_age=ORDER_ARCHIVE_AGE, path=None,
+                 maintain=True):
         super().__init__()
 
+        if path is None:
+            path = sqlDataBaseFile
+
         # Obtain engine and session
-        engine = create_engine('sqlite:///%s' % sqlDataBaseFile, echo=False)
+        engine = create_engine('sqlite:///%s' % path, echo=False)
+        use_savepoints(engine)
+        if wal:
+            write_pragmas = dict(SQLITE_PRAGMAS, journal_mode='WAL')
+            event.listen(engine, 'connect', lambda connection, record: set_pragmas(connection, write_pragmas))
         Session = sessionmaker(bind=engine)
         self.session = scoped_session(Session)
 
-        Base.metadata.create_all(engine)
-        self.session.commit()
+        if maintain:
+            Base.metadata.create_all(engine)
+            migrate(engine)
+            self.session.commit()
+
+        # Thread local sessions for concurrent reads
+        self.read_session = None
+        if wal:
+            read_engine = create_engine(
+                'sqlite:///%s' % path,
+                echo=False,
+                poolclass=QueuePool,
+                pool_size=read_pool_size,
+                connect_args={'check_same_thread': False}
+            )
+            read_pragmas = dict(SQLITE_PRAGMAS, query_only='ON')
+            event.listen(read_engine, 'connect', lambda connection, record: set_pragmas(connection, read_pragmas))
+            self.read_session = scoped_session(sessionmaker(bind=read_engine))
 
         self.task_queue = queue.Queue()
-        self.results = {}
+        # Number of write tasks queued and number of them done, i.e. committed or failed. Direct reads wait for the
+        # writes in between, see read()
+        self.write_count_lock = threading.Lock()
+        self.writes_queued = 0
+        self.writes_done = 0
+        # Futures of the writes applied to the open transaction, resolved when it is committed
+        self.uncommitted = []
+        metrics.DATABASE_QUEUE_SIZE.set_callback(lambda: {(): self.task_queue.qsize()})
+
+        # Group commit settings
+        if group_commit:
+            self.max_batch = max_batch
+            self.max_latency = max_latency
+        else:
+            self.max_batch = 1
+            self.max_latency = 0
+
+        # Periodic maintenance tasks as (interval, function), run on the worker thread when due
+        self.maintenance_tasks = []
+        if maintain:
+            self.maintenance_tasks = [
+                (BALANCE_HISTORY_ROLLUP_INTERVAL, self._rollup_balances),
+                (ORDER_ARCHIVE_INTERVAL, self._archive_orders),
+            ]
+        self.order_archive_age = order_archive_age
+        self.maintenance_runs = {}
 
-        self.lock = threading.Lock()
-        self.event = threading.Event()
         self.daemon = True
         self.start()
 
+        # Daemon thread is killed on exit, make sure queued writes reach the disk before that
+        atexit.register(self.flush)
+
     def run(self):
-        for func, args, token in iter(self.task_queue.get, None):
-            if token is not None:
-                args = args+(token,)
+        running = True
+        while running:
+            self._run_maintenance()
+            try:
+                task = self.task_queue.get(timeout=MAINTENANCE_CHECK_INTERVAL)
+            except queue.Empty:
+                continue
+
+            processed_writes = 0
+            deadline = time.time() + self.max_latency
+
+            while True:
+                if task is None:
+                    running = False
+                    break
+
+                func, args, future, write = task
+                if write:
+                    processed_writes += 1
+                    self._apply_write(func, args, future)
+                else:
+                    self._apply_read(func, args, future)
+
+                if len(self.uncommitted) >= self.max_batch:
+                    break
+
+                # Keep collecting writes into the open transaction until the queue is drained or the latency is over
+                try:
+                    timeout = deadline - time.time()
+                    if self.uncommitted and timeout > 0:
+                        task = self.task_queue.get(timeout=timeout)
+                    else:
+                        task = self.task_queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            if self.uncommitted:
+                self._commit()
+            with self.write_count_lock:
+                self.writes_done += processed_writes
+
+    def _run_maintenance(self):
+        """ Run the periodic maintenance tasks which are due
+        """
+        now = time.time()
+        for interval, func in self.maintenance_tasks:
+            if now - self.maintenance_runs.get(func.__name__, 0) < interval:
+                continue
+
+            self.maintenance_runs[func.__name__] = now
+            try:
+                func()
+                self.session.commit()
+            except Exception:
+                log.exception('Database maintenance {} failed'.format(func.__name__))
+                self.session.rollback()
+
+    def _apply_write(self, func, args, future):
+        """ Apply single write task within a savepoint, without committing it
+
+            A failing write is rolled back to the savepoint and its future gets the exception, the other writes of
+            the open transaction are kept.
+        """
+        if not future.set_running_or_notify_cancel():
+            return
+
+        savepoint = self.session.begin_nested()
+        try:
             func(*args)
+            savepoint.commit()
+        except Exception as e:
+            log.exception('Database write {} failed'.format(func.__name__))
+            savepoint.rollback()
+            future.set_exception(e)
+            return
+        self.uncommitted.append(future)
 
-    def _get_result(self, token):
-        while True:
-            with self.lock:
-                if token in self.results:
-                    return_value = self.results[token]
-                    del self.results[token]
-                    return return_value
-                else:
-                    self.event.clear()
-            self.event.wait()
+    @staticmethod
+    def _apply_read(func, args, future):
+        """ Run a task and hand its result or exception over to the waiting caller
+        """
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(func(*args))
+        except Exception as e:
+            future.set_exception(e)
+
+    def _commit(self):
+        futures, self.uncommitted = self.uncommitted, []
+        try:
+            self.session.commit()
+        except Exception as e:
+            log.exception('Database commit failed, rolling back')
+            self.session.rollback()
+            for future in futures:
+                future.set_exception(e)
+            return
+        for future in futures:
+            future.set_result(None)
 
-    def _set_result(self, token, result):
-        with self.lock:
-            self.results[token] = result
-            self.event.set()
+    def flush(self):
+        """ Block until all queued writes are committed
+        """
+        if self.is_alive():
+            self.execute(self._flush)
+
+    def _flush(self):
+        self._commit()
+        return True
+
+    def submit(self, func, *args):
+        """ Queue a task whose result is needed by the caller
+
+            :return: concurrent.futures.Future: Future of this call only, resolved by the database thread
+        """
+        future = Future()
+        self.task_queue.put((func, args, future, False))
+        return future
 
     def execute(self, func, *args):
-        token = str(uuid.uuid4)
-        self.task_queue.put((func, args, token))
-        return self._get_result(token)
+        return self.submit(func, *args).result()
+
+    def read(self, func, *args):
+        """ Run a read-only task, passing the session to use as the first argument
+
+            With concurrent reads enabled the task runs on the calling thread with a pooled read-only connection,
+            otherwise it is queued like any other task. Either way the task sees all writes queued before it: writes
+            still queued or waiting in the open transaction are committed first.
+        """
+        if self.read_session is None:
+            return self.execute(func, self.session, *args)
+
+        with self.write_count_lock:
+            writes_pending = self.writes_done < self.writes_queued
+        if writes_pending:
+            self.flush()
+
+        try:
+            return func(self.read_session, *args)
+        finally:
+            self.read_session.remove()
 
     def execute_noreturn(self, func, *args):
-        self.task_queue.put((func, args, None))
+        """ Queue a write task, the caller doesn't wait for it
+
+            :return: concurrent.futures.Future: Resolved when the write is committed, or with the exception it failed
+                with
+        """
+        future = Future()
+        with self.write_count_lock:
+            self.writes_queued += 1
+        self.task_queue.put((func, args, future, True))
+        return future
 
     def set_item(self, category, key, value):
-        self.execute_noreturn(self._set_item, category, key, value)
+        return self.execute_noreturn(self._set_item, category, key, value)
 
     def _set_item(self, category, key, value):
         value = json.dumps(value)
@@ -223,13 +799,13 @@ class DatabaseWorker(threading.Thread):
         else:
             e = Config(category, key, value)
             self.session.add(e)
-        self.session.commit()
 
     def get_item(self, category, key):
-        return self.execute(self._get_item, category, key)
+        return self.read(self._get_item, category, key)
 
-    def _get_item(self, category, key, token):
-        e = self.session.query(Config).filter_by(
+    @staticmethod
+    def _get_item(session, category, key):
+        e = session.query(Config).filter_by(
             category=category,
             key=key
         ).first()
@@ -237,10 +813,10 @@ class DatabaseWorker(threading.Thread):
             result = None
         else:
             result = json.loads(e.value)
-        self._set_result(token, result)
+        return result
 
     def del_item(self, category, key):
-        self.execute_noreturn(self._del_item, category, key)
+        return self.execute_noreturn(self._del_item, category, key)
 
     def _del_item(self, category, key):
         e = self.session.query(Config).filter_by(
@@ -248,30 +824,29 @@ class DatabaseWorker(threading.Thread):
             key=key
         ).first()
         self.session.delete(e)
-        self.session.commit()
 
     def contains(self, category, key):
         return self.execute(self._contains, category, key)
 
-    def _contains(self, category, key, token):
+    def _contains(self, category, key):
         e = self.session.query(Config).filter_by(
             category=category,
             key=key
         ).first()
-        self._set_result(token, bool(e))
+        return bool(e)
 
     def get_items(self, category):
         return self.execute(self._get_items, category)
 
-    def _get_items(self, category, token):
+    def _get_items(self, category):
         es = self.session.query(Config).filter_by(
             category=category
         ).all()
         result = [(e.key, e.value) for e in es]
-        self._set_result(token, result)
+        return result
 
     def clear(self, category):
-        self.execute_noreturn(self._clear, category)
+        return self.execute_noreturn(self._clear, category)
 
     def _clear(self, category):
         rows = self.session.query(Config).filter_by(
@@ -279,46 +854,53 @@ class DatabaseWorker(threading.Thread):
         )
         for row in rows:
             self.session.delete(row)
-            self.session.commit()
-
-    def update_order(self,order_id, user_data):
-        e = self.session.query(Orders).filter_by(
-            order_id=order_id
-        ).update({ 'userdata': user_data})
 
-        self.session.commit()
+    def update_order(self, order_id, user_data):
+        self.execute_noreturn(self._update_order, order_id, user_data)
         return True
 
-    def save_order(self, worker, order_id, order):
-        self.execute_noreturn(self._save_order, worker, order_id, order)
-
-    def _save_order(self, worker, order_id, order):
-        value = json.dumps(order)
-        e = self.session.query(Orders).filter_by(
+    def _update_order(self, order_id, user_data):
+        self.session.query(Orders).filter_by(
             order_id=order_id
-        ).first()
-        if e:
-            e.value = value
-        else:
-            e = Orders(worker, order_id, value)
-            self.session.add(e)
-        self.session.commit()
+        ).update({'userdata': user_data})
 
-    def remove_order(self, worker, order_id):
-        self.execute_noreturn(self._remove_order, worker, order_id)
+    def save_orders(self, worker, orders):
+        return self.execute_noreturn(self._save_orders, worker, orders)
 
-    def _remove_order(self, worker, order_id):
-        e = self.session.query(Orders).filter_by(
-            worker=worker,
-            order_id=order_id
-        ).first()
+    def _save_orders(self, worker, orders):
+        """ Insert new orders and update existing ones with bulk statements
+
+            :param str worker: Name of the worker
+            :param dict orders: Column values of the orders by order id
+        """
+        order_ids = list(orders)
+        existing = {}
+        for chunk in chunks(order_ids, BULK_CHUNK_SIZE):
+            rows = self.session.query(Orders.id, Orders.order_id).filter(Orders.order_id.in_(chunk))
+            existing.update((order_id, row_id) for row_id, order_id in rows)
+
+        self.session.bulk_update_mappings(Orders, [
+            dict(orders[order_id], id=existing[order_id])
+            for order_id in order_ids if order_id in existing
+        ])
+        self.session.bulk_insert_mappings(Orders, [
+            dict(orders[order_id], worker=worker, order_id=order_id, userdata='', deleted=False)
+            for order_id in order_ids if order_id not in existing
+        ])
+
+    def remove_orders(self, worker, order_ids):
+        return self.execute_noreturn(self._remove_orders, worker, order_ids)
+
+    def _remove_orders(self, worker, order_ids):
         # non-destructive remove
-        e.deleted = True
-        #self.session.delete(e)
-        self.session.commit()
+        for chunk in chunks(order_ids, BULK_CHUNK_SIZE):
+            self.session.query(Orders).filter(
+                Orders.worker == worker,
+                Orders.order_id.in_(chunk)
+            ).update({'deleted': True, 'deleted_at': int(time.time())}, synchronize_session=False)
 
     def clear_orders(self, worker):
-        self.execute_noreturn(self._clear_orders, worker)
+        return self.execute_noreturn(self._clear_orders, worker)
 
     def _clear_orders(self, worker):
         rows = self.session.query(Orders).filter_by(
@@ -326,83 +908,330 @@ class DatabaseWorker(threading.Thread):
         )
         for row in rows:
             self.session.delete(row)
-            self.session.commit()
 
     def fetch_order(self, order_id):
         return self.execute(self._fetch_order, order_id)
 
-    def _fetch_order(self, order_id, token):
+    def _fetch_order(self, order_id):
         """ Get first item that has bigger time as given timestamp and matches account and worker name
         """
         result = self.session.query(Orders).filter_by(
             order_id=order_id
         ).first()
 
-        self._set_result(token, result)
+        return result
+
+    def fetch_orders(self, category, raw=False, include_deleted=False):
+        return self.execute(self._fetch_orders, category, raw, include_deleted)
 
-    def fetch_orders(self, category, raw=False):
-        return self.execute(self._fetch_orders, category, raw)
+    @staticmethod
+    def _filter_active(query, include_deleted):
+        if include_deleted:
+            return query
+        return query.filter(Orders.deleted == False)  # noqa: E712
 
-    def _fetch_orders(self, worker, raw, token):
-        results = self.session.query(Orders).filter_by(
+    def _fetch_orders(self, worker, raw, include_deleted):
+        query = self.session.query(Orders).filter_by(
             worker=worker,
-        ).all()
+        )
+        results = self._filter_active(query, include_deleted).all()
 
         if raw:
-            self._set_result(token, results)
-            return
+            return results
 
         if not results:
             result = None
         else:
             result = {}
             for row in results:
-                result[row.order_id] = json.loads(row.order)
-        self._set_result(token, result)
+                if row.order is None:
+                    # Saved without the raw order, build it from the typed columns
+                    result[row.order_id] = dict(self._order_record(row)._asdict(), id=row.order_id)
+                else:
+                    result[row.order_id] = json.loads(row.order)
+        return result
+
+    @staticmethod
+    def _order_record(row):
+        return OrderRecord(*(getattr(row, field) for field in OrderRecord._fields))
+
+    def _order_record_query(self):
+        return self.session.query(*(getattr(Orders, field) for field in OrderRecord._fields))
+
+    def fetch_order_records(self, worker, include_deleted=False):
+        return self.execute(self._fetch_order_records, worker, include_deleted)
+
+    def _fetch_order_records(self, worker, include_deleted):
+        query = self._order_record_query().filter(Orders.worker == worker)
+        rows = self._filter_active(query, include_deleted)
+        result = {row.order_id: self._order_record(row) for row in rows}
+        return result or None
+
+    def fetch_orders_by_price(self, worker, side, min_price=None, max_price=None):
+        return self.execute(self._fetch_orders_by_price, worker, side, min_price, max_price)
+
+    def _fetch_orders_by_price(self, worker, side, min_price, max_price):
+        query = self._filter_active(self._order_record_query(), False).filter(
+            Orders.worker == worker,
+            Orders.side == side,
+        )
+        if min_price is not None:
+            query = query.filter(Orders.price >= min_price)
+        if max_price is not None:
+            query = query.filter(Orders.price <= max_price)
+        return [self._order_record(row) for row in query.order_by(Orders.price)]
 
     def save_balance(self, balance):
-        self.execute_noreturn(self._save_balance, balance)
+        return self.execute_noreturn(self._save_balance, balance)
 
     def _save_balance(self, balance):
         self.session.add(balance)
-        self.session.commit()
 
     def get_balance(self, account, worker, timestamp, base_asset, quote_asset):
-        return self.execute(self._get_balance, account, worker, timestamp, base_asset, quote_asset)
+        return self.read(self._get_balance, account, worker, timestamp, base_asset, quote_asset)
 
-    def _get_balance(self, account, worker, timestamp, base_asset, quote_asset, token):
+    @staticmethod
+    def _get_balance(session, account, worker, timestamp, base_asset, quote_asset):
         """ Get first item that has bigger time as given timestamp and matches account and worker name
         """
-        result = self.session.query(Balances).filter(
+        result = session.query(Balances).filter(
             Balances.account == account,
             Balances.worker == worker,
             Balances.base_symbol == base_asset,
             Balances.quote_symbol == quote_asset,
             Balances.timestamp > timestamp
-        ).first()
+        ).order_by(Balances.timestamp).first()
 
-        self._set_result(token, result)
+        return result
 
     def get_recent_balance_entry(self, account, worker, base_asset, quote_asset):
-        return self.execute(self._get_recent_balance_entry, account, worker, base_asset, quote_asset)
+        return self.read(self._get_recent_balance_entry, account, worker, base_asset, quote_asset)
 
-    def _get_recent_balance_entry(self, account, worker, base_asset, quote_asset, token):
+    @staticmethod
+    def _get_recent_balance_entry(session, account, worker, base_asset, quote_asset):
         """ Get most recent balance history item that matches account and worker name
         """
-        result = self.session.query(Balances).filter(
+        result = session.query(Balances).filter(
             Balances.account == account,
             Balances.worker == worker,
             Balances.base_symbol == base_asset,
             Balances.quote_symbol == quote_asset,
-        ).order_by(Balances.id.desc()).first()
+        ).order_by(Balances.timestamp.desc(), Balances.id.desc()).first()
+
+        return result
+
+    def _rollup_balances(self):
+        """ Downsample old balance history and enforce the retention period
+
+            Within each tier only the first entry of every bucket is kept, so the entry returned for "first entry after
+            a timestamp" stays as close as the tier resolution allows while the table stops growing.
+        """
+        now = time.time()
+        for age, resolution in BALANCE_HISTORY_TIERS:
+            params = {'cutoff': now - age, 'resolution': resolution}
+            self.session.execute(text(
+                'DELETE FROM balances WHERE timestamp < :cutoff AND resolution < :resolution AND id NOT IN ('
+                'SELECT MIN(id) FROM balances WHERE timestamp < :cutoff AND resolution <= :resolution '
+                'GROUP BY account, worker, base_symbol, quote_symbol, CAST(timestamp / :resolution AS INTEGER))'
+            ), params)
+            self.session.execute(text(
+                'UPDATE balances SET resolution = :resolution WHERE timestamp < :cutoff AND resolution < :resolution'
+            ), params)
+
+        self.session.query(Balances).filter(
+            Balances.timestamp < now - BALANCE_HISTORY_RETENTION
+        ).delete(synchronize_session=False)
+
+    def _archive_orders(self):
+        """ Move orders deleted longer than order_archive_age ago to the orders archive
+
+            Orders deleted before the deletion time was recorded are archived on the first run.
+        """
+        condition = (Orders.deleted == True) & (  # noqa: E712
+            (Orders.deleted_at == None) | (Orders.deleted_at < time.time() - self.order_archive_age)  # noqa: E711
+        )
+        columns = [column.name for column in OrdersArchive.__table__.columns if column.name != 'id']
+        archived = self.session.execute(OrdersArchive.__table__.insert().from_select(
+            columns,
+            select([Orders.__table__.columns[name] for name in columns]).where(condition)
+        )).rowcount
+        if archived:
+            self.session.query(Orders).filter(condition).delete(synchronize_session=False)
+            log.info('Archived {} deleted orders'.format(archived))
+
+
+class MemoryBackend(StorageBackend):
+    """ Storage backend keeping everything in memory, for tests and backtests
+
+        Nothing is written to the disk and all data is lost when the process exits. Deleted orders are kept until
+        the worker's orders are cleared.
+    """
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.items = {}
+        self.orders = {}
+        self.balances = []
+
+    def set_item(self, category, key, value):
+        with self.lock:
+            self.items.setdefault(category, {})[key] = json.dumps(value)
+
+    def get_item(self, category, key):
+        value = self.items.get(category, {}).get(key)
+        if value is None:
+            return None
+        return json.loads(value)
+
+    def del_item(self, category, key):
+        with self.lock:
+            self.items.get(category, {}).pop(key, None)
+
+    def contains(self, category, key):
+        return key in self.items.get(category, {})
+
+    def get_items(self, category):
+        with self.lock:
+            return list(self.items.get(category, {}).items())
+
+    def clear(self, category):
+        with self.lock:
+            self.items.pop(category, None)
+
+    def update_order(self, order_id, user_data):
+        with self.lock:
+            order = self.orders.get(order_id)
+            if order is not None:
+                order.userdata = user_data
+        return True
+
+    def save_orders(self, worker, orders):
+        with self.lock:
+            for order_id, columns in orders.items():
+                order = self.orders.get(order_id)
+                if order is None:
+                    self.orders[order_id] = Orders(worker, order_id, **columns)
+                else:
+                    for name, value in columns.items():
+                        setattr(order, name, value)
+
+    def remove_orders(self, worker, order_ids):
+        now = int(time.time())
+        with self.lock:
+            for order_id in order_ids:
+                order = self.orders.get(order_id)
+                if order is not None and order.worker == worker:
+                    order.deleted = True
+                    order.deleted_at = now
+
+    def clear_orders(self, worker):
+        with self.lock:
+            self.orders = {order_id: order for order_id, order in self.orders.items() if order.worker != worker}
+
+    def fetch_order(self, order_id):
+        return self.orders.get(order_id)
+
+    def _worker_orders(self, worker, include_deleted):
+        with self.lock:
+            return [
+                order for order in self.orders.values()
+                if order.worker == worker and (include_deleted or not order.deleted)
+            ]
+
+    def fetch_orders(self, category, raw=False, include_deleted=False):
+        results = self._worker_orders(category, include_deleted)
+        if raw:
+            return results
+        if not results:
+            return None
+
+        result = {}
+        for row in results:
+            if row.order is None:
+                result[row.order_id] = dict(DatabaseWorker._order_record(row)._asdict(), id=row.order_id)
+            else:
+                result[row.order_id] = json.loads(row.order)
+        return result
+
+    def fetch_order_records(self, worker, include_deleted=False):
+        results = self._worker_orders(worker, include_deleted)
+        return {row.order_id: DatabaseWorker._order_record(row) for row in results} or None
+
+    def fetch_orders_by_price(self, worker, side, min_price=None, max_price=None):
+        results = [
+            DatabaseWorker._order_record(row) for row in self._worker_orders(worker, False)
+            if row.side == side and row.price is not None
+            and (min_price is None or row.price >= min_price)
+            and (max_price is None or row.price <= max_price)
+        ]
+        return sorted(results, key=lambda record: record.price)
+
+    def save_balance(self, balance):
+        with self.lock:
+            self.balances.append(balance)
+
+    def _balance_history(self, account, worker, base_asset, quote_asset):
+        with self.lock:
+            return [
+                balance for balance in self.balances
+                if balance.account == account and balance.worker == worker
+                and balance.base_symbol == base_asset and balance.quote_symbol == quote_asset
+            ]
+
+    def get_balance(self, account, worker, timestamp, base_asset, quote_asset):
+        """ Get first item that has bigger time as given timestamp and matches account and worker name
+        """
+        history = self._balance_history(account, worker, base_asset, quote_asset)
+        later = [balance for balance in history if balance.timestamp > timestamp]
+        if not later:
+            return None
+        return min(later, key=lambda balance: balance.timestamp)
+
+    def get_recent_balance_entry(self, account, worker, base_asset, quote_asset):
+        """ Get most recent balance history item that matches account and worker name
+        """
+        history = self._balance_history(account, worker, base_asset, quote_asset)
+        if not history:
+            return None
+        # Later entries win ties on the timestamp like the id ordering of the database
+        return max(reversed(history), key=lambda balance: balance.timestamp)
 
-        self._set_result(token, result)
 
 # Derive sqlite file directory
 data_dir = user_data_dir(APP_NAME, AUTHOR)
 sqlDataBaseFile = os.path.join(data_dir, storageDatabase)
 
-# Create directory for sqlite file
-helper.mkdir(data_dir)
+# Storage backend, created on first use by get_backend()
+_backend = None
+_backend_lock = threading.Lock()
+
 
-db_worker = DatabaseWorker()
+def get_backend():
+    """ Returns the storage backend
+
+        Unless another backend has been set with set_backend(), the SQLite database worker is started on first use,
+        so importing this module doesn't touch the disk.
+    """
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            # Create directory for sqlite file
+            helper.mkdir(data_dir)
+            _backend = DatabaseWorker()
+        return _backend
+
+
+def set_backend(backend):
+    """ Replace the storage backend, e.g. with a MemoryBackend for tests and backtests
+
+        Storage objects created earlier use the new backend as well, the key/value cache is dropped.
+
+        :param StorageBackend | backend: Backend to use from now on
+    """
+    global _backend
+    with _backend_lock:
+        if _backend is not None:
+            _backend.flush()
+        _backend = backend
+    with Storage._cache_lock:
+        Storage._cache.clear()
@@ -1,14 +1,20 @@
+import asyncio
 import datetime
 import copy
 import collections
+import functools
+import json
 import logging
 import math
 import time
 
+from dexbot import metrics
 from dexbot.config import Config
-from dexbot.storage import Storage
+from dexbot.storage import Storage, chunks
 from dexbot.statemachine import StateMachine
+from dexbot.depth import market_depth
 from dexbot.helper import truncate
+from dexbot.orderbook import order_books
 from dexbot.strategies.external_feeds.price_feed import PriceFeed
 from dexbot.qt_queue.idle_queue import idle_add
 
@@ -22,10 +28,23 @@ from bitshares.dex import Dex
 from bitshares.instance import shared_bitshares_instance
 from bitshares.market import Market
 from bitshares.price import FilledOrder, Order, UpdateCallOrder
+from bitsharesbase import operations
 
 # Number of maximum retries used to retry action before failing
 MAX_TRIES = 3
 
+# Checkpoints of the worker's runtime state older than this are not restored, seconds
+CHECKPOINT_MAX_AGE = 60 * 60
+
+# The runtime state of a running worker is checkpointed at most this often, see save_checkpoint_if_due(), seconds
+CHECKPOINT_INTERVAL = 60
+
+# The snapshot of the worker's account is reused for at most this long, about a block, seconds
+ACCOUNT_SNAPSHOT_MAX_AGE = 3
+
+# Maximum number of objects requested with one get_objects call, the default limit of the nodes
+GET_OBJECTS_LIMIT = 100
+
 """ Strategies need to specify their own configuration values, so each strategy can have a class method 'configure' 
     which returns a list of ConfigElement named tuples.
     
@@ -134,6 +153,12 @@ class StrategyBase(Storage, StateMachine, Events):
         'error_ontick',
     ]
 
+    # Cadence of the ontick events, see dexbot.scheduler.TickScheduler: tick every tick_blocks blocks, at most once
+    # per tick_interval seconds, and with tick_on_change only after a market or account event reached the worker
+    tick_blocks = 1
+    tick_interval = 0
+    tick_on_change = False
+
     @classmethod
     def configure(cls, return_base_config=True):
         """ Return a list of ConfigElement objects defining the configuration values for this class.
@@ -242,9 +267,20 @@ class StrategyBase(Storage, StateMachine, Events):
         self._account = Account(self.worker["account"], full=True, bitshares_instance=self.bitshares)
         self._market = Market(config["workers"][name]["market"], bitshares_instance=self.bitshares)
 
+        # Snapshot of the account's balances, taken together with its open orders, see refresh_account()
+        self._balances = None
+        self.account_refreshed = 0
+        self._take_account_snapshot()
+
+        # Time of the last runtime state checkpoint, see save_checkpoint()
+        self.checkpointed = 0
+
         # Recheck flag - Tell the strategy to check for updated orders
         self.recheck_orders = False
 
+        # Measurement of the running coroutine event handler, counting the RPC calls of call_async()
+        self.handler_measurement = None
+
         # Count of orders to be fetched from the API
         self.fetch_depth = 8
 
@@ -324,6 +360,10 @@ class StrategyBase(Storage, StateMachine, Events):
             self.log.exception('Unable to cancel order(s), private key missing.')
             return False
 
+        if not self.bitshares.bundle:
+            # Bundled cancels are counted when the bundle is broadcast, see execute()
+            count = len(orders) if isinstance(orders, (list, set, tuple)) else 1
+            metrics.ORDERS_CANCELLED.inc(count, worker=self.worker_name)
         return True
 
     def account_total_value(self, return_asset):
@@ -343,10 +383,9 @@ class StrategyBase(Storage, StateMachine, Events):
                 total_value += balance['amount']
 
         # Orders balance calculation
-        for order in self.all_own_orders:
-            updated_order = self.get_updated_order(order['id'])
-
-            if not order:
+        updated_orders = self.get_updated_orders([order['id'] for order in self.all_own_orders])
+        for updated_order in updated_orders.values():
+            if not updated_order:
                 continue
             if updated_order['base']['symbol'] == return_asset:
                 total_value += updated_order['base']['amount']
@@ -366,7 +405,14 @@ class StrategyBase(Storage, StateMachine, Events):
             :param float | fee_reservation: How much is saved in reserve for the fees
             :return: Balance of specific asset
         """
-        balance = self._account.balance(asset)
+        symbol = asset['symbol'] if isinstance(asset, dict) else asset
+        for balance in self.balances:
+            if balance['symbol'] == symbol:
+                # Callers may change the amount, keep the snapshot intact
+                balance = balance.copy()
+                break
+        else:
+            balance = Amount(0, symbol, bitshares_instance=self.bitshares)
 
         if fee_reservation > 0:
             balance['amount'] = balance['amount'] - fee_reservation
@@ -505,8 +551,7 @@ class StrategyBase(Storage, StateMachine, Events):
         quote_asset = self.market['quote']['id']
         base_asset = self.market['base']['id']
 
-        for order_id in order_ids:
-            order = self.get_updated_order(order_id)
+        for order in self.get_updated_orders(order_ids).values():
             if not order:
                 continue
             asset_id = order['base']['asset']['id']
@@ -670,83 +715,50 @@ class StrategyBase(Storage, StateMachine, Events):
             :param float | quote_amount:
             :param float | base_amount:
             :param bool | exclude_own_orders: Exclude own orders when calculating a price
-            :return: price as float
+            :return: price as float, None if there are no buy orders on the market
         """
-        market_buy_orders = []
-
-        # Exclude own orders from orderbook if needed
-        if exclude_own_orders:
-            market_buy_orders = self.get_market_buy_orders(depth=self.fetch_depth)
-            own_buy_orders_ids = [o['id'] for o in self.get_own_buy_orders()]
-            market_buy_orders = [o for o in market_buy_orders if o['id'] not in own_buy_orders_ids]
+        bids = self.get_market_depth('buy', exclude_own_orders)
 
         # In case amount is not given, return price of the highest buy order on the market
         if quote_amount == 0 and base_amount == 0:
-            if exclude_own_orders:
-                if market_buy_orders:
-                    return float(market_buy_orders[0]['price'])
-                else:
-                    return '0.0'
-            else:
-                return float(self.ticker().get('highestBid'))
-
-        # Like get_market_sell_price(), but defaulting to base_amount if both base and quote are specified.
-        asset_amount = base_amount
+            return bids.best_price
 
         """ Since the purpose is never get both quote and base amounts, favor base amount if both given because
             this function is looking for buy price.
         """
-        if base_amount > quote_amount:
-            base = True
-        else:
-            asset_amount = quote_amount
-            base = False
-
-        if not market_buy_orders:
-            market_buy_orders = self.get_market_buy_orders(depth=self.fetch_depth)
-        market_fee = self.get_market_fee()
-
-        target_amount = asset_amount * (1 + market_fee)
-
-        quote_amount = 0
-        base_amount = 0
-        missing_amount = target_amount
-
-        for order in market_buy_orders:
-            if base:
-                # BASE amount was given
-                if order['base']['amount'] <= missing_amount:
-                    quote_amount += order['quote']['amount']
-                    base_amount += order['base']['amount']
-                    missing_amount -= order['base']['amount']
-                else:
-                    base_amount += missing_amount
-                    quote_amount += missing_amount / order['price']
-                    break
-            elif not base:
-                # QUOTE amount was given
-                if order['quote']['amount'] <= missing_amount:
-                    quote_amount += order['quote']['amount']
-                    base_amount += order['base']['amount']
-                    missing_amount -= order['quote']['amount']
-                else:
-                    base_amount += missing_amount * order['price']
-                    quote_amount += missing_amount
-                    break
-
-        return base_amount / quote_amount
+        base = base_amount > quote_amount
+        asset_amount = base_amount if base else quote_amount
+        target_amount = asset_amount * (1 + self.get_market_fee())
+        return bids.fill_price(target_amount, by_base=base)
+
+    def get_market_depth(self, side, exclude_own_orders=False):
+        """ Returns one side of the market's order book as arrays of prices and amounts, see dexbot.depth
+
+            The depth is built from the raw orders of the order book cache, without creating Order objects.
+
+            :param str | side: 'buy' for the bids, 'sell' for the asks
+            :param bool | exclude_own_orders: Leave own orders out
+            :return: MarketDepth
+        """
+        exclude_ids = ()
+        if exclude_own_orders:
+            own_orders = self.get_own_buy_orders() if side == 'buy' else self.get_own_sell_orders()
+            exclude_ids = {order['id'] for order in own_orders}
+        orders = order_books.get_limit_orders(self.bitshares, self.market, self.fetch_depth)
+        return market_depth(orders, self.market, side, exclude_ids)
 
     def get_market_orders(self, depth=1, updated=True):
         """ Returns orders from the current market. Orders are sorted by price.
 
-            get_market_orders() call does not have any depth limit.
+            get_market_orders() call does not have any depth limit. The orders come from the order book cache shared
+            by the workers of the process, see dexbot.orderbook.
 
             :param int | depth: Amount of orders per side will be fetched, default=1
             :param bool | updated: Return updated orders. "Updated" means partially filled orders will represent
                                    remainders and not just initial amounts
             :return: Returns a list of orders or None
         """
-        orders = self.bitshares.rpc.get_limit_orders(self.market['base']['id'], self.market['quote']['id'], depth)
+        orders = order_books.get_limit_orders(self.bitshares, self.market, depth)
         if updated:
             orders = [self.get_updated_limit_order(o) for o in orders]
         orders = [Order(o, bitshares_instance=self.bitshares) for o in orders]
@@ -774,70 +786,21 @@ class StrategyBase(Storage, StateMachine, Events):
             :param float | quote_amount:
             :param float | base_amount:
             :param bool | exclude_own_orders: Exclude own orders when calculating a price
-            :return:
+            :return: price as float, None if there are no sell orders on the market
         """
-        market_sell_orders = []
-
-        # Exclude own orders from orderbook if needed
-        if exclude_own_orders:
-            market_sell_orders = self.get_market_sell_orders(depth=self.fetch_depth)
-            own_sell_orders_ids = [o['id'] for o in self.get_own_sell_orders()]
-            market_sell_orders = [o for o in market_sell_orders if o['id'] not in own_sell_orders_ids]
+        asks = self.get_market_depth('sell', exclude_own_orders)
 
         # In case amount is not given, return price of the lowest sell order on the market
         if quote_amount == 0 and base_amount == 0:
-            if exclude_own_orders:
-                if market_sell_orders:
-                    return float(market_sell_orders[0]['price'])
-                else:
-                    return '0.0'
-            else:
-                return float(self.ticker().get('lowestAsk'))
-
-        asset_amount = quote_amount
+            return asks.best_price
 
         """ Since the purpose is never get both quote and base amounts, favor quote amount if both given because
             this function is looking for sell price.
         """
-        if quote_amount > base_amount:
-            quote = True
-        else:
-            asset_amount = base_amount
-            quote = False
-
-        if not market_sell_orders:
-            market_sell_orders = self.get_market_sell_orders(depth=self.fetch_depth)
-        market_fee = self.get_market_fee()
-
-        target_amount = asset_amount * (1 + market_fee)
-
-        quote_amount = 0
-        base_amount = 0
-        missing_amount = target_amount
-
-        for order in market_sell_orders:
-            if quote:
-                # QUOTE amount was given
-                if order['quote']['amount'] <= missing_amount:
-                    quote_amount += order['quote']['amount']
-                    base_amount += order['base']['amount']
-                    missing_amount -= order['quote']['amount']
-                else:
-                    base_amount += missing_amount * order['price']
-                    quote_amount += missing_amount
-                    break
-            elif not quote:
-                # BASE amount was given
-                if order['base']['amount'] <= missing_amount:
-                    quote_amount += order['quote']['amount']
-                    base_amount += order['base']['amount']
-                    missing_amount -= order['base']['amount']
-                else:
-                    base_amount += missing_amount
-                    quote_amount += missing_amount / order['price']
-                    break
-
-        return base_amount / quote_amount
+        quote = quote_amount > base_amount
+        asset_amount = quote_amount if quote else base_amount
+        target_amount = asset_amount * (1 + self.get_market_fee())
+        return asks.fill_price(target_amount, by_base=not quote)
 
     def get_market_spread(self, quote_amount=0, base_amount=0):
         """ Returns the market spread %, including own orders, from specified depth.
@@ -850,7 +813,7 @@ class StrategyBase(Storage, StateMachine, Events):
         bid = self.get_market_buy_price(quote_amount=quote_amount, base_amount=base_amount, exclude_own_orders=False)
 
         # Calculate market spread
-        if ask == 0 or bid == 0:
+        if not ask or not bid:
             return None
 
         return ask / bid - 1
@@ -969,32 +932,74 @@ class StrategyBase(Storage, StateMachine, Events):
         if isinstance(order_id, dict):
             order_id = order_id['id']
 
-        # At first, try to look up own orders. This prevents RPC calls whether requested order is own order
-        order = None
-        for limit_order in self.account['limit_orders']:
-            if order_id == limit_order['id']:
-                order = limit_order
-                break
-        else:
-            # We are using direct rpc call here because passing an Order object to self.get_updated_limit_order() give
-            # us weird error "Object of type 'BitShares' is not JSON serializable"
-            order = self.bitshares.rpc.get_objects([order_id])[0]
+        return self.get_updated_orders([order_id])[order_id]
 
-        # Do not try to continue whether there is no order in the blockchain
-        if not order:
-            return None
+    def get_updated_orders(self, order_ids):
+        """ Like get_updated_order(), for many orders at once
+
+            :param list order_ids: blockchain Order objects or ids of the orders
+            :return: dict: Updated Order objects by order id, None for the orders which don't exist
+        """
+        orders = {}
+        for order_id, limit_order in self._get_limit_orders(order_ids).items():
+            if limit_order:
+                limit_order = Order(self.get_updated_limit_order(limit_order), bitshares_instance=self.bitshares)
+            orders[order_id] = limit_order
+        return orders
 
-        updated_order = self.get_updated_limit_order(order)
-        return Order(updated_order, bitshares_instance=self.bitshares)
+    def get_orders(self, order_ids):
+        """ Returns the orders as they are on the blockchain, with the original amounts in 'base' and 'quote' and the
+            amount left in 'for_sale'
+
+            :param list order_ids: blockchain Order objects or ids of the orders
+            :return: dict: Order objects by order id, None for the orders which don't exist
+        """
+        orders = {}
+        for order_id, limit_order in self._get_limit_orders(order_ids).items():
+            if limit_order:
+                limit_order = Order(limit_order, bitshares_instance=self.bitshares)
+            orders[order_id] = limit_order
+        return orders
+
+    def _get_limit_orders(self, order_ids):
+        """ Returns the limit order objects by order id, None for the orders which don't exist
+
+            Own orders are looked up in the account snapshot, the others are fetched with a get_objects call per
+            GET_OBJECTS_LIMIT orders.
+        """
+        order_ids = [order_id['id'] if isinstance(order_id, dict) else order_id for order_id in order_ids]
+        own_orders = {limit_order['id']: limit_order for limit_order in self.refresh_account()['limit_orders']}
+
+        limit_orders = {}
+        missing = []
+        for order_id in order_ids:
+            if order_id in own_orders:
+                limit_orders[order_id] = own_orders[order_id]
+            elif order_id not in limit_orders:
+                limit_orders[order_id] = None
+                missing.append(order_id)
+
+        for chunk in chunks(missing, GET_OBJECTS_LIMIT):
+            # We are using direct rpc call here because passing an Order object to self.get_updated_limit_order()
+            # give us weird error "Object of type 'BitShares' is not JSON serializable"
+            for order_id, limit_order in zip(chunk, self.bitshares.rpc.get_objects(chunk)):
+                limit_orders[order_id] = limit_order or None
+        return limit_orders
 
     def execute(self):
         """ Execute a bundle of operations
 
             :return: dict: transaction
         """
+        cancels = sum(isinstance(op, operations.Limit_order_cancel) for op in self.bitshares.txbuffer.ops)
         self.bitshares.blocking = "head"
-        r = self.bitshares.txbuffer.broadcast()
-        self.bitshares.blocking = False
+        try:
+            r = self.bitshares.txbuffer.broadcast()
+        finally:
+            self.bitshares.blocking = False
+            self.invalidate_account()
+        if cancels:
+            metrics.ORDERS_CANCELLED.inc(cancels, worker=self.worker_name)
         return r
 
     def is_buy_order(self, order):
@@ -1039,6 +1044,32 @@ class StrategyBase(Storage, StateMachine, Events):
         else:
             return False
 
+    def order_columns(self, order):
+        """ Get the typed columns stored for an order in the worker's market terms
+
+            Base and quote are the market's assets and the price is BASE/QUOTE of the market for both sides, so
+            that orders can be queried by price from the database.
+
+            :param dict | order: dict or Order object
+            :return dict: Column values by column name
+        """
+        columns = Storage.order_columns(self, order)
+        if columns['base_asset'] is None:
+            return columns
+
+        if self.is_buy_order(order):
+            columns['side'] = 'buy'
+        elif self.is_sell_order(order):
+            columns['side'] = 'sell'
+            columns.update({
+                'base_amount': columns['quote_amount'],
+                'base_asset': columns['quote_asset'],
+                'quote_amount': columns['base_amount'],
+                'quote_asset': columns['base_asset'],
+                'price': 1 / columns['price'] if columns['price'] else None,
+            })
+        return columns
+
     def pause(self):
         """ Pause the worker
 
@@ -1052,6 +1083,59 @@ class StrategyBase(Storage, StateMachine, Events):
         if self.clear_enabled:
             self.clear_orders()
 
+    def get_runtime_state(self):
+        """ Returns the runtime state to checkpoint when the worker is stopped, see save_checkpoint()
+
+            Strategies with state which is slow to rebuild override this and pick the state up again with
+            load_checkpoint() on start. The state must be JSON serializable.
+
+            :return dict: The state, None to not write a checkpoint
+        """
+        return None
+
+    def save_checkpoint(self):
+        """ Store the runtime state of the worker, to continue where it left off on the next start
+        """
+        state = self.get_runtime_state()
+        if state is None:
+            return
+        self.checkpointed = time.time()
+        self['checkpoint'] = {'time': self.checkpointed, 'config': self.worker, 'state': state}
+        self.log.debug('Runtime state checkpointed')
+
+    def save_checkpoint_if_due(self, interval=CHECKPOINT_INTERVAL):
+        """ Store the runtime state unless it was checkpointed within the interval, see save_checkpoint()
+
+            Strategies call this after each successful maintenance, so a worker which crashed instead of being
+            stopped continues from its last checkpoint as well.
+
+            :param float interval: Minimum time between the checkpoints in seconds
+        """
+        if time.time() - self.checkpointed >= interval:
+            self.save_checkpoint()
+
+    def load_checkpoint(self, max_age=CHECKPOINT_MAX_AGE):
+        """ Returns the runtime state stored when the worker was stopped last time
+
+            The checkpoint is used only once. It is ignored when it is older than max_age or the worker's
+            config changed meanwhile.
+
+            :param float max_age: Maximum age of the checkpoint in seconds
+            :return dict: The state returned by get_runtime_state(), None if there is no usable checkpoint
+        """
+        checkpoint = self['checkpoint']
+        if checkpoint is None:
+            return None
+        del self['checkpoint']
+
+        if time.time() - checkpoint['time'] > max_age:
+            self.log.info('Ignoring the runtime state checkpoint, it is older than {} seconds'.format(max_age))
+            return None
+        if checkpoint['config'] != json.loads(json.dumps(self.worker)):
+            self.log.info('Ignoring the runtime state checkpoint, the worker config changed')
+            return None
+        return checkpoint['state']
+
     def clear_all_worker_data(self):
         """ Clear all the worker data from the database and cancel all orders
         """
@@ -1109,6 +1193,7 @@ class StrategyBase(Storage, StateMachine, Events):
         )
 
         self.log.debug('Placed buy order {}'.format(buy_transaction))
+        metrics.ORDERS_PLACED.inc(worker=self.worker_name, side='buy')
         if return_order_id:
             buy_order = self.get_order(buy_transaction['orderid'], return_none=return_none)
             if buy_order and buy_order['deleted']:
@@ -1164,6 +1249,7 @@ class StrategyBase(Storage, StateMachine, Events):
         )
 
         self.log.debug('Placed sell order {}'.format(sell_transaction))
+        metrics.ORDERS_PLACED.inc(worker=self.worker_name, side='sell')
         if return_order_id:
             sell_order = self.get_order(sell_transaction['orderid'], return_none=return_none)
             if sell_order and sell_order['deleted']:
@@ -1188,28 +1274,74 @@ class StrategyBase(Storage, StateMachine, Events):
             try:
                 return action(*args, **kwargs)
             except bitsharesapi.exceptions.UnhandledRPCError as exception:
-                if "Assert Exception: amount_to_sell.amount > 0" in str(exception):
-                    if tries > MAX_TRIES:
-                        raise
-                    else:
-                        tries += 1
-                        self.log.warning("Ignoring: '{}'".format(str(exception)))
-                        self.bitshares.txbuffer.clear()
-                        self.account.refresh()
-                        time.sleep(2)
-                elif "now <= trx.expiration" in str(exception):  # Usually loss of sync to blockchain
-                    if tries > MAX_TRIES:
-                        raise
-                    else:
-                        tries += 1
-                        self.log.warning("retrying on '{}'".format(str(exception)))
-                        self.bitshares.txbuffer.clear()
-                        time.sleep(6)  # Wait at least a BitShares block
-                elif "Assert Exception: delta.amount > 0: Insufficient Balance" in str(exception):
-                    self.log.critical('Insufficient balance of fee asset')
-                    raise
-                else:
-                    raise
+                time.sleep(self._retry_delay(exception, tries))
+                tries += 1
+            finally:
+                if not self.bitshares.bundle:
+                    # The action may have broadcast a transaction changing the account
+                    self.invalidate_account()
+
+    async def retry_action_async(self, action, *args, **kwargs):
+        """ Coroutine variant of retry_action(): the action runs in the executor (see call_async()) and the waits
+            between the tries don't block the event loop
+
+            :param action:
+            :return:
+        """
+        tries = 0
+        while True:
+            try:
+                return await self.call_async(action, *args, **kwargs)
+            except bitsharesapi.exceptions.UnhandledRPCError as exception:
+                await asyncio.sleep(self._retry_delay(exception, tries))
+                tries += 1
+            finally:
+                if not self.bitshares.bundle:
+                    self.invalidate_account()
+
+    def _retry_delay(self, exception, tries):
+        """ Returns the time to wait before retrying an action which failed, or raises the exception if the action
+            shouldn't be retried
+
+            :param exception: The exception raised by the action
+            :param int tries: Number of retries done already
+            :return: int: Seconds to wait
+        """
+        if "Assert Exception: amount_to_sell.amount > 0" in str(exception):
+            if tries > MAX_TRIES:
+                raise exception
+            self.log.warning("Ignoring: '{}'".format(str(exception)))
+            metrics.ACTION_RETRIES.inc(worker=self.worker_name)
+            self.bitshares.txbuffer.clear()
+            self.refresh_account(force=True)
+            return 2
+        elif "now <= trx.expiration" in str(exception):  # Usually loss of sync to blockchain
+            if tries > MAX_TRIES:
+                raise exception
+            self.log.warning("retrying on '{}'".format(str(exception)))
+            metrics.ACTION_RETRIES.inc(worker=self.worker_name)
+            self.bitshares.txbuffer.clear()
+            return 6  # Wait at least a BitShares block
+        elif "Assert Exception: delta.amount > 0: Insufficient Balance" in str(exception):
+            self.log.critical('Insufficient balance of fee asset')
+            raise exception
+        else:
+            raise exception
+
+    async def call_async(self, func, *args, **kwargs):
+        """ Await a blocking call, such as an RPC or an external exchange request, from a coroutine event handler
+
+            The call runs in the default executor of the event loop, so the other workers keep running meanwhile. Its
+            RPC calls are counted for the running event handler.
+
+            :param func: Function to call
+            :return: The result of the call
+        """
+        call = functools.partial(func, *args, **kwargs)
+        if self.handler_measurement is not None:
+            call = functools.partial(self.handler_measurement.run, call)
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(None, call)
 
     def store_profit_estimation_data(self):
         """ Save total quote, total base, center_price, and datetime in to the database
@@ -1269,19 +1401,54 @@ class StrategyBase(Storage, StateMachine, Events):
     @property
     def account(self):
         """ Return the full account as :class:`bitshares.account.Account` object!
-            Can be refreshed by using ``x.refresh()``
+            Can be refreshed by using ``x.refresh_account()``
 
             :return: object | Account
         """
         return self._account
 
+    def refresh_account(self, force=False):
+        """ Fetch the full account, its balances and open orders, with a single RPC call
+
+            The snapshot is reused until the next event, a broadcast or ACCOUNT_SNAPSHOT_MAX_AGE, so the balances
+            and orders read while handling an event cost one call in total.
+
+            :param bool | force: Fetch the account even if the snapshot is still valid
+            :return: object | Account
+        """
+        if force or self._balances is None or time.time() - self.account_refreshed > ACCOUNT_SNAPSHOT_MAX_AGE:
+            self._account.refresh()
+            self._take_account_snapshot()
+        return self._account
+
+    def _take_account_snapshot(self):
+        balances = self._account.get('balances')
+        if balances is None:
+            # Not a full account, fetch it on first use
+            return
+        self._balances = [
+            Amount({'amount': balance['balance'], 'asset_id': balance['asset_type']}, bitshares_instance=self.bitshares)
+            for balance in balances if int(balance['balance']) > 0
+        ]
+        self.account_refreshed = time.time()
+
+    def invalidate_account(self):
+        """ Drop the account snapshot, the next read of balances or orders fetches the account again
+
+            Called on every event the worker handles and after broadcasting transactions.
+        """
+        self._balances = None
+
     @property
     def balances(self):
         """ Returns all the balances of the account assigned for the worker.
 
+            The list is shared until the account is fetched again, don't modify it.
+
             :return: Balances in list where each asset is in their own Amount object
         """
-        return self._account.balances
+        self.refresh_account()
+        return self._balances
 
     @property
     def base_asset(self):
@@ -1300,7 +1467,7 @@ class StrategyBase(Storage, StateMachine, Events):
         """
         # Refresh account data
         if refresh:
-            self.account.refresh()
+            self.refresh_account()
 
         orders = []
         for order in self.account.openorders:
@@ -1317,7 +1484,7 @@ class StrategyBase(Storage, StateMachine, Events):
         orders = []
 
         # Refresh account data
-        self.account.refresh()
+        self.refresh_account()
 
         for order in self.account.openorders:
             if self.worker["market"] == order.market and self.account.openorders:
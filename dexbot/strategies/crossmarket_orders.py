@@ -14,6 +14,9 @@ class Strategy(StrategyBase):
     """ Relative Orders strategy
     """
 
+    # Check the orders every 5 blocks
+    tick_blocks = 5
+
     @classmethod
     def configure(cls, return_base_config=True):
         return StrategyBase.configure(return_base_config) + [
@@ -65,8 +68,6 @@ class Strategy(StrategyBase):
         # don't clear your orders history
         self.clear_enabled = False
 
-        # Tick counter
-        self.counter = 0
         self.fill_history = {}
 
         # Define Callbacks
@@ -167,14 +168,12 @@ class Strategy(StrategyBase):
         self.disabled = True
 
     def tick(self, d):
-        """ Ticks come in on every block. We need to periodically check orders because cancelled orders
-            do not triggers a market_update event
+        """ Ticks come in on every fifth block, see tick_blocks. We need to periodically check orders because
+            cancelled orders do not triggers a market_update event
         """
-        if (self.is_reset_on_price_change and not
-                self.counter % 5):
+        if self.is_reset_on_price_change:
             self.log.debug('Checking orders by tick threshold')
             self.check_orders()
-        self.counter += 1
 
     def get_center_simple(self, external_price_source, external_ticker):
         market = external_ticker or self.market.get_string('/')
@@ -211,37 +210,38 @@ class Strategy(StrategyBase):
     def update_orders(self):
         self.log.info('Starting to update orders')
 
+        orders = self.all_own_orders
+
         # Cancel the orders before redoing them
         self.cancel_all_orders()
 
         # soft remove
-        for order_id in self.all_own_orders:
-            res = self.remove_order({ "id": order_id})
-            self.log.info("update order to cancelled {} {}".format(order_id, res))
+        self.remove_orders(orders)
+        self.log.info("update orders to cancelled {}".format([order['id'] for order in orders]))
 
         #self.clear_orders()
 
         # Recalculate buy and sell order prices
         self.calculate_order_prices()
 
-        order_ids = []
+        placed_orders = []
         expected_num_orders = 0
 
         for order in self.buy_orders:
             buy_order = self.place_market_buy_order(order[1], order[0], True)
             if buy_order:
-                self.save_order(buy_order)
-                order_ids.append(buy_order['id'])
+                placed_orders.append(buy_order)
             expected_num_orders += 1
 
         # Sell Side
         for order in self.sell_orders:
             sell_order = self.place_market_sell_order(order[1], order[0], True)
             if sell_order:
-                self.save_order(sell_order)
-                order_ids.append(sell_order['id'])
+                placed_orders.append(sell_order)
             expected_num_orders += 1
 
+        self.save_orders(placed_orders)
+        order_ids = [order['id'] for order in placed_orders]
         self['order_ids'] = order_ids
         self.log.info("Done placing orders {}".format(order_ids))
 
@@ -416,10 +416,11 @@ class Strategy(StrategyBase):
 
             changed_set = []
             current_active_orders = 0
+            current_orders = self.get_orders([order.order_id for order in orders])
             # Loop trough the orders and look for changes
             for order in orders:
                 order_id = order.order_id
-                current_order = self.get_order(order_id)
+                current_order = current_orders[order_id]
 
                 if current_order:
                     current_active_orders += 1
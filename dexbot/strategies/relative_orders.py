@@ -9,6 +9,9 @@ class Strategy(StrategyBase):
     """ Relative Orders strategy
     """
 
+    # Check the orders every 8 blocks
+    tick_blocks = 8
+
     @classmethod
     def configure(cls, return_base_config=True):
         return StrategyBase.configure(return_base_config) + [
@@ -67,9 +70,6 @@ class Strategy(StrategyBase):
         super().__init__(*args, **kwargs)
         self.log.info("Initializing Relative Orders")
 
-        # Tick counter
-        self.counter = 0
-
         # Define Callbacks
         self.ontick += self.tick
         self.onMarketUpdate += self.check_orders
@@ -161,14 +161,12 @@ class Strategy(StrategyBase):
         self.disabled = True
 
     def tick(self, d):
-        """ Ticks come in on every block. We need to periodically check orders because cancelled orders
-            do not triggers a market_update event
+        """ Ticks come in on every eighth block, see tick_blocks. We need to periodically check orders because
+            cancelled orders do not triggers a market_update event
         """
-        if (self.is_reset_on_price_change and not
-                self.counter % 8):
+        if self.is_reset_on_price_change:
             self.log.debug('Checking orders by tick threshold')
             self.check_orders()
-        self.counter += 1
 
     @property
     def amount_quote(self):
@@ -191,6 +189,18 @@ class Strategy(StrategyBase):
         else:
             return self.order_size
 
+    def calculate_dynamic_spread(self):
+        """ Returns the market spread multiplied by the dynamic spread factor
+
+            The configured spread is used while one side of the market is empty and there is no market spread.
+        """
+        market_spread = self.get_market_spread(quote_amount=self.market_depth_amount)
+        if market_spread is None:
+            self.log.warning('Cannot calculate the market spread, one side of the market is empty. '
+                             'Using the configured spread')
+            return self.spread
+        return market_spread * self.dynamic_spread_factor
+
     def calculate_order_prices(self):
         # Set center price as None, in case dynamic has not amount given, center price is calculated from market orders
         center_price = None
@@ -198,7 +208,7 @@ class Strategy(StrategyBase):
 
         # Calculate spread if dynamic spread option in use, this calculation doesn't include own orders on the market
         if self.dynamic_spread:
-            spread = self.get_market_spread(quote_amount=self.market_depth_amount) * self.dynamic_spread_factor
+            spread = self.calculate_dynamic_spread()
 
         if self.is_center_price_dynamic:
             # Calculate center price from the market orders
@@ -241,7 +251,7 @@ class Strategy(StrategyBase):
         # Recalculate buy and sell order prices
         self.calculate_order_prices()
 
-        order_ids = []
+        placed_orders = []
         expected_num_orders = 0
 
         amount_base = self.amount_base
@@ -251,18 +261,18 @@ class Strategy(StrategyBase):
         if amount_base:
             buy_order = self.place_market_buy_order(amount_base, self.buy_price, True)
             if buy_order:
-                self.save_order(buy_order)
-                order_ids.append(buy_order['id'])
+                placed_orders.append(buy_order)
             expected_num_orders += 1
 
         # Sell Side
         if amount_quote:
             sell_order = self.place_market_sell_order(amount_quote, self.sell_price, True)
             if sell_order:
-                self.save_order(sell_order)
-                order_ids.append(sell_order['id'])
+                placed_orders.append(sell_order)
             expected_num_orders += 1
 
+        self.save_orders(placed_orders)
+        order_ids = [order['id'] for order in placed_orders]
         self['order_ids'] = order_ids
 
         self.log.info("Done placing orders")
@@ -385,9 +395,12 @@ class Strategy(StrategyBase):
         if not orders:
             need_update = True
         else:
+            # Look up all orders with one call, the original amounts are needed to detect partial fills
+            current_orders = self.get_orders(list(orders))
+
             # Loop trough the orders and look for changes
             for order_id, order in orders.items():
-                current_order = self.get_order(order_id)
+                current_order = current_orders[order_id]
 
                 if not current_order:
                     need_update = True
@@ -417,7 +430,7 @@ class Strategy(StrategyBase):
 
             # Calculate spread if dynamic spread option in use, this calculation includes own orders on the market
             if self.dynamic_spread:
-                spread = self.get_market_spread(quote_amount=self.market_depth_amount) * self.dynamic_spread_factor
+                spread = self.calculate_dynamic_spread()
 
             center_price = self.calculate_center_price(
                 None,
@@ -14,6 +14,9 @@ from dexbot.strategies.base import StrategyBase, ConfigElement, DetailElement
 class Strategy(StrategyBase):
     """ Staggered Orders strategy """
 
+    # Check the orders every 3 blocks
+    tick_blocks = 3
+
     @classmethod
     def configure(cls, return_base_config=True):
         """ Modes description:
@@ -84,9 +87,6 @@ class Strategy(StrategyBase):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        # Tick counter
-        self.counter = 0
-
         # Define callbacks
         self.onMarketUpdate += self.maintain_strategy
         self.onAccount += self.maintain_strategy
@@ -169,7 +169,9 @@ class Strategy(StrategyBase):
         self.max_check_interval = 120
         self.current_check_interval = self.min_check_interval
 
-        self.cancel_all_orders()
+        # Continue with the orders left on the market when the worker was stopped recently, otherwise start over
+        if not self.restore_runtime_state():
+            self.cancel_all_orders()
 
         if self.view:
             self.update_gui_profit()
@@ -225,7 +227,7 @@ class Strategy(StrategyBase):
         success = self.remove_outside_orders(self.sell_orders, self.buy_orders)
         if not success:
             # Return back to beginning
-            self.log_maintenance_time()
+            self.finish_maintenance()
             return
 
         # Restore virtual orders on startup if needed
@@ -234,7 +236,7 @@ class Strategy(StrategyBase):
 
             if self.virtual_orders_restored:
                 self.log.info('Virtual orders restored')
-                self.log_maintenance_time()
+                self.finish_maintenance()
                 return
 
         # Replace excessive real orders with virtual ones, buy side
@@ -264,7 +266,7 @@ class Strategy(StrategyBase):
                 real orders without waiting until all range will be covered.
             """
             self.replace_virtual_order_with_real(self.virtual_buy_orders[0])
-            self.log_maintenance_time()
+            self.finish_maintenance()
             return
 
         # Check for operational depth, sell side
@@ -272,7 +274,7 @@ class Strategy(StrategyBase):
                 len(self.real_sell_orders) < self.operational_depth and
                 not self.bootstrapping):
             self.replace_virtual_order_with_real(self.virtual_sell_orders[0])
-            self.log_maintenance_time()
+            self.finish_maintenance()
             return
 
         # Prepare to bundle operations into single transaction
@@ -339,7 +341,7 @@ class Strategy(StrategyBase):
                 self.base_balance_history[0] != self.base_balance_history[2] or
                 self.quote_balance_history[0] != self.quote_balance_history[2]):
             self.last_check = datetime.now()
-            self.log_maintenance_time()
+            self.finish_maintenance()
             return
 
         # There are no funds and current orders aren't close enough, try to fix the situation by shifting orders.
@@ -362,7 +364,7 @@ class Strategy(StrategyBase):
             if self.actual_spread < self.target_spread + self.increment:
                 # Target spread is reached, no need to cancel anything
                 self.last_check = datetime.now()
-                self.log_maintenance_time()
+                self.finish_maintenance()
                 return
 
         # What amount of quote may be obtained if buy using avail base balance
@@ -402,12 +404,18 @@ class Strategy(StrategyBase):
             self.log.info('Target spread is not reached but cannot determine what furthest order to cancel')
 
         self.last_check = datetime.now()
-        self.log_maintenance_time()
+        self.finish_maintenance()
 
         # Update profit estimate
         if self.view:
             self.update_gui_profit()
 
+    def finish_maintenance(self):
+        """ Log the maintenance time and checkpoint the runtime state, at the end of a maintenance run
+        """
+        self.log_maintenance_time()
+        self.save_checkpoint_if_due()
+
     def log_maintenance_time(self):
         """ Measure time from self.start and print a log message
         """
@@ -1912,6 +1920,50 @@ class Strategy(StrategyBase):
         """ Override pause() """
         pass
 
+    def get_runtime_state(self):
+        """ Override get_runtime_state() to checkpoint the virtual orders and the maintenance state
+        """
+        return {
+            'virtual_orders': [
+                {
+                    'price': order['price'],
+                    'base': [order['base']['amount'], order['base']['symbol']],
+                    'quote': [order['quote']['amount'], order['quote']['symbol']],
+                }
+                for order in self.virtual_orders
+            ],
+            'bootstrapping': self.bootstrapping,
+            'base_balance_history': self.base_balance_history,
+            'quote_balance_history': self.quote_balance_history,
+            'current_check_interval': self.current_check_interval,
+        }
+
+    def restore_runtime_state(self):
+        """ Restore the state checkpointed by the last run, see get_runtime_state()
+
+            :return bool: True if the state was restored, False if there was no usable checkpoint
+        """
+        state = self.load_checkpoint()
+        if state is None:
+            return False
+
+        for entry in state['virtual_orders']:
+            order = VirtualOrder()
+            order['price'] = entry['price']
+            order['base'] = Amount(*entry['base'], bitshares_instance=self.bitshares)
+            order['quote'] = Amount(*entry['quote'], bitshares_instance=self.bitshares)
+            order['for_sale'] = order['base']
+            self.virtual_orders.append(order)
+
+        self.virtual_orders_restored = True
+        self.bootstrapping = state['bootstrapping']
+        self.base_balance_history = state['base_balance_history']
+        self.quote_balance_history = state['quote_balance_history']
+        self.current_check_interval = state['current_check_interval']
+        self.log.info('Continuing with the orders on the market and {} virtual orders from the last run'.format(
+            len(self.virtual_orders)))
+        return True
+
     def purge(self):
         """ We are not cancelling orders on save/remove worker from the GUI
             TODO: don't work yet because worker removal is happening via BaseStrategy staticmethod
@@ -1919,10 +1971,8 @@ class Strategy(StrategyBase):
         pass
 
     def tick(self, d):
-        """ Ticks come in on every block """
-        if not (self.counter or 0) % 3:
-            self.maintain_strategy()
-        self.counter += 1
+        """ Ticks come in on every third block, see tick_blocks """
+        self.maintain_strategy()
 
 
 class VirtualOrder(dict):
@@ -41,6 +41,9 @@ class Strategy(StrategyBase):
         NOTE: Change this comment section to describe the strategy.
     """
 
+    # Check the orders every 3 blocks
+    tick_blocks = 3
+
     @classmethod
     def configure(cls, return_base_config=True):
         """ This function is used to auto generate fields for GUI
@@ -85,9 +88,6 @@ class Strategy(StrategyBase):
         """
         self.log.info("Initializing {}...".format(STRATEGY_NAME))
 
-        # Tick counter
-        self.counter = 0
-
         # Define Callbacks
         self.onMarketUpdate += self.maintain_strategy
         self.onAccount += self.maintain_strategy
@@ -161,10 +161,8 @@ class Strategy(StrategyBase):
         pass
 
     def tick(self, d):
-        """ Ticks come in on every block """
-        if not (self.counter or 0) % 3:
-            self.maintain_strategy()
-        self.counter += 1
+        """ Ticks come in on every third block, see tick_blocks """
+        self.maintain_strategy()
 
     def update_gui_slider(self):
         """ Updates GUI slider on the workers list """
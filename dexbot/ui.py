@@ -14,63 +14,71 @@ from dexbot.config import Config
 log = logging.getLogger(__name__)
 
 
-def verbose(f):
-    @click.pass_context
-    def new_func(ctx, *args, **kwargs):
+def configure_logging(verbose=0, systemd=False):
+    """ Set up the dexbot loggers
+
+        :param int verbose: Verbosity (0-15), above 4 enables the grapheneapi and above 8 the graphenebase logging
+        :param bool systemd: Leave out the timestamps, systemd adds them
+    """
+    verbosity = [
+        "critical", "error", "warn", "info", "debug"
+    ][int(min(verbose, 4))]
+    if systemd:
+        # Don't print the timestamps: systemd will log it for us
+        formatter1 = logging.Formatter('%(name)s - %(levelname)s - %(message)s')
+        formatter2 = logging.Formatter(
+            '%(worker_name)s using account %(account)s on %(market)s - %(levelname)s - %(message)s')
+    elif verbosity == "debug":
+        # When debugging: log where the log call came from
+        formatter1 = logging.Formatter('%(asctime)s (%(module)s:%(lineno)d) - %(levelname)s - %(message)s')
+        formatter2 = logging.Formatter(
+            '%(asctime)s (%(module)s:%(lineno)d) - %(worker_name)s - %(levelname)s - %(message)s')
+    else:
+        formatter1 = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+        formatter2 = logging.Formatter(
+            '%(asctime)s - %(worker_name)s using account %(account)s on %(market)s - %(levelname)s - %(message)s')
+
+    # Use special format for special workers logger
+    logger = logging.getLogger("dexbot.per_worker")
+    logger.setLevel(getattr(logging, verbosity.upper()))
+    ch = logging.StreamHandler()
+    ch.setFormatter(formatter2)
+    logger.addHandler(ch)
+
+    # Logging to a file
+    fh = logging.FileHandler('dexbot.log')
+    fh.setFormatter(formatter2)
+    logger.addHandler(fh)
+
+    logger.propagate = False  # Don't double up with root logger
+    # Set the root logger with basic format
+    ch = logging.StreamHandler()
+    ch.setFormatter(formatter1)
+    logging.getLogger("dexbot").addHandler(ch)
+    logging.getLogger("").handlers = []
+
+    # GrapheneAPI logging
+    if verbose > 4:
         verbosity = [
             "critical", "error", "warn", "info", "debug"
-        ][int(min(ctx.obj.get("verbose", 0), 4))]
-        if ctx.obj.get("systemd", False):
-            # Don't print the timestamps: systemd will log it for us
-            formatter1 = logging.Formatter('%(name)s - %(levelname)s - %(message)s')
-            formatter2 = logging.Formatter(
-                '%(worker_name)s using account %(account)s on %(market)s - %(levelname)s - %(message)s')
-        elif verbosity == "debug":
-            # When debugging: log where the log call came from
-            formatter1 = logging.Formatter('%(asctime)s (%(module)s:%(lineno)d) - %(levelname)s - %(message)s')
-            formatter2 = logging.Formatter(
-                '%(asctime)s (%(module)s:%(lineno)d) - %(worker_name)s - %(levelname)s - %(message)s')
-        else:
-            formatter1 = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-            formatter2 = logging.Formatter(
-                '%(asctime)s - %(worker_name)s using account %(account)s on %(market)s - %(levelname)s - %(message)s')
+        ][int(min(verbose - 4, 4))]
+        logger = logging.getLogger("grapheneapi")
+        logger.setLevel(getattr(logging, verbosity.upper()))
+        logger.addHandler(ch)
 
-        # Use special format for special workers logger
-        logger = logging.getLogger("dexbot.per_worker")
+    if verbose > 8:
+        verbosity = [
+            "critical", "error", "warn", "info", "debug"
+        ][int(min(verbose - 8, 4))]
+        logger = logging.getLogger("graphenebase")
         logger.setLevel(getattr(logging, verbosity.upper()))
-        ch = logging.StreamHandler()
-        ch.setFormatter(formatter2)
         logger.addHandler(ch)
 
-        # Logging to a file
-        fh = logging.FileHandler('dexbot.log')
-        fh.setFormatter(formatter2)
-        logger.addHandler(fh)
-
-        logger.propagate = False  # Don't double up with root logger
-        # Set the root logger with basic format
-        ch = logging.StreamHandler()
-        ch.setFormatter(formatter1)
-        logging.getLogger("dexbot").addHandler(ch)
-        logging.getLogger("").handlers = []
-
-        # GrapheneAPI logging
-        if ctx.obj["verbose"] > 4:
-            verbosity = [
-                "critical", "error", "warn", "info", "debug"
-            ][int(min(ctx.obj.get("verbose", 4) - 4, 4))]
-            logger = logging.getLogger("grapheneapi")
-            logger.setLevel(getattr(logging, verbosity.upper()))
-            logger.addHandler(ch)
-
-        if ctx.obj["verbose"] > 8:
-            verbosity = [
-                "critical", "error", "warn", "info", "debug"
-            ][int(min(ctx.obj.get("verbose", 8) - 8, 4))]
-            logger = logging.getLogger("graphenebase")
-            logger.setLevel(getattr(logging, verbosity.upper()))
-            logger.addHandler(ch)
 
+def verbose(f):
+    @click.pass_context
+    def new_func(ctx, *args, **kwargs):
+        configure_logging(ctx.obj.get("verbose", 0), ctx.obj.get("systemd", False))
         return ctx.invoke(f, *args, **kwargs)
     return update_wrapper(new_func, f)
 
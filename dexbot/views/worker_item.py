@@ -4,7 +4,7 @@ from .ui.worker_item_widget_ui import Ui_widget
 from .confirmation import ConfirmationDialog
 from .worker_details import WorkerDetailsView
 from .edit_worker import EditWorkerView
-from dexbot.storage import db_worker
+from dexbot.storage import Storage
 from dexbot.controllers.worker_controller import WorkerController
 from dexbot.views.errors import gui_error
 
@@ -42,13 +42,15 @@ class WorkerItemWidget(QtWidgets.QWidget, Ui_widget):
         strategies = WorkerController.get_strategies()
         self.set_worker_strategy(strategies[module]['name'])
 
-        profit = db_worker.get_item(worker_name, 'profit')
+        # Read through the cache, the running worker's latest values may not be in the database yet
+        storage = Storage(worker_name)
+        profit = storage['profit']
         if profit:
             self.set_worker_profit(profit)
         else:
             self.set_worker_profit(0)
 
-        percentage = db_worker.get_item(worker_name, 'slider')
+        percentage = storage['slider']
         if percentage:
             self.set_worker_slider(percentage)
         else:
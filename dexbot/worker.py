@@ -1,3 +1,5 @@
+import asyncio
+import functools
 import importlib
 import sys
 import logging
@@ -6,10 +8,18 @@ import threading
 import copy
 
 import dexbot.errors as errors
+from dexbot import metrics
+from dexbot.dispatcher import EVENT_QUEUE_DEPTH, InstanceLocks, WorkerInbox, create_dispatcher
+from dexbot.orderbook import order_books
+from dexbot.scheduler import TICK_MAX_LAG, TickScheduler
+from dexbot.stats import HANDLER_BUDGET, HandlerStats, count_rpc_calls
+from dexbot.storage import get_backend
 from dexbot.strategies.base import StrategyBase
 
 from bitshares import BitShares
+from bitshares.market import Market
 from bitshares.notify import Notify
+from bitshares.price import FilledOrder
 from bitshares.instance import shared_bitshares_instance
 
 log = logging.getLogger(__name__)
@@ -20,6 +30,33 @@ log_workers = logging.getLogger('dexbot.per_worker')
 # GUIs can add a handler to this logger to get a stream of events of the running workers.
 
 
+def market_key(market):
+    """ Returns a key identifying the market regardless of its orientation
+
+        :param market: Market, or any price like object such as an Order
+    """
+    return frozenset((market['base']['symbol'], market['quote']['symbol']))
+
+
+def event_targets(handler):
+    """ Returns the callables connected to an Events slot, or the handler itself if it is a plain method
+    """
+    return list(getattr(handler, 'targets', [handler]))
+
+
+def call_handler(handler, data):
+    """ Call the callables connected to an event outside the asyncio dispatch mode
+
+        :raises TypeError: If a callable is a coroutine function, it would never run
+    """
+    for target in event_targets(handler):
+        result = target(data)
+        if asyncio.iscoroutine(result):
+            result.close()
+            raise TypeError('{} is a coroutine, it only runs with dispatch_mode: asyncio'.format(
+                getattr(target, '__qualname__', target)))
+
+
 class WorkerInfrastructure(threading.Thread):
 
     def __init__(
@@ -39,8 +76,39 @@ class WorkerInfrastructure(threading.Thread):
         self.config_lock = threading.RLock()
         self.workers = {}
 
+        # Runs the event handlers of the workers, see dexbot.dispatcher
+        self.dispatcher = create_dispatcher(self.config)
+        # Handlers of workers sharing a BitShares instance take turns
+        self.instance_locks = InstanceLocks()
+        # BitShares instances of the accounts when handlers run in parallel, see account_instance()
+        self.account_instances = {}
+        # Connection looking up block headers when handlers run in parallel, see block_header()
+        self.header_instance = None
+        # Events waiting to be handled by name of the worker
+        self.inboxes = {}
+        self.event_queue_depth = int(self.config.get('event_queue_depth', EVENT_QUEUE_DEPTH))
+        # Decides which workers tick on a block, see the tick_* attributes of StrategyBase
+        self.scheduler = TickScheduler(float(self.config.get('tick_max_lag', TICK_MAX_LAG)), self.block_header)
+
+        # Handler latencies and RPC calls, shown by dexbot-cli stats
+        self.stats = HandlerStats(
+            budget=float(self.config.get('handler_budget', HANDLER_BUDGET)),
+            profile=bool(self.config.get('handler_profile', False))
+        )
+        count_rpc_calls(self.bitshares)
+
+        metrics.EVENT_QUEUE_DEPTH.set_callback(lambda: self._queue_metric('depth'))
+
         self.accounts = set()
         self.markets = set()
+        # Markets and accounts the notification instance is subscribed to
+        self.subscribed_markets = set()
+        self.subscribed_accounts = set()
+
+        # Names of the running workers by market key (see market_key()) and by account name, rebuilt by
+        # update_routes() whenever workers are added or stopped
+        self.market_workers = {}
+        self.account_workers = {}
 
         # Set the module search path
         user_worker_path = os.path.expanduser("~/bots")
@@ -50,39 +118,92 @@ class WorkerInfrastructure(threading.Thread):
     def init_workers(self, config):
         """ Initialize the workers
         """
-        self.config_lock.acquire()
-        for worker_name, worker in config["workers"].items():
-            if "account" not in worker:
-                log_workers.critical("Worker has no account", extra={
-                    'worker_name': worker_name, 'account': 'unknown',
-                    'market': 'unknown', 'is_disabled': (lambda: True)
-                })
-                continue
-            if "market" not in worker:
-                log_workers.critical("Worker has no market", extra={
-                    'worker_name': worker_name, 'account': worker['account'],
-                    'market': 'unknown', 'is_disabled': (lambda: True)
-                })
-                continue
+        with self.config_lock:
+            for worker_name in config["workers"]:
+                self.init_worker(worker_name, config)
+            self.update_routes()
+
+    def init_worker(self, worker_name, config):
+        """ Initialize a single worker
+
+            :param str worker_name: Name of the worker
+            :param dict config: dexbot config containing the worker
+        """
+        worker = config["workers"][worker_name]
+        if "account" not in worker:
+            log_workers.critical("Worker has no account", extra={
+                'worker_name': worker_name, 'account': 'unknown',
+                'market': 'unknown', 'is_disabled': (lambda: True)
+            })
+            return
+        if "market" not in worker:
+            log_workers.critical("Worker has no market", extra={
+                'worker_name': worker_name, 'account': worker['account'],
+                'market': 'unknown', 'is_disabled': (lambda: True)
+            })
+            return
+        try:
+            strategy_class = getattr(
+                importlib.import_module(worker["module"]),
+                'Strategy'
+            )
+            self.workers[worker_name] = strategy_class(
+                config=config,
+                name=worker_name,
+                bitshares_instance=self.account_instance(worker['account']),
+                view=self.view
+            )
+        except BaseException:
+            log_workers.exception("Worker initialisation", extra={
+                'worker_name': worker_name, 'account': worker['account'],
+                'market': 'unknown', 'is_disabled': (lambda: True)
+            })
+
+    def account_instance(self, account):
+        """ Returns the BitShares instance used by the workers of the account
+
+            When the dispatcher runs handlers in parallel every account gets its own instance, with its own RPC
+            connection and transaction buffer, so workers of different accounts never share one. Workers of the same
+            account share their account's instance and take turns, see InstanceLocks. Without the account's key in
+            the wallet its workers use the shared instance.
+
+            :param str account: Name of the account
+        """
+        if not self.dispatcher.is_parallel:
+            return self.bitshares
+
+        instance = self.account_instances.get(account)
+        if instance is None:
             try:
-                strategy_class = getattr(
-                    importlib.import_module(worker["module"]),
-                    'Strategy'
-                )
-                self.workers[worker_name] = strategy_class(
-                    config=config,
-                    name=worker_name,
-                    bitshares_instance=self.bitshares,
-                    view=self.view
-                )
-                self.markets.add(worker['market'])
-                self.accounts.add(worker['account'])
-            except BaseException:
-                log_workers.exception("Worker initialisation", extra={
-                    'worker_name': worker_name, 'account': worker['account'],
-                    'market': 'unknown', 'is_disabled': (lambda: True)
-                })
-        self.config_lock.release()
+                key = self.bitshares.wallet.getActiveKeyForAccount(account)
+                instance = BitShares(self.config['node'], keys=[key], num_retries=-1)
+                count_rpc_calls(instance)
+            except Exception:
+                log.warning('Could not create a BitShares instance for account {}, its workers share the instance '
+                            'of the notifications and take turns with the other workers using it'.format(account))
+                instance = self.bitshares
+            self.account_instances[account] = instance
+        return instance
+
+    def update_routes(self):
+        """ Rebuild the subscribed markets and accounts and the indexes routing their events to the workers
+        """
+        with self.config_lock:
+            market_workers = {}
+            account_workers = {}
+            for worker_name, worker in self.workers.items():
+                market_workers.setdefault(market_key(worker.market), []).append(worker_name)
+                account_workers.setdefault(self.config['workers'][worker_name]['account'], []).append(worker_name)
+
+            self.markets = {self.config['workers'][worker_name]['market'] for worker_name in self.workers}
+            self.accounts = set(account_workers)
+            self.market_workers = market_workers
+            self.account_workers = account_workers
+            self.inboxes = {
+                worker_name: self.inboxes.get(worker_name) or WorkerInbox(
+                    self.event_queue_depth, worker_name=worker_name)
+                for worker_name in self.workers
+            }
 
     def update_notify(self):
         if not self.config['workers']:
@@ -93,7 +214,7 @@ class WorkerInfrastructure(threading.Thread):
             raise errors.NoWorkersAvailable()
         if self.notify:
             # Update the notification instance
-            self.notify.reset_subscriptions(list(self.accounts), list(self.markets))
+            self.update_subscriptions()
         else:
             # Initialize the notification instance
             self.notify = Notify(
@@ -104,72 +225,263 @@ class WorkerInfrastructure(threading.Thread):
                 on_block=self.on_block,
                 bitshares_instance=self.bitshares
             )
+            self.subscribed_markets = set(self.markets)
+            self.subscribed_accounts = set(self.accounts)
+
+        # Keep the order books of the subscribed markets up to date from their notifications, the book keys are the
+        # market keys
+        order_books.track(set(self.market_workers))
+
+    def update_subscriptions(self):
+        """ Subscribe to the markets and accounts of new workers and unsubscribe from markets no longer used
+
+            Only the difference is sent over the open websocket. reset_subscriptions() would cancel all subscriptions
+            and subscribe to every market and account again, stalling all workers meanwhile, so it is only the
+            fallback when sending the difference fails. The lists of the websocket are kept up to date, so a reconnect
+            subscribes to the current set.
+        """
+        with self.config_lock:
+            markets = set(self.markets)
+            accounts = set(self.accounts)
+        websocket = self.notify.websocket
+
+        # Workers may use the shared instance for their transactions meanwhile
+        with self.instance_locks.get(self.bitshares):
+            self._update_subscriptions(websocket, markets, accounts)
+
+        self.subscribed_markets = markets
+        self.subscribed_accounts = accounts
+
+    def _update_subscriptions(self, websocket, markets, accounts):
+        try:
+            callback = websocket.__events__.index('on_market')
+            for market_name in markets - self.subscribed_markets:
+                market = Market(market_name, bitshares_instance=self.bitshares)
+                market_ids = [market['base']['id'], market['quote']['id']]
+                websocket.subscribe_to_market(callback, *market_ids)
+                websocket.subscription_markets.append(market_ids)
+            for market_name in self.subscribed_markets - markets:
+                market = Market(market_name, bitshares_instance=self.bitshares)
+                market_ids = [market['base']['id'], market['quote']['id']]
+                websocket.unsubscribe_from_market(*market_ids)
+                if market_ids in websocket.subscription_markets:
+                    websocket.subscription_markets.remove(market_ids)
+
+            new_accounts = list(accounts - self.subscribed_accounts)
+            if new_accounts:
+                websocket.get_full_accounts(new_accounts, True)
+                websocket.subscription_accounts.extend(new_accounts)
+            # There is no call to unsubscribe from a single account, notifications of accounts without workers
+            # are dropped by on_account() until the next reconnect
+            for account in self.subscribed_accounts - accounts:
+                if account in websocket.subscription_accounts:
+                    websocket.subscription_accounts.remove(account)
+        except Exception:
+            log.exception('Updating the subscriptions failed, resubscribing everything')
+            self.notify.reset_subscriptions(list(accounts), list(markets))
+
+    def block_header(self, block_num):
+        """ Returns the header of a block, used by the scheduler to know how late the block arrived
+
+            When the dispatcher runs handlers in parallel they may be using the shared instance. The header is then
+            fetched over a connection of its own, so the notifications never wait for a handler.
+        """
+        if not self.dispatcher.is_parallel:
+            # The handlers run on this thread
+            return self.bitshares.rpc.get_block_header(block_num)
+
+        if self.header_instance is None:
+            # Don't retry, the block's lag is unknown then and the next block tries again
+            self.header_instance = BitShares(self.config['node'], num_retries=0)
+        return self.header_instance.rpc.get_block_header(block_num)
 
     # Events
     def on_block(self, data):
         if self.jobs:
+            # Jobs may change the workers, let the handlers still running finish first
+            self.dispatcher.wait_idle()
             try:
                 for job in self.jobs:
                     job()
             finally:
                 self.jobs = set()
 
+        self.stats.save_if_due()
+        # Orders may have been placed, filled or cancelled, the workers fetch the order books again
+        order_books.invalidate()
+        if not self.scheduler.new_block(data):
+            return
+
         self.config_lock.acquire()
-        for worker_name, worker in self.config["workers"].items():
-            if worker_name not in self.workers or self.workers[worker_name].disabled:
+        for worker_name, worker in self.workers.items():
+            if worker.disabled or not self.scheduler.is_due(worker_name, worker):
                 continue
-            try:
-                self.workers[worker_name].ontick(data)
-            except Exception as e:
-                self.workers[worker_name].log.exception("in ontick()")
-                try:
-                    self.workers[worker_name].error_ontick(e)
-                except Exception:
-                    self.workers[worker_name].log.exception("in error_ontick()")
+            self.post_event(worker_name, 'block', 'ontick', 'error_ontick', data)
         self.config_lock.release()
 
     def on_market(self, data):
         if data.get("deleted", False):  # No info available on deleted orders
+            # The order was filled or cancelled, only its id is known
+            order_books.remove_order(data.get('id'))
+            return
+
+        try:
+            key = market_key(data)
+        except (KeyError, TypeError):
+            log.debug('Market notification without a market: {}'.format(data))
             return
+        if order_books.is_tracked(key):
+            order_books.update_order(key, data)
+        else:
+            order_books.invalidate(key)
 
+        # Filled orders are the last market events dropped from a full inbox, see WorkerInbox
+        kind = 'fill' if isinstance(data, FilledOrder) else 'market'
         self.config_lock.acquire()
-        for worker_name, worker in self.config["workers"].items():
+        for worker_name in self.market_workers.get(key, ()):
             if self.workers[worker_name].disabled:
                 self.workers[worker_name].log.debug('Worker "{}" is disabled'.format(worker_name))
                 continue
-            if worker["market"] == data.market:
-                try:
-                    self.workers[worker_name].onMarketUpdate(data)
-                except Exception as e:
-                    self.workers[worker_name].log.exception("in onMarketUpdate()")
-                    try:
-                        self.workers[worker_name].error_onMarketUpdate(e)
-                    except Exception:
-                        self.workers[worker_name].log.exception("in error_onMarketUpdate()")
+            self.scheduler.on_change(worker_name)
+            self.post_event(worker_name, kind, 'onMarketUpdate', 'error_onMarketUpdate', data)
         self.config_lock.release()
 
     def on_account(self, account_update):
         self.config_lock.acquire()
         account = account_update.account
-        for worker_name, worker in self.config["workers"].items():
+        for worker_name in self.account_workers.get(account["name"], ()):
             if self.workers[worker_name].disabled:
                 self.workers[worker_name].log.info('Worker "{}" is disabled'.format(worker_name))
                 continue
-            if worker["account"] == account["name"]:
-                try:
-                    self.workers[worker_name].onAccount(account_update)
-                except Exception as e:
-                    self.workers[worker_name].log.exception("in onAccountUpdate()")
-                    try:
-                        self.workers[worker_name].error_onAccount(e)
-                    except Exception:
-                        self.workers[worker_name].log.exception("in error_onAccountUpdate()")
+            self.scheduler.on_change(worker_name)
+            self.post_event(worker_name, 'account', 'onAccount', 'error_onAccount', account_update)
         self.config_lock.release()
 
+    def post_event(self, worker_name, kind, handler, error_handler, data):
+        """ Queue an event in the worker's inbox and make sure the inbox gets processed
+
+            :param str worker_name: Name of the worker
+            :param str kind: Kind of the event, see WorkerInbox
+            :param str handler: Name of the worker's method handling the event
+            :param str error_handler: Name of the worker's method handling exceptions raised by the handler
+            :param data: Event data
+        """
+        metrics.EVENTS.inc(worker=worker_name, kind=kind)
+        inbox = self.inboxes.get(worker_name)
+        if inbox is not None and inbox.put(kind, (handler, error_handler, data)):
+            if self.dispatcher.is_async:
+                self.dispatcher.dispatch(worker_name, self.process_inbox_async, worker_name)
+            else:
+                self.dispatcher.dispatch(worker_name, self.process_inbox, worker_name)
+
+    def process_inbox(self, worker_name):
+        """ Handle the oldest event waiting in the worker's inbox, then continue with the next one
+
+            The next event is dispatched instead of handled in a loop, so the dispatcher can run other workers in
+            between.
+        """
+        inbox = self.inboxes.get(worker_name)
+        if inbox is None:
+            return
+
+        event = inbox.get()
+        if event is None:
+            return
+
+        self.handle_event(worker_name, *event)
+        self.dispatcher.dispatch(worker_name, self.process_inbox, worker_name)
+
+    async def process_inbox_async(self, worker_name):
+        """ Coroutine variant of process_inbox() used with the asyncio dispatcher
+        """
+        inbox = self.inboxes.get(worker_name)
+        if inbox is None:
+            return
+
+        event = inbox.get()
+        if event is None:
+            return
+
+        await self.handle_event_async(worker_name, *event)
+        self.dispatcher.dispatch(worker_name, self.process_inbox_async, worker_name)
+
+    def queue_stats(self):
+        """ Returns the event counters and queue depth of every worker's inbox, see WorkerInbox.stats()
+        """
+        return {worker_name: inbox.stats() for worker_name, inbox in list(self.inboxes.items())}
+
+    def _queue_metric(self, name):
+        return {(worker_name,): stats[name] for worker_name, stats in self.queue_stats().items()}
+
+    def handle_event(self, worker_name, handler, error_handler, data):
+        """ Call an event handler of the worker, passing exceptions to its error handler
+
+            :param str worker_name: Name of the worker
+            :param str handler: Name of the worker's method handling the event
+            :param str error_handler: Name of the worker's method handling exceptions raised by the handler
+            :param data: Event data
+        """
+        worker = self.workers.get(worker_name)
+        # The worker may have been stopped or disabled while the event was queued
+        if worker is None or worker.disabled:
+            return
+
+        with self.instance_locks.get(worker.bitshares):
+            # Balances and orders are fetched again once for the new event
+            worker.invalidate_account()
+            try:
+                with self.stats.measure(worker_name, handler, worker.log):
+                    call_handler(getattr(worker, handler), data)
+            except Exception as e:
+                metrics.HANDLER_ERRORS.inc(worker=worker_name, event=handler)
+                worker.log.exception("in {}()".format(handler))
+                try:
+                    call_handler(getattr(worker, error_handler), e)
+                except Exception:
+                    worker.log.exception("in {}()".format(error_handler))
+
+    async def handle_event_async(self, worker_name, handler, error_handler, data):
+        """ Coroutine variant of handle_event()
+
+            The callables connected to the worker's event are called one by one through the dispatcher: coroutine
+            functions are awaited on the event loop, plain functions run in the executor.
+        """
+        worker = self.workers.get(worker_name)
+        if worker is None or worker.disabled:
+            return
+
+        await self.instance_locks.acquire_async(worker.bitshares)
+        try:
+            worker.invalidate_account()
+            try:
+                # The handlers of other workers run on the same thread meanwhile, they can't be profiled separately
+                # and their RPC calls are counted where they are made, on the executor threads
+                with self.stats.measure(worker_name, handler, worker.log, profile=False,
+                                        count_thread=False) as measurement:
+                    worker.handler_measurement = measurement
+                    for target in event_targets(getattr(worker, handler)):
+                        if not asyncio.iscoroutinefunction(target):
+                            target = functools.partial(measurement.run, target)
+                        await self.dispatcher.call(target, data)
+            except Exception as e:
+                metrics.HANDLER_ERRORS.inc(worker=worker_name, event=handler)
+                worker.log.exception("in {}()".format(handler))
+                try:
+                    for target in event_targets(getattr(worker, error_handler)):
+                        await self.dispatcher.call(target, e)
+                except Exception:
+                    worker.log.exception("in {}()".format(error_handler))
+        finally:
+            worker.handler_measurement = None
+            self.instance_locks.release_async(worker.bitshares)
+
     def add_worker(self, worker_name, config):
+        """ Start a worker next to the running ones, only subscribing to its market and account if needed
+        """
         with self.config_lock:
             self.config['workers'][worker_name] = config['workers'][worker_name]
-            self.init_workers(config)
+            self.init_worker(worker_name, config)
+            self.update_routes()
         self.update_notify()
 
     def run(self):
@@ -184,27 +496,29 @@ class WorkerInfrastructure(threading.Thread):
             :param bool pause: optional argument which tells worker if it was stopped or just paused
         """
         if worker_name:
-            try:
-                # Kill only the specified worker
-                self.remove_market(worker_name)
-            except KeyError:
-                # Worker was not found meaning it does not exist or it is paused already
-                return
-
             with self.config_lock:
-                account = self.config['workers'][worker_name]['account']
+                if worker_name not in self.config['workers']:
+                    # Worker was not found meaning it does not exist or it is paused already
+                    return
                 self.config['workers'].pop(worker_name)
+                worker = self.workers.pop(worker_name, None)
+                self.update_routes()
+            self.scheduler.remove_worker(worker_name)
 
-            self.accounts.remove(account)
-            if pause:
-                self.workers[worker_name].pause()
-            self.workers.pop(worker_name, None)
+            self.dispatcher.wait_idle(worker_name)
+            if pause and worker:
+                self.pause_worker(worker)
         else:
             # Kill all of the workers
+            with self.config_lock:
+                workers = self.workers
+                self.workers = {}
+                self.update_routes()
+
+            self.dispatcher.wait_idle()
             if pause:
-                for worker in self.workers:
-                    self.workers[worker].pause()
-                self.workers = []
+                for worker in workers.values():
+                    self.pause_worker(worker)
 
         # Update other workers
         if len(self.workers) > 0:
@@ -212,25 +526,29 @@ class WorkerInfrastructure(threading.Thread):
         else:
             # No workers left, close websocket
             self.notify.websocket.close()
+            self.dispatcher.shutdown()
+            # Make sure the checkpoints and other pending writes hit the disk before the process exits
+            get_backend().flush()
+            self.stats.remove()
+
+    def pause_worker(self, worker):
+        """ Checkpoint the runtime state of a stopped worker and pause it, see StrategyBase.save_checkpoint()
+        """
+        with self.instance_locks.get(worker.bitshares):
+            try:
+                worker.save_checkpoint()
+            except Exception:
+                worker.log.exception('Checkpointing the runtime state failed')
+            worker.pause()
 
     def remove_worker(self, worker_name=None):
         if worker_name:
-            self.workers[worker_name].purge()
+            workers = [self.workers[worker_name]]
         else:
-            for worker in self.workers:
-                self.workers[worker].purge()
-
-    def remove_market(self, worker_name):
-        """ Remove the market only if the worker is the only one using it
-        """
-        with self.config_lock:
-            market = self.config['workers'][worker_name]['market']
-            for name, worker in self.config['workers'].items():
-                if market == worker['market']:
-                    break  # Found the same market, do nothing
-            else:
-                # No markets found, safe to remove
-                self.markets.remove(market)
+            workers = list(self.workers.values())
+        for worker in workers:
+            with self.instance_locks.get(worker.bitshares):
+                worker.purge()
 
     @staticmethod
     def remove_offline_worker(config, worker_name, bitshares_instance):
@@ -0,0 +1,126 @@
+import random
+
+import pytest
+
+from dexbot import depth
+from dexbot.depth import MarketDepth, market_depth
+
+"""
+Unit tests of the order book depth pricing, on the NumPy and on the list path.
+"""
+
+MARKET = {'base': {'id': '1.3.0', 'precision': 5}, 'quote': {'id': '1.3.1', 'precision': 4}}
+
+
+@pytest.fixture(params=['lists', 'numpy'])
+def arrays(request, monkeypatch):
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(depth, 'numpy', None)
+    return request.param
+
+
+def walk(orders, amount, by_base):
+    """ The order by order walk the depth pricing replaced, orders are (base, quote, price)
+    """
+    base_amount = quote_amount = 0
+    missing = amount
+    for base, quote, price in orders:
+        filled = base if by_base else quote
+        if filled <= missing:
+            base_amount += base
+            quote_amount += quote
+            missing -= filled
+        elif by_base:
+            base_amount += missing
+            quote_amount += missing / price
+            break
+        else:
+            base_amount += missing * price
+            quote_amount += missing
+            break
+    return base_amount / quote_amount
+
+
+def limit_order(number, sold, received, for_sale, sell_amount, receive_amount):
+    return {
+        'id': '1.7.{}'.format(number),
+        'for_sale': for_sale,
+        'sell_price': {
+            'base': {'amount': sell_amount, 'asset_id': sold},
+            'quote': {'amount': receive_amount, 'asset_id': received},
+        },
+    }
+
+
+def random_book(rng, size):
+    orders = []
+    for number in range(size):
+        sold, received = rng.choice([('1.3.0', '1.3.1'), ('1.3.1', '1.3.0')])
+        sell_amount = rng.randint(1, 10 ** 8)
+        orders.append(limit_order(number, sold, received, rng.randint(1, sell_amount), sell_amount,
+                                  rng.randint(1, 10 ** 8)))
+    return orders
+
+
+def expected_side(orders, side):
+    """ Amounts of the orders of one side in the market's terms, like the Order objects built by the strategies
+    """
+    sold = '1.3.0' if side == 'buy' else '1.3.1'
+    result = []
+    for order in orders:
+        sell_price = order['sell_price']
+        if sell_price['base']['asset_id'] != sold:
+            continue
+        received = order['for_sale'] * sell_price['quote']['amount'] / sell_price['base']['amount']
+        if side == 'buy':
+            base, quote = order['for_sale'] / 10 ** 5, received / 10 ** 4
+        else:
+            base, quote = received / 10 ** 5, order['for_sale'] / 10 ** 4
+        result.append((base, quote, base / quote))
+    return result
+
+
+def test_fill_price_matches_the_order_walk(arrays):
+    rng = random.Random(1)
+    for _ in range(200):
+        orders = random_book(rng, rng.randint(1, 200))
+        for side in ('buy', 'sell'):
+            side_depth = market_depth(orders, MARKET, side)
+            reference = expected_side(orders, side)
+            assert len(side_depth) == len(reference)
+            if not reference:
+                assert side_depth.fill_price(1) is None
+                continue
+
+            for by_base in (True, False):
+                total = sum(order[0 if by_base else 1] for order in reference)
+                for amount in (total * rng.random(), total * 2, reference[0][0 if by_base else 1]):
+                    assert side_depth.fill_price(amount, by_base) == pytest.approx(walk(reference, amount, by_base))
+
+
+def test_partial_and_exhausted_fills(arrays):
+    # Two orders: 10 QUOTE at 2, then 10 QUOTE at 3
+    side_depth = MarketDepth([2.0, 3.0], [20.0, 30.0], [10.0, 10.0])
+    assert side_depth.best_price == 2.0
+    assert side_depth.fill_price(5) == pytest.approx(2.0)
+    assert side_depth.fill_price(15) == pytest.approx((20 + 15) / 15)
+    assert side_depth.fill_price(20, by_base=True) == pytest.approx(2.0)
+    # More than the side holds: the average of the whole side
+    assert side_depth.fill_price(100) == pytest.approx(50 / 20)
+
+
+def test_excluded_and_empty(arrays):
+    orders = [
+        limit_order(1, '1.3.0', '1.3.1', 100000, 100000, 10000),
+        limit_order(2, '1.3.0', '1.3.1', 100000, 200000, 10000),
+    ]
+    bids = market_depth(orders, MARKET, 'buy', exclude_ids={'1.7.1'})
+    assert len(bids) == 1
+    assert bids.best_price == pytest.approx(2.0)
+
+    asks = market_depth(orders, MARKET, 'sell')
+    assert len(asks) == 0
+    assert asks.best_price is None
+    assert asks.fill_price(1) is None
@@ -0,0 +1,150 @@
+import asyncio
+import threading
+import time
+
+from dexbot.dispatcher import AsyncioDispatcher, InstanceLocks, ThreadPoolDispatcher, WorkerInbox
+
+"""
+Unit tests of the worker inbox and the dispatchers.
+"""
+
+
+def drain(inbox):
+    events = []
+    while True:
+        event = inbox.get()
+        if event is None:
+            return events
+        events.append(event)
+
+
+def test_ticks_and_account_updates_are_coalesced():
+    inbox = WorkerInbox()
+    assert inbox.put('account', 'account 1')
+    assert not inbox.put('block', 'block 1')
+    inbox.put('account', 'account 2')
+    inbox.put('block', 'block 2')
+
+    # The latest event keeps the place of the first one of its kind
+    assert drain(inbox) == ['account 2', 'block 2']
+    assert inbox.stats()['coalesced'] == 2
+    # Empty inbox asks to be scheduled again
+    assert inbox.put('account', 'account 3')
+
+
+def test_market_events_are_all_delivered():
+    inbox = WorkerInbox()
+    for index in range(5):
+        inbox.put('market', 'order {}'.format(index))
+    assert drain(inbox) == ['order {}'.format(index) for index in range(5)]
+
+
+def test_full_inbox_drops_the_oldest_event_but_fills():
+    inbox = WorkerInbox(max_depth=3)
+    inbox.put('fill', 'filled')
+    inbox.put('market', 'placed 1')
+    inbox.put('market', 'placed 2')
+    inbox.put('block', 'block 1')
+    inbox.put('account', 'account 1')
+    assert drain(inbox) == ['filled', 'block 1', 'account 1']
+    assert inbox.stats()['dropped'] == 2
+
+
+def test_inbox_full_of_fills_stays_bounded():
+    inbox = WorkerInbox(max_depth=2)
+    for index in range(4):
+        inbox.put('fill', index)
+    assert inbox.stats()['dropped'] == 2
+    assert inbox.stats()['max_depth'] == 2
+    assert drain(inbox) == [2, 3]
+
+
+def test_thread_pool_serializes_handlers_per_worker():
+    dispatcher = ThreadPoolDispatcher(max_threads=4)
+    lock = threading.Lock()
+    calls = {'worker 1': [], 'worker 2': []}
+    running = {'worker 1': 0, 'worker 2': 0}
+    overlaps = []
+    parallel = []
+
+    def handler(worker_name, index):
+        with lock:
+            running[worker_name] += 1
+            if running[worker_name] > 1:
+                overlaps.append((worker_name, index))
+            if all(running.values()):
+                parallel.append(index)
+        time.sleep(0.01)
+        with lock:
+            calls[worker_name].append(index)
+            running[worker_name] -= 1
+
+    for index in range(10):
+        dispatcher.dispatch('worker 1', handler, 'worker 1', index)
+        dispatcher.dispatch('worker 2', handler, 'worker 2', index)
+    assert dispatcher.wait_idle('worker 1', timeout=5)
+    assert calls['worker 1'] == list(range(10))
+    assert dispatcher.wait_idle(timeout=5)
+    dispatcher.shutdown()
+
+    assert calls['worker 2'] == list(range(10))
+    assert not overlaps
+    # Handlers of different workers run at the same time
+    assert parallel
+
+
+def test_wait_idle_times_out_on_a_busy_worker():
+    dispatcher = ThreadPoolDispatcher()
+    release = threading.Event()
+    dispatcher.dispatch('worker', release.wait)
+    assert not dispatcher.wait_idle('worker', timeout=0.05)
+    # Other workers are idle
+    assert dispatcher.wait_idle('other', timeout=0.05)
+    release.set()
+    assert dispatcher.wait_idle(timeout=5)
+    dispatcher.shutdown()
+
+
+def test_coroutines_sharing_an_instance_take_turns():
+    dispatcher = AsyncioDispatcher()
+    locks = InstanceLocks()
+    instance = object()
+    running = []
+    overlaps = []
+
+    async def handler(name):
+        await locks.acquire_async(instance)
+        try:
+            if running:
+                overlaps.append(name)
+            running.append(name)
+            await asyncio.sleep(0.01)
+            running.remove(name)
+        finally:
+            locks.release_async(instance)
+
+    for name in ('worker 1', 'worker 2', 'worker 3'):
+        dispatcher.dispatch(name, handler, name)
+    assert dispatcher.wait_idle(timeout=5)
+    dispatcher.shutdown()
+    assert not overlaps
+
+
+def test_coroutines_wait_for_a_thread_holding_the_instance():
+    dispatcher = AsyncioDispatcher()
+    locks = InstanceLocks()
+    instance = object()
+    order = []
+
+    async def handler():
+        await locks.acquire_async(instance)
+        order.append('coroutine')
+        locks.release_async(instance)
+
+    with locks.get(instance):
+        dispatcher.dispatch('worker', handler)
+        time.sleep(0.05)
+        order.append('thread')
+    assert dispatcher.wait_idle(timeout=5)
+    dispatcher.shutdown()
+    assert order == ['thread', 'coroutine']
@@ -0,0 +1,47 @@
+import time
+
+from dexbot import metrics
+from dexbot.dispatcher import WorkerInbox
+from dexbot.scheduler import TickScheduler
+
+"""
+Unit tests of the metrics exported in the Prometheus text format.
+"""
+
+
+def block_lag_sample():
+    for line in metrics.expose().splitlines():
+        if line.startswith('dexbot_block_lag_seconds '):
+            return line.split(' ')[1]
+    return None
+
+
+def test_block_lag_is_exported_after_a_block():
+    produced = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(time.time() - 5))
+    scheduler = TickScheduler(block_header=lambda number: {'timestamp': produced})
+    scheduler.new_block('{:08x}'.format(1000) + '00' * 16)
+    assert 4 <= float(block_lag_sample()) < 60
+
+
+def test_unknown_block_lag_is_exported_as_nan():
+    scheduler = TickScheduler()
+    scheduler.new_block('{:08x}'.format(1000) + '00' * 16)
+    assert block_lag_sample() == 'NaN'
+
+
+def sample(name, worker):
+    for line in metrics.expose().splitlines():
+        if line.startswith('{}{{worker="{}"}} '.format(name, worker)):
+            return float(line.split(' ')[1])
+    return 0
+
+
+def test_inbox_counters_keep_counting_for_a_restarted_worker():
+    for _ in range(2):
+        # The worker gets a new inbox when it is started again
+        inbox = WorkerInbox(max_depth=1, worker_name='restarted')
+        inbox.put('account', 'account 1')
+        inbox.put('account', 'account 2')
+        inbox.put('block', 'block 1')
+    assert sample('dexbot_events_coalesced_total', 'restarted') == 2
+    assert sample('dexbot_events_dropped_total', 'restarted') == 2
@@ -0,0 +1,135 @@
+import threading
+import time
+
+from dexbot.orderbook import LocalOrderBook, OrderBookCache, book_key, sort_key
+
+"""
+Unit tests of the order book cache shared by the workers, with a fake node.
+"""
+
+BASE = '1.3.0'
+QUOTE = '1.3.1'
+MARKET = {'base': {'id': BASE, 'symbol': 'BASE'}, 'quote': {'id': QUOTE, 'symbol': 'QUOTE'}}
+KEY = book_key('BASE', 'QUOTE')
+
+
+def limit_order(number, sold, price, for_sale=1000):
+    received = QUOTE if sold == BASE else BASE
+    return {
+        'id': '1.7.{}'.format(number),
+        'for_sale': for_sale,
+        'sell_price': {
+            'base': {'amount': 1000, 'asset_id': sold},
+            'quote': {'amount': int(price * 1000), 'asset_id': received},
+        },
+    }
+
+
+class Node:
+    """ Keeps all orders like the node and answers get_limit_orders()
+    """
+
+    def __init__(self, orders=(), delay=0):
+        self.orders = {order['id']: order for order in orders}
+        self.delay = delay
+        self.fetches = 0
+        self.rpc = self
+
+    def get_limit_orders(self, base_id, quote_id, limit):
+        self.fetches += 1
+        time.sleep(self.delay)
+        result = []
+        for asset_id in (base_id, quote_id):
+            side = [order for order in self.orders.values() if order['sell_price']['base']['asset_id'] == asset_id]
+            result.extend(sorted(side, key=sort_key)[:limit])
+        return result
+
+
+def ids(orders):
+    return [order['id'] for order in orders]
+
+
+def test_local_book_keeps_the_sides_sorted():
+    book = LocalOrderBook(BASE, QUOTE)
+    book.seed([limit_order(1, BASE, 2.0), limit_order(2, QUOTE, 1.0)], depth=10)
+    book.update(limit_order(3, BASE, 1.5))
+    book.update(limit_order(4, QUOTE, 0.5))
+    assert ids(book.get_limit_orders(BASE, QUOTE, 10)) == ['1.7.3', '1.7.1', '1.7.4', '1.7.2']
+
+    # A changed order moves to its new place, a filled one disappears
+    book.update(limit_order(1, BASE, 1.0))
+    assert book.remove('1.7.4')
+    assert not book.remove('1.7.4')
+    assert ids(book.get_limit_orders(BASE, QUOTE, 10)) == ['1.7.1', '1.7.3', '1.7.2']
+    # Orders of other markets are not taken
+    assert not book.update(limit_order(5, '1.3.9', 1.0))
+
+
+def test_local_book_knows_only_the_seeded_part_of_a_full_side():
+    book = LocalOrderBook(BASE, QUOTE)
+    book.seed([limit_order(number, BASE, number) for number in range(1, 4)], depth=3)
+    assert book.get_limit_orders(BASE, QUOTE, 3) is not None
+    assert book.get_limit_orders(BASE, QUOTE, 4) is None
+
+    # Beyond the worst seeded order there may be unknown orders, such an order isn't taken
+    book.update(limit_order(9, BASE, 10.0))
+    assert '1.7.9' not in book.orders
+    book.remove('1.7.3')
+    assert book.get_limit_orders(BASE, QUOTE, 3) is None
+
+
+def test_cache_shares_one_fetch():
+    node = Node([limit_order(1, BASE, 1.0)], delay=0.05)
+    cache = OrderBookCache()
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(cache.get_limit_orders(node, MARKET, 5)))
+        for _ in range(5)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert node.fetches == 1
+    assert all(ids(result) == ['1.7.1'] for result in results)
+
+
+def test_cache_is_refetched_after_invalidation():
+    node = Node([limit_order(1, BASE, 1.0)])
+    cache = OrderBookCache()
+    cache.get_limit_orders(node, MARKET, 5)
+    cache.get_limit_orders(node, MARKET, 5)
+    assert node.fetches == 1
+
+    node.orders['1.7.2'] = limit_order(2, BASE, 0.5)
+    cache.invalidate(KEY)
+    assert ids(cache.get_limit_orders(node, MARKET, 5)) == ['1.7.2', '1.7.1']
+    assert node.fetches == 2
+
+
+def test_tracked_book_follows_the_notifications():
+    node = Node([limit_order(number, BASE, number) for number in range(1, 4)])
+    cache = OrderBookCache()
+    cache.track({KEY})
+    assert ids(cache.get_limit_orders(node, MARKET, 2)) == ['1.7.1', '1.7.2']
+
+    new_order = limit_order(4, BASE, 0.5)
+    node.orders[new_order['id']] = new_order
+    cache.update_order(KEY, new_order)
+    del node.orders['1.7.1']
+    cache.remove_order('1.7.1')
+
+    assert ids(cache.get_limit_orders(node, MARKET, 2)) == ['1.7.4', '1.7.2']
+    assert node.fetches == 1
+
+
+def test_tracked_book_is_reseeded_when_it_differs_from_the_node():
+    node = Node([limit_order(1, BASE, 1.0)])
+    cache = OrderBookCache(resync_interval=0)
+    cache.track({KEY})
+    cache.get_limit_orders(node, MARKET, 5)
+
+    # A notification which never arrived
+    node.orders['1.7.2'] = limit_order(2, BASE, 0.5)
+    assert ids(cache.get_limit_orders(node, MARKET, 5)) == ['1.7.2', '1.7.1']
@@ -0,0 +1,98 @@
+import time
+import types
+
+from dexbot.scheduler import TickScheduler, block_number
+
+"""
+Unit tests of the tick scheduler, driven with block ids as received by WorkerInfrastructure.on_block().
+"""
+
+
+def block_id(number):
+    return '{:08x}'.format(number) + 'a3' * 16
+
+
+def header_at(timestamp):
+    return {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(timestamp))}
+
+
+class Worker:
+    def __init__(self, tick_blocks=1, tick_interval=0, tick_on_change=False):
+        self.tick_blocks = tick_blocks
+        self.tick_interval = tick_interval
+        self.tick_on_change = tick_on_change
+
+
+def test_block_number_from_id():
+    assert block_number(block_id(31337)) == 31337
+    assert block_number(None) is None
+    assert block_number('not a block id') is None
+
+
+def test_lag_of_the_notified_block():
+    headers = {}
+    scheduler = TickScheduler(max_lag=60, block_header=headers.__getitem__)
+
+    headers[100] = header_at(time.time() - 3)
+    assert scheduler.new_block(block_id(100))
+    assert scheduler.block_num == 100
+    assert 0 <= scheduler.lag < 60
+
+    # A block produced long ago, e.g. while the node catches up, is stale
+    headers[101] = header_at(time.time() - 600)
+    assert not scheduler.new_block(block_id(101))
+    assert scheduler.lag >= 600
+    assert scheduler.behind
+
+    headers[102] = header_at(time.time())
+    assert scheduler.new_block(block_id(102))
+    assert not scheduler.behind
+
+
+def test_unknown_block_time_never_skips():
+    def fail(number):
+        raise RuntimeError('node gone')
+
+    scheduler = TickScheduler(max_lag=60, block_header=fail)
+    assert scheduler.new_block(block_id(5))
+    assert scheduler.lag is None
+    assert scheduler.block_num == 5
+
+
+def test_workers_are_spread_over_their_cadence():
+    scheduler = TickScheduler(max_lag=0)
+    names = ['worker {}'.format(index) for index in range(30)]
+    ticks = {name: [] for name in names}
+    for number in range(1, 31):
+        scheduler.new_block(block_id(number))
+        for name in names:
+            if scheduler.is_due(name, Worker(tick_blocks=3)):
+                ticks[name].append(number)
+
+    # Every worker ticks every third block, but not all on the same blocks
+    assert all(len(numbers) == 10 for numbers in ticks.values())
+    assert len({numbers[0] for numbers in ticks.values()}) == 3
+
+
+def test_tick_on_change():
+    scheduler = TickScheduler(max_lag=0)
+    worker = Worker(tick_on_change=True)
+    scheduler.new_block(block_id(1))
+    assert not scheduler.is_due('worker', worker)
+    scheduler.on_change('worker')
+    assert scheduler.is_due('worker', worker)
+    assert not scheduler.is_due('worker', worker)
+
+
+def test_lag_does_not_include_the_header_lookup(monkeypatch):
+    clock = [1000000.0]
+
+    def block_header(number):
+        # A slow node
+        clock[0] += 30
+        return header_at(1000000 - 2)
+
+    monkeypatch.setattr('dexbot.scheduler.time', types.SimpleNamespace(time=lambda: clock[0], strptime=time.strptime))
+    scheduler = TickScheduler(max_lag=10, block_header=block_header)
+    assert scheduler.new_block(block_id(100))
+    assert scheduler.lag == 2
@@ -0,0 +1,50 @@
+import pytest
+
+pytest.importorskip('bitshares')
+pytest.importorskip('click')
+
+from dexbot.sharding import NO_WORKERS_EXIT_CODE, ShardSupervisor, shard_workers  # noqa: E402
+
+"""
+Unit tests of the shard supervisor, with fake processes.
+"""
+
+
+class FakeProcess:
+
+    def __init__(self, exitcode=None):
+        self.exitcode = exitcode
+        self.name = 'dexbot-shard'
+
+    def is_alive(self):
+        return self.exitcode is None
+
+
+def supervisor(*exitcodes):
+    workers = {'worker {}'.format(index): {'account': 'account {}'.format(index)} for index in range(len(exitcodes))}
+    supervisor = ShardSupervisor({'workers': workers}, {}, len(exitcodes))
+    supervisor.started = []
+    supervisor.start_shard = supervisor.started.append
+    for shard, exitcode in zip(supervisor.shards, exitcodes):
+        shard['process'] = FakeProcess(exitcode)
+    return supervisor
+
+
+def test_workers_of_an_account_share_a_shard():
+    workers = {
+        'a1': {'account': 'a'}, 'a2': {'account': 'a'}, 'a3': {'account': 'a'},
+        'b1': {'account': 'b'}, 'c1': {'account': 'c'},
+    }
+    shards = shard_workers(workers, 2)
+    assert sorted(sorted(shard) for shard in shards) == [['a1', 'a2', 'a3'], ['b1', 'c1']]
+
+
+def test_only_crashed_shards_are_restarted():
+    shards = supervisor(None, 0, NO_WORKERS_EXIT_CODE, 1)
+    shards.check_shards()
+    assert [shard['process'] is None for shard in shards.shards] == [False, True, True, False]
+    assert shards.shards[3]['restart_at']
+
+    shards.shards[3]['restart_at'] = 1
+    shards.check_shards()
+    assert shards.started == [3]
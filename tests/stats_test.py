@@ -0,0 +1,66 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from dexbot import stats
+from dexbot.stats import HandlerStats, RPCCallCounter, load_stats
+
+"""
+Unit tests of the handler statistics files.
+"""
+
+
+def write_stats(directory, pid, updated):
+    path = os.path.join(str(directory), 'stats-{}.json'.format(pid))
+    with open(path, 'w') as file:
+        json.dump({'pid': pid, 'started': updated, 'updated': updated, 'budget': 5, 'workers': {}}, file)
+    return path
+
+
+def test_stale_stats_files_are_pruned(tmp_path, monkeypatch):
+    monkeypatch.setattr(stats, 'STATS_DIR', str(tmp_path))
+    live = write_stats(tmp_path, os.getpid(), time.time())
+    # A process which is gone, and a running one which stopped writing its statistics long ago
+    dead = write_stats(tmp_path, 2 ** 22 + 1, time.time())
+    stale = write_stats(tmp_path, os.getppid(), time.time() - 2 * stats.STATS_STALE_AGE)
+
+    assert [process['pid'] for process in load_stats()] == [os.getpid()]
+    assert os.path.exists(live)
+    assert not os.path.exists(dead)
+    assert not os.path.exists(stale)
+
+
+def test_remove_deletes_the_stats_file(tmp_path):
+    handler_stats = HandlerStats(path=str(tmp_path / 'stats-1.json'))
+    handler_stats.save()
+    assert os.path.exists(handler_stats.path)
+    handler_stats.remove()
+    assert not os.path.exists(handler_stats.path)
+
+
+class FakeRPC:
+
+    def get_objects(self, ids):
+        return [None for _ in ids]
+
+
+def test_rpc_calls_on_other_threads_count_for_the_handler(tmp_path):
+    handler_stats = HandlerStats(path=str(tmp_path / 'stats.json'))
+    rpc = RPCCallCounter(FakeRPC())
+    executor = ThreadPoolExecutor(max_workers=1)
+
+    with handler_stats.measure('worker', 'ontick', count_thread=False) as measurement:
+        # Made on the measuring thread by another coroutine, not counted
+        rpc.get_objects([])
+        executor.submit(measurement.run, rpc.get_objects, ['1.7.1']).result()
+        executor.submit(measurement.run, rpc.get_objects, ['1.7.2']).result()
+    with handler_stats.measure('worker', 'onAccount'):
+        rpc.get_objects([])
+        # Not run through the measurement
+        executor.submit(rpc.get_objects, []).result()
+    executor.shutdown()
+
+    workers = handler_stats.to_dict()['workers']
+    assert workers['worker']['ontick']['rpc_calls'] == 2
+    assert workers['worker']['onAccount']['rpc_calls'] == 1
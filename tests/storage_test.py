@@ -0,0 +1,373 @@
+import json
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.exc import IntegrityError
+
+from dexbot.storage import (
+    BULK_CHUNK_SIZE, ORDER_COLUMNS, Base, Balances, Config, DatabaseWorker, MemoryBackend, OrdersArchive,
+    Storage, order_columns, set_backend
+)
+
+"""
+Unit tests of the storage module, using database files in a temporary directory.
+"""
+
+
+@pytest.fixture(autouse=True)
+def restore_backend():
+    yield
+    set_backend(None)
+
+
+@pytest.fixture(params=['sqlite', 'memory'])
+def backend(request, tmp_path):
+    """ Storage backend used by Storage, the tests using it run against every backend
+    """
+    if request.param == 'sqlite':
+        backend = DatabaseWorker(path=str(tmp_path / 'dexbot.sqlite'))
+    else:
+        backend = MemoryBackend()
+    set_backend(backend)
+    return backend
+
+
+def test_reads_resolve_their_own_future(tmp_path):
+    database = DatabaseWorker(path=str(tmp_path / 'dexbot.sqlite'))
+
+    def fail():
+        raise ValueError('failed')
+
+    failing = database.submit(fail)
+    futures = [database.submit(lambda index=index: index * 2) for index in range(10)]
+    assert [future.result() for future in futures] == list(range(0, 20, 2))
+    assert isinstance(failing.exception(), ValueError)
+    # The worker keeps running after a task failed
+    assert database.execute(lambda: 'done') == 'done'
+
+
+def test_concurrent_reads(tmp_path):
+    database = DatabaseWorker(wal=False, path=str(tmp_path / 'dexbot.sqlite'))
+    for index in range(8):
+        database.set_item('worker', str(index), index)
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = list(executor.map(lambda index: database.get_item('worker', str(index)), range(8)))
+    assert results == list(range(8))
+
+
+def test_read_sees_queued_writes(tmp_path):
+    # A long commit latency keeps the writes in the open transaction unless the reads wait for them
+    database = DatabaseWorker(max_latency=5, path=str(tmp_path / 'dexbot.sqlite'))
+
+    database.save_balance(Balances('account', 'worker', 1.0, 'BASE', 2.0, 'QUOTE', 0.5, int(time.time())))
+    entry = database.get_recent_balance_entry('account', 'worker', 'BASE', 'QUOTE')
+    assert entry is not None
+    assert entry.quote_total == 2.0
+
+    database.set_item('worker', 'key', {'value': 1})
+    assert database.get_item('worker', 'key') == {'value': 1}
+
+
+def test_migrate_drops_obsolete_indexes(tmp_path):
+    path = str(tmp_path / 'dexbot.sqlite')
+    engine = create_engine('sqlite:///%s' % path)
+    Base.metadata.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(text('CREATE INDEX ix_orders_active ON orders (worker, order_id) WHERE deleted = 0'))
+
+    DatabaseWorker(path=path)
+    indexes = {index['name'] for index in inspect(engine).get_indexes('orders')}
+    assert 'ix_orders_active' not in indexes
+    assert 'ix_orders_worker_order_id' in indexes
+
+
+def test_only_maintaining_worker_migrates(tmp_path):
+    path = str(tmp_path / 'dexbot.sqlite')
+    engine = create_engine('sqlite:///%s' % path)
+
+    shard = DatabaseWorker(path=path, maintain=False)
+    assert not shard.maintenance_tasks
+    assert not inspect(engine).get_table_names()
+
+    supervisor = DatabaseWorker(path=path)
+    assert supervisor.maintenance_tasks
+    assert 'orders' in inspect(engine).get_table_names()
+
+
+def test_writes_are_committed_in_batches(tmp_path):
+    path = str(tmp_path / 'dexbot.sqlite')
+    database = DatabaseWorker(max_latency=5, path=path)
+    writes = [database.set_item('worker', str(index), index) for index in range(3)]
+    time.sleep(0.2)
+
+    # Other connections only see the writes once the batch is committed
+    connection = sqlite3.connect(path)
+    assert connection.execute('SELECT COUNT(*) FROM config').fetchone() == (0,)
+    assert not any(write.done() for write in writes)
+    database.flush()
+    assert connection.execute('SELECT COUNT(*) FROM config').fetchone() == (3,)
+    assert all(write.result() is None for write in writes)
+
+
+def test_failing_write_keeps_the_batch(tmp_path):
+    database = DatabaseWorker(max_latency=5, path=str(tmp_path / 'dexbot.sqlite'))
+    database.set_item('worker', 'before', 1)
+    # Violates the unique index on category and key when flushed
+    failing = database.execute_noreturn(lambda: database.session.add(Config('worker', 'before', '2')))
+    after = database.set_item('worker', 'after', 3)
+    database.flush()
+
+    assert isinstance(failing.exception(), IntegrityError)
+    assert after.result() is None
+    assert database.get_item('worker', 'before') == 1
+    assert database.get_item('worker', 'after') == 3
+
+
+def test_failing_write_drops_the_cached_category(tmp_path, monkeypatch):
+    database = DatabaseWorker(path=str(tmp_path / 'dexbot.sqlite'))
+    set_backend(database)
+    storage = Storage('worker')
+    storage['stored'] = 1
+
+    # Not serializable, the write fails on the database thread
+    monkeypatch.setattr(database, '_set_item', lambda category, key, value: json.dumps(object()))
+    storage['lost'] = 2
+    database.flush()
+    monkeypatch.undo()
+
+    assert 'worker' not in Storage._cache
+    assert storage['stored'] == 1
+    assert storage['lost'] is None
+
+
+def create_old_database(path):
+    """ Database with the tables of dexbot versions without indexes, typed order columns and balance resolution
+    """
+    engine = create_engine('sqlite:///%s' % path)
+    with engine.begin() as connection:
+        connection.execute(text(
+            'CREATE TABLE config (id INTEGER PRIMARY KEY, category VARCHAR, key VARCHAR, value VARCHAR)'))
+        connection.execute(text(
+            'CREATE TABLE orders (id INTEGER PRIMARY KEY, worker VARCHAR, order_id VARCHAR, "order" VARCHAR, '
+            'userdata VARCHAR, deleted BOOLEAN)'))
+        connection.execute(text(
+            'CREATE TABLE balances (id INTEGER PRIMARY KEY, account VARCHAR, worker VARCHAR, base_total FLOAT, '
+            'base_symbol VARCHAR, quote_total FLOAT, quote_symbol VARCHAR, center_price FLOAT, timestamp INTEGER)'))
+        connection.execute(text(
+            "INSERT INTO config (category, key, value) VALUES ('worker', 'key', '1'), ('worker', 'key', '2')"))
+        connection.execute(text(
+            "INSERT INTO balances (account, worker, base_total, base_symbol, quote_total, quote_symbol, "
+            "center_price, timestamp) VALUES ('account', 'worker', 1, 'BASE', 2, 'QUOTE', 0.5, :timestamp)"
+        ), timestamp=int(time.time()))
+    return engine
+
+
+def test_migrate_creates_indexes(tmp_path):
+    path = str(tmp_path / 'dexbot.sqlite')
+    engine = create_old_database(path)
+    database = DatabaseWorker(path=path)
+    inspector = inspect(engine)
+
+    assert 'ix_config_category_key' in {index['name'] for index in inspector.get_indexes('config')}
+    assert 'ix_orders_order_id' in {index['name'] for index in inspector.get_indexes('orders')}
+    assert 'ix_balances_history' in {index['name'] for index in inspector.get_indexes('balances')}
+    # The newest of the duplicate rows is kept for the new unique index
+    assert database.get_item('worker', 'key') == 2
+
+
+def test_storage_reads_from_the_cache(tmp_path, monkeypatch):
+    database = DatabaseWorker(path=str(tmp_path / 'dexbot.sqlite'))
+    set_backend(database)
+    storage = Storage('worker')
+    storage['key'] = {'value': 1}
+
+    def no_queries(*args):
+        raise AssertionError('The database was queried')
+
+    monkeypatch.setattr(database, 'get_item', no_queries)
+    monkeypatch.setattr(database, 'get_items', no_queries)
+    assert storage['key'] == {'value': 1}
+    assert 'key' in storage
+
+    del storage['key']
+    assert storage['key'] is None
+    assert 'key' not in storage
+    monkeypatch.undo()
+    database.flush()
+    assert database.get_item('worker', 'key') is None
+
+
+def test_storages_of_a_worker_share_the_cache(backend):
+    first = Storage('worker')
+    second = Storage('worker')
+
+    first['key'] = 1
+    assert second['key'] == 1
+    second['key'] = 2
+    assert first['key'] == 2
+    del first['key']
+    assert second['key'] is None
+    assert Storage('other')['key'] is None
+
+
+def test_bulk_save_and_remove_orders(backend):
+    storage = Storage('worker')
+    # More orders than bound to a single IN clause
+    orders = [{'id': '1.7.{}'.format(index), 'price': index} for index in range(BULK_CHUNK_SIZE + 10)]
+    storage.save_orders(orders)
+    storage.save_orders([{'id': '1.7.0', 'price': 0.5}])
+    assert len(storage.fetch_orders()) == len(orders)
+    assert storage.fetch_orders()['1.7.0'] == {'id': '1.7.0', 'price': 0.5}
+
+    storage.remove_orders(orders[1:])
+    assert list(storage.fetch_orders()) == ['1.7.0']
+    assert len(storage.fetch_orders(include_deleted=True)) == len(orders)
+    # Orders of other workers are not removed
+    Storage('other').remove_orders([orders[0]])
+    assert list(storage.fetch_orders()) == ['1.7.0']
+
+
+def test_migrate_adds_balance_resolution(tmp_path):
+    path = str(tmp_path / 'dexbot.sqlite')
+    engine = create_old_database(path)
+    database = DatabaseWorker(path=path)
+
+    assert 'resolution' in {column['name'] for column in inspect(engine).get_columns('balances')}
+    assert database.get_recent_balance_entry('account', 'worker', 'BASE', 'QUOTE').resolution == 0
+
+
+def test_rollup_balances(tmp_path):
+    database = DatabaseWorker(path=str(tmp_path / 'dexbot.sqlite'))
+    now = int(time.time())
+    # Two days ago, an entry every 10 seconds for 10 minutes, and recent entries
+    old = now - 2 * 24 * 60 * 60
+    for timestamp in list(range(old, old + 600, 10)) + [now - 20, now - 10]:
+        database.save_balance(Balances('account', 'worker', 1.0, 'BASE', 2.0, 'QUOTE', 0.5, timestamp))
+    database.flush()
+
+    database.execute(database._rollup_balances)
+    database.flush()
+
+    entries = database.execute(lambda: database.session.query(Balances).order_by(Balances.timestamp).all())
+    rolled_up = [entry for entry in entries if entry.timestamp < now - 24 * 60 * 60]
+    # One entry per minute bucket of the first tier, the recent ones are untouched
+    assert len({entry.timestamp // 60 for entry in rolled_up}) == len(rolled_up)
+    assert all(entry.resolution == 60 for entry in rolled_up)
+    assert [entry.timestamp for entry in entries[-2:]] == [now - 20, now - 10]
+
+
+def test_migrate_adds_typed_order_columns(tmp_path):
+    path = str(tmp_path / 'dexbot.sqlite')
+    engine = create_old_database(path)
+    with engine.begin() as connection:
+        connection.execute(text(
+            "INSERT INTO orders (worker, order_id, \"order\", userdata, deleted) "
+            "VALUES ('worker', '1.7.1', '{\"id\": \"1.7.1\"}', '', 0)"))
+    database = DatabaseWorker(path=path)
+
+    order_columns = {column['name'] for column in inspect(engine).get_columns('orders')}
+    assert set(ORDER_COLUMNS) | {'deleted_at'} <= order_columns
+    assert 'ix_orders_worker_side_price' in {index['name'] for index in inspect(engine).get_indexes('orders')}
+    # Old rows keep their json and get empty typed columns
+    assert database.fetch_orders('worker') == {'1.7.1': {'id': '1.7.1'}}
+    record = database.fetch_order_records('worker')['1.7.1']
+    assert record.side is None and record.price is None
+
+
+class SidedStorage(Storage):
+    """ Stores the side like the strategies do, see StrategyBase.order_columns()
+    """
+
+    def order_columns(self, order):
+        return dict(order_columns(order), side=order['side'], price=order['price'])
+
+
+def test_fetch_orders_by_price(backend):
+    storage = SidedStorage('worker')
+    storage.store_raw_orders = False
+    storage.save_orders([
+        {'id': '1.7.1', 'side': 'buy', 'price': 3.0},
+        {'id': '1.7.2', 'side': 'buy', 'price': 1.0},
+        {'id': '1.7.3', 'side': 'buy', 'price': 2.0},
+        {'id': '1.7.4', 'side': 'sell', 'price': 2.5},
+    ])
+    storage.remove_orders([{'id': '1.7.3'}])
+
+    assert [record.order_id for record in storage.fetch_orders_by_price('buy')] == ['1.7.2', '1.7.1']
+    assert [record.order_id for record in storage.fetch_orders_by_price('buy', min_price=2)] == ['1.7.1']
+    assert [record.order_id for record in storage.fetch_orders_by_price('buy', max_price=2)] == ['1.7.2']
+    assert [record.price for record in storage.fetch_orders_by_price('sell', 2, 3)] == [2.5]
+    # Without the raw order the order is built from the typed columns
+    assert storage.fetch_orders()['1.7.4']['side'] == 'sell'
+
+
+def test_archive_deleted_orders(tmp_path):
+    database = DatabaseWorker(path=str(tmp_path / 'dexbot.sqlite'), order_archive_age=0)
+    database.save_orders('worker', {
+        '1.7.1': {'order': None, 'side': 'buy', 'price': 1.0},
+        '1.7.2': {'order': None, 'side': 'sell', 'price': 2.0},
+    })
+    database.remove_orders('worker', ['1.7.1'])
+    database.flush()
+    time.sleep(1)
+
+    database.execute(database._archive_orders)
+    database.flush()
+    assert set(database.fetch_orders('worker', include_deleted=True)) == {'1.7.2'}
+    archived = database.execute(lambda: database.session.query(OrdersArchive.order_id).all())
+    assert [row.order_id for row in archived] == ['1.7.1']
+
+
+def test_item_round_trip(backend):
+    storage = Storage('worker')
+    storage['key'] = {'value': [1, 2]}
+    storage['other'] = 'text'
+    del storage['other']
+    backend.flush()
+
+    # A new cache is loaded from the backend
+    set_backend(backend)
+    assert Storage('worker')['key'] == {'value': [1, 2]}
+    assert dict(Storage('worker').items()) == {'key': json.dumps({'value': [1, 2]})}
+    assert backend.get_item('worker', 'other') is None
+
+    Storage('worker').clear()
+    backend.flush()
+    assert backend.get_items('worker') == []
+
+
+def test_order_round_trip(backend):
+    storage = Storage('worker')
+    order = {'id': '1.7.1', 'base': {'amount': 2, 'asset': {'id': '1.3.0'}},
+             'quote': {'amount': 4, 'asset': {'id': '1.3.1'}}}
+    storage.save_order(order)
+    storage.update_order('1.7.1', 'userdata')
+    backend.flush()
+
+    assert storage.fetch_orders() == {'1.7.1': order}
+    assert Storage.fetch_order('1.7.1').userdata == 'userdata'
+    record = storage.fetch_orders(records=True)['1.7.1']
+    assert (record.price, record.base_asset, record.quote_amount) == (0.5, '1.3.0', 4)
+
+    storage.remove_order(order)
+    assert storage.fetch_orders() is None
+    assert list(storage.fetch_orders(include_deleted=True)) == ['1.7.1']
+    assert storage.fetch_orders(include_deleted=True, raw=True)[0].deleted
+
+    Storage.clear_worker_data('worker')
+    assert storage.fetch_orders(include_deleted=True) is None
+
+
+def test_balance_round_trip(backend):
+    now = int(time.time())
+    for base_total in (1, 2, 3):
+        Storage.store_balance_entry('account', 'worker', base_total, 'BASE', 1.0, 'QUOTE', 0.5, now + base_total)
+    Storage.store_balance_entry('account', 'other', 4, 'BASE', 1.0, 'QUOTE', 0.5, now + 4)
+
+    assert Storage.get_balance_history('account', 'worker', now + 1, 'BASE', 'QUOTE').base_total == 2
+    assert Storage.get_balance_history('account', 'worker', now + 3, 'BASE', 'QUOTE') is None
+    assert Storage.get_recent_balance_entry('account', 'worker', 'BASE', 'QUOTE').base_total == 3
@@ -0,0 +1,179 @@
+import logging
+import types
+
+import pytest
+
+pytest.importorskip('bitshares')
+
+from dexbot.depth import MarketDepth  # noqa: E402
+from dexbot.strategies.base import ACCOUNT_SNAPSHOT_MAX_AGE, StrategyBase  # noqa: E402
+from dexbot.worker import WorkerInfrastructure  # noqa: E402
+
+"""
+Unit tests of the account snapshot, the order lookups and the market prices of the strategies, with a stub account
+and RPC.
+"""
+
+
+class StubAmount(dict):
+    """ Amount of an asset, without looking the asset up
+    """
+
+    def __init__(self, amount, symbol=None, bitshares_instance=None):
+        if isinstance(amount, dict):
+            amount, symbol = int(amount['amount']), amount['asset_id']
+        super().__init__(amount=amount, symbol=symbol)
+
+    def copy(self):
+        return StubAmount(self['amount'], self['symbol'])
+
+
+class StubAccount(dict):
+    """ Full account, fetched again from the chain state on refresh()
+    """
+
+    def __init__(self, chain):
+        super().__init__(chain)
+        self.chain = chain
+        self.refreshes = 0
+
+    def refresh(self):
+        self.refreshes += 1
+        self.clear()
+        self.update(self.chain)
+
+
+def account_balances(**amounts):
+    return [{'asset_type': symbol, 'balance': str(amount)} for symbol, amount in amounts.items()]
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = [1000.0]
+    monkeypatch.setattr('dexbot.strategies.base.time', types.SimpleNamespace(time=lambda: clock[0]))
+    monkeypatch.setattr('dexbot.strategies.base.Amount', StubAmount)
+    return clock
+
+
+def strategy(chain):
+    """ Strategy reading the account from the chain state, without connecting to a node
+    """
+    strategy = StrategyBase.__new__(StrategyBase)
+    strategy.bitshares = types.SimpleNamespace(rpc=None)
+    strategy.log = logging.getLogger(__name__)
+    strategy.disabled = False
+    strategy._account = StubAccount(chain)
+    strategy._market = {'base': {'symbol': 'USD'}, 'quote': {'symbol': 'BTS'}}
+    strategy._balances = None
+    strategy.account_refreshed = 0
+    strategy._take_account_snapshot()
+    return strategy
+
+
+def test_account_snapshot_expires(clock):
+    chain = {'name': 'alice', 'balances': account_balances(BTS=100), 'limit_orders': []}
+    worker = strategy(chain)
+
+    chain['balances'] = account_balances(BTS=60)
+    clock[0] += ACCOUNT_SNAPSHOT_MAX_AGE
+    assert worker.balance('BTS')['amount'] == 100
+    assert worker._account.refreshes == 0
+
+    clock[0] += 0.1
+    assert worker.balance('BTS')['amount'] == 60
+    assert worker.balance('BTS')['amount'] == 60
+    assert worker._account.refreshes == 1
+
+
+def test_account_event_invalidates_the_snapshot(clock):
+    chain = {'name': 'alice', 'balances': account_balances(BTS=100), 'limit_orders': []}
+    worker = strategy(chain)
+    seen = []
+    worker.onAccount = lambda update: seen.append(worker.balance('BTS')['amount'])
+    worker.error_onAccount = lambda error: seen.append(error)
+    workers = WorkerInfrastructure({'node': 'wss://node', 'workers': {
+        'worker': {'account': 'alice', 'market': 'BTS/USD'},
+    }}, bitshares_instance=worker.bitshares)
+    workers.workers = {'worker': worker}
+    workers.update_routes()
+
+    chain['balances'] = account_balances(BTS=60)
+    workers.on_account(types.SimpleNamespace(account={'name': 'alice'}))
+    assert seen == [60]
+    assert worker._account.refreshes == 1
+
+
+def test_balance_returns_a_copy(clock):
+    worker = strategy({'name': 'alice', 'balances': account_balances(BTS=100), 'limit_orders': []})
+
+    balance = worker.balance('BTS')
+    balance['amount'] -= 40
+    assert worker.balance('BTS', fee_reservation=10)['amount'] == 90
+    assert worker.balance({'symbol': 'BTS'})['amount'] == 100
+    assert worker.balances == [StubAmount(100, 'BTS')]
+    assert worker.balance('USD')['amount'] == 0
+
+
+def limit_order(order_id):
+    return {
+        'id': order_id,
+        'for_sale': 50,
+        'sell_price': {'base': {'amount': 100, 'asset_id': '1.3.0'}, 'quote': {'amount': 200, 'asset_id': '1.3.1'}},
+    }
+
+
+class OrdersRPC:
+    """ Returns the orders of the ids it is asked for, None for the filled orders
+    """
+
+    def __init__(self, filled):
+        self.filled = filled
+        self.calls = []
+
+    def get_objects(self, ids):
+        self.calls.append(list(ids))
+        return [None if order_id in self.filled else limit_order(order_id) for order_id in ids]
+
+
+def test_orders_are_fetched_in_chunks(clock, monkeypatch):
+    monkeypatch.setattr('dexbot.strategies.base.Order', lambda order, bitshares_instance=None: order)
+    order_ids = ['1.7.{}'.format(number) for number in range(250)]
+    own = order_ids[:2]
+    filled = set(order_ids[2::10])
+    worker = strategy({'name': 'alice', 'balances': [], 'limit_orders': [limit_order(order_id) for order_id in own]})
+    worker.bitshares.rpc = rpc = OrdersRPC(filled)
+
+    # Duplicates are fetched once, own orders come from the account snapshot
+    orders = worker.get_updated_orders(order_ids + order_ids[:20] + [{'id': order_ids[-1]}])
+    assert [len(chunk) for chunk in rpc.calls] == [100, 100, 48]
+    assert sum(rpc.calls, []) == order_ids[2:]
+    assert set(orders) == set(order_ids)
+    for order_id in order_ids:
+        if order_id in filled:
+            assert orders[order_id] is None
+        else:
+            assert orders[order_id]['id'] == order_id
+            assert orders[order_id]['sell_price']['base']['amount'] == 50
+            assert orders[order_id]['sell_price']['quote']['amount'] == 100
+
+    # Single orders are looked up the same way
+    rpc.calls = []
+    assert worker.get_updated_order(own[0])['id'] == own[0]
+    assert worker.get_updated_order(order_ids[2]) is None
+    assert worker.get_updated_order({'id': order_ids[3]})['id'] == order_ids[3]
+    assert rpc.calls == [[order_ids[2]], [order_ids[3]]]
+
+
+def test_empty_market_side_has_no_price(clock):
+    worker = strategy({'name': 'alice', 'balances': [], 'limit_orders': []})
+    worker.get_market_fee = lambda: 0
+    depths = {'buy': MarketDepth([2.0, 1.0], [20.0, 10.0], [10.0, 10.0]), 'sell': MarketDepth([], [], [])}
+    worker.get_market_depth = lambda side, exclude_own_orders=False: depths[side]
+
+    for exclude_own_orders in (True, False):
+        assert worker.get_market_sell_price(exclude_own_orders=exclude_own_orders) is None
+        assert worker.get_market_sell_price(quote_amount=5, exclude_own_orders=exclude_own_orders) is None
+        assert worker.get_market_buy_price(exclude_own_orders=exclude_own_orders) == 2.0
+        assert worker.get_market_buy_price(quote_amount=15, exclude_own_orders=exclude_own_orders) == 25 / 15
+    assert worker.get_market_spread() is None
+    assert worker.get_market_spread(quote_amount=5) is None
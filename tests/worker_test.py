@@ -0,0 +1,196 @@
+import logging
+import types
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+pytest.importorskip('bitshares')
+
+from dexbot.dispatcher import create_dispatcher  # noqa: E402
+from dexbot.worker import WorkerInfrastructure, market_key  # noqa: E402
+
+"""
+Unit tests of the event routing of the worker infrastructure, with stub workers.
+"""
+
+
+def market(quote, base):
+    return {'base': {'symbol': base}, 'quote': {'symbol': quote}}
+
+
+class StubWorker:
+    """ Records the events it handles instead of trading
+    """
+
+    def __init__(self, market_name):
+        quote, base = market_name.split(':')
+        self.market = market(quote, base)
+        self.bitshares = None
+        self.disabled = False
+        self.log = logging.getLogger(__name__)
+        self.events = []
+
+    def invalidate_account(self):
+        pass
+
+    def onMarketUpdate(self, data):
+        self.events.append(('market', data))
+
+    def onAccount(self, data):
+        self.events.append(('account', data))
+
+
+def infrastructure(workers):
+    """ Worker infrastructure running the stub workers, by worker name to (account, market)
+    """
+    config = {'node': 'wss://node', 'workers': {
+        worker_name: {'account': account, 'market': market_name}
+        for worker_name, (account, market_name) in workers.items()
+    }}
+    infrastructure = WorkerInfrastructure(config, bitshares_instance=types.SimpleNamespace(rpc=None))
+    infrastructure.workers = {
+        worker_name: StubWorker(market_name) for worker_name, (account, market_name) in workers.items()
+    }
+    infrastructure.update_routes()
+    return infrastructure
+
+
+def account_update(name):
+    return types.SimpleNamespace(account={'name': name})
+
+
+def test_market_key_ignores_the_orientation():
+    assert market_key(market('BTS', 'USD')) == market_key(market('USD', 'BTS'))
+    assert market_key(market('BTS', 'USD')) != market_key(market('BTS', 'CNY'))
+
+
+def test_events_reach_the_subscribed_workers_only():
+    workers = infrastructure({
+        'bts-usd': ('alice', 'BTS:USD'),
+        'usd-bts': ('bob', 'USD:BTS'),
+        'bts-cny': ('alice', 'BTS:CNY'),
+    })
+    assert workers.markets == {'BTS:USD', 'USD:BTS', 'BTS:CNY'}
+    assert workers.accounts == {'alice', 'bob'}
+
+    order = dict(market('BTS', 'USD'), id='1.7.1')
+    workers.on_market(order)
+    assert workers.workers['bts-usd'].events == [('market', order)]
+    assert workers.workers['usd-bts'].events == [('market', order)]
+    assert workers.workers['bts-cny'].events == []
+
+    update = account_update('bob')
+    workers.on_account(update)
+    assert workers.workers['usd-bts'].events[-1] == ('account', update)
+    assert workers.workers['bts-usd'].events == [('market', order)]
+    # Accounts without workers are ignored
+    workers.on_account(account_update('carol'))
+
+
+def test_routes_are_rebuilt_when_workers_change():
+    workers = infrastructure({'bts-usd': ('alice', 'BTS:USD')})
+
+    workers.config['workers']['bts-cny'] = {'account': 'bob', 'market': 'BTS:CNY'}
+    workers.workers['bts-cny'] = StubWorker('BTS:CNY')
+    workers.update_routes()
+    workers.on_account(account_update('bob'))
+    assert [kind for kind, data in workers.workers['bts-cny'].events] == ['account']
+    assert set(workers.inboxes) == {'bts-usd', 'bts-cny'}
+
+    workers.config['workers'].pop('bts-usd')
+    stopped = workers.workers.pop('bts-usd')
+    workers.update_routes()
+    workers.on_market(dict(market('BTS', 'USD'), id='1.7.1'))
+    workers.on_account(account_update('alice'))
+    assert stopped.events == []
+    assert workers.markets == {'BTS:CNY'}
+    assert workers.accounts == {'bob'}
+    assert set(workers.inboxes) == {'bts-cny'}
+
+
+class CoroutineWorker(StubWorker):
+
+    async def onMarketUpdate(self, data):
+        self.events.append(('market', data))
+
+    def error_onMarketUpdate(self, error):
+        self.events.append(('error', type(error)))
+
+
+def test_coroutine_handlers_fail_outside_the_asyncio_mode():
+    workers = infrastructure({'bts-usd': ('alice', 'BTS:USD')})
+    worker = workers.workers['bts-usd'] = CoroutineWorker('BTS:USD')
+    workers.handle_event('bts-usd', 'onMarketUpdate', 'error_onMarketUpdate', {})
+    assert worker.events == [('error', TypeError)]
+
+
+class StubWebsocket:
+    """ Records the subscription calls of the notification websocket
+    """
+
+    __events__ = ['on_block', 'on_market', 'on_account']
+
+    def __init__(self, markets, accounts):
+        self.subscription_markets = list(markets)
+        self.subscription_accounts = list(accounts)
+        self.calls = []
+
+    def subscribe_to_market(self, callback, *market_ids):
+        self.calls.append(('subscribe', callback) + market_ids)
+
+    def unsubscribe_from_market(self, *market_ids):
+        self.calls.append(('unsubscribe',) + market_ids)
+
+    def get_full_accounts(self, accounts, subscribe):
+        self.calls.append(('accounts', sorted(accounts), subscribe))
+
+
+def market_ids(market_name, bitshares_instance=None):
+    quote, base = market_name.split(':')
+    return {'base': {'id': base.lower()}, 'quote': {'id': quote.lower()}}
+
+
+def test_only_the_changed_subscriptions_are_sent(monkeypatch):
+    monkeypatch.setattr('dexbot.worker.Market', market_ids)
+    workers = infrastructure({'bts-usd': ('alice', 'BTS:USD'), 'bts-cny': ('bob', 'BTS:CNY')})
+    websocket = StubWebsocket([['usd', 'bts'], ['cny', 'bts']], ['alice', 'bob'])
+    workers.notify = types.SimpleNamespace(websocket=websocket)
+    workers.subscribed_markets = set(workers.markets)
+    workers.subscribed_accounts = set(workers.accounts)
+
+    workers.config['workers'].pop('bts-cny')
+    workers.workers.pop('bts-cny')
+    workers.config['workers']['eur-bts'] = {'account': 'carol', 'market': 'EUR:BTS'}
+    workers.workers['eur-bts'] = StubWorker('EUR:BTS')
+    workers.update_routes()
+    workers.update_subscriptions()
+
+    assert websocket.calls == [
+        ('subscribe', 1, 'bts', 'eur'),
+        ('unsubscribe', 'cny', 'bts'),
+        ('accounts', ['carol'], True),
+    ]
+    assert websocket.subscription_markets == [['usd', 'bts'], ['bts', 'eur']]
+    assert websocket.subscription_accounts == ['alice', 'carol']
+    assert workers.subscribed_markets == {'BTS:USD', 'EUR:BTS'}
+    assert workers.subscribed_accounts == {'alice', 'carol'}
+
+
+class HeaderRPC:
+
+    def get_block_header(self, number):
+        return {'timestamp': '2019-01-01T00:00:00', 'number': number}
+
+
+def test_block_headers_do_not_wait_for_the_handlers(monkeypatch):
+    monkeypatch.setattr('dexbot.worker.BitShares', lambda node, **kwargs: types.SimpleNamespace(rpc=HeaderRPC()))
+    for mode in ('sequential', 'threads'):
+        workers = infrastructure({'bts-usd': ('alice', 'BTS:USD')})
+        workers.dispatcher = create_dispatcher({'dispatch_mode': mode})
+        workers.bitshares.rpc = HeaderRPC()
+
+        # A handler is using the shared instance
+        with workers.instance_locks.get(workers.bitshares):
+            header = ThreadPoolExecutor(max_workers=1).submit(workers.block_header, 5).result(timeout=1)
+        assert header['number'] == 5
+        workers.dispatcher.shutdown()